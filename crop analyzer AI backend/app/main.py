@@ -1,17 +1,400 @@
 import os
+import json
+import asyncio
 import time
-from fastapi import FastAPI, HTTPException, UploadFile, File
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from typing import Optional
+from typing import Optional, Dict, Any, List
 
-from app.services.crop_analyzer import CropAnalyzer
+from app.services.batch import BatchItem, close_uploads, detach_uploads, expand_batch_uploads, run_batch
+from app.services.crop_analyzer import DEFAULT_MODEL, CropAnalyzer
+from app.services.history import ROLLUP_GROUPS, HistoryStore, parse_day
+from app.services.jobs import JobQueueFull, create_job_queue
+from app.services.metrics import CONTENT_TYPE, REGISTRY, MetricsMiddleware, monitor_event_loop_lag, stage
+from app.services.image_detail import DETAIL_MODES, DetailPolicy
+from app.services.perceptual_hash import HammingIndex
+from app.services.rate_limiter import AdaptiveConcurrencyLimiter, UpstreamLimiter
+from app.services.resilience import ResilientCaller, parse_targets
+from app.services.request_context import run_cancellable
+from app.services.result_cache import AnalysisCache
+from app.services.scheduler import FairScheduler, Flow, scheduling
+from app.services.shared_state import SharedState
+from app.services.static_assets import WebAssets
+from app.services.triage import Triage, create_triage_backend
+from app.services.upload_limits import UploadBudget, UploadLimitMiddleware, read_upload_limited
+from app.services.upstream_client import create_upstream_client, get_pool_stats
+from app.services.warmup import warm_up
 
 load_dotenv()
 
-app = FastAPI(title="AI Crop Disease Analyzer")
+# Configuration
+MAX_FILE_SIZE_MB = int(os.getenv("MAX_FILE_SIZE_MB", 10))
+MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
+
+# Upload ingestion limits: multipart framing allowance per request and the
+# total body bytes allowed in flight across all concurrent uploads
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+UPLOAD_INFLIGHT_BUDGET_MB = int(os.getenv("UPLOAD_INFLIGHT_BUDGET_MB", 256))
+
+# Batch analysis configuration
+MAX_BATCH_SIZE_MB = int(os.getenv("MAX_BATCH_SIZE_MB", 1024))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 8))
+# Images per upstream completion in batches; 1 disables packing
+BATCH_PACK_SIZE = int(os.getenv("BATCH_PACK_SIZE", 1))
+
+# Asynchronous job queue configuration
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "memory")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_QUEUE_MAX_SIZE = int(os.getenv("JOB_QUEUE_MAX_SIZE", 100))
+JOB_RESULT_TTL_S = float(os.getenv("JOB_RESULT_TTL_S", 3600))
+# On shutdown, give queued and running jobs this long to finish before failing them
+JOB_DRAIN_TIMEOUT_S = float(os.getenv("JOB_DRAIN_TIMEOUT_S", 10))
+
+# Upstream (OpenRouter) connection pool configuration
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 100))
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", 20))
+UPSTREAM_KEEPALIVE_EXPIRY_S = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY_S", 30))
+UPSTREAM_TIMEOUT_S = float(os.getenv("UPSTREAM_TIMEOUT_S", 30))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() == "true"
+
+# Upstream rate limits (0 disables a bucket) and adaptive concurrency bounds
+UPSTREAM_RPM = float(os.getenv("UPSTREAM_RPM", 0))
+UPSTREAM_TPM = float(os.getenv("UPSTREAM_TPM", 0))
+UPSTREAM_CONCURRENCY_INITIAL = int(os.getenv("UPSTREAM_CONCURRENCY_INITIAL", 8))
+UPSTREAM_CONCURRENCY_MIN = int(os.getenv("UPSTREAM_CONCURRENCY_MIN", 1))
+UPSTREAM_CONCURRENCY_MAX = int(os.getenv("UPSTREAM_CONCURRENCY_MAX", 64))
+
+# Priority lanes for upstream capacity: weighted fair queueing between lanes (highest priority first),
+# round-robin between tenants within a lane. Web/API uploads default to the first lane, batch and
+# jobs to the last; API keys (X-API-Key) name tenants and may assign a lower lane
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+SCHEDULER_LANES = os.getenv("SCHEDULER_LANES", "interactive=8,standard=3,bulk=1")
+SCHEDULER_API_KEYS = os.getenv("SCHEDULER_API_KEYS", "")
+SCHEDULER_TENANT_CAPS = os.getenv("SCHEDULER_TENANT_CAPS", "")
+# Upstream calls in flight per tenant unless SCHEDULER_TENANT_CAPS says otherwise, 0 = no cap
+SCHEDULER_TENANT_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_TENANT_MAX_CONCURRENCY", 0))
+
+# Upstream resilience: ordered models ("model" or "model@url"), retries, hedging and circuit breaking
+OPENROUTER_MODELS = os.getenv("OPENROUTER_MODELS", DEFAULT_MODEL)
+# Point at another OpenAI-compatible endpoint, e.g. the mock server in benchmarks/ for load tests
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", 3))
+UPSTREAM_RETRY_BASE_DELAY_S = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY_S", 0.5))
+UPSTREAM_RETRY_MAX_DELAY_S = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY_S", 8))
+# Hedge a request once it is slower than this latency percentile; 0 disables hedging
+UPSTREAM_HEDGE_PERCENTILE = float(os.getenv("UPSTREAM_HEDGE_PERCENTILE", 95))
+UPSTREAM_BREAKER_FAILURES = int(os.getenv("UPSTREAM_BREAKER_FAILURES", 5))
+UPSTREAM_BREAKER_RESET_S = float(os.getenv("UPSTREAM_BREAKER_RESET_S", 30))
+# Stream single-image completions and return as soon as every analysis field has arrived
+UPSTREAM_STREAMING = os.getenv("UPSTREAM_STREAMING", "true").lower() == "true"
+# Mark the static system prompt for provider prompt caching (Anthropic and Gemini models)
+PROMPT_CACHING_ENABLED = os.getenv("PROMPT_CACHING_ENABLED", "true").lower() == "true"
+
+# Metrics configuration (Prometheus text format on GET /metrics)
+# Adds a Server-Timing header with per-stage durations, visible in browser dev tools
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "false").lower() == "true"
+# Event-loop lag sampling period, 0 = off
+EVENT_LOOP_LAG_INTERVAL_MS = float(os.getenv("EVENT_LOOP_LAG_INTERVAL_MS", 100))
+
+# Multi-worker configuration (see app/serve.py)
+# SQLite file shared by the worker processes for rate-limit buckets and metrics, empty = per process
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "")
+# How often each worker publishes its metrics for the others to report
+METRICS_PUBLISH_INTERVAL_S = float(os.getenv("METRICS_PUBLISH_INTERVAL_S", 5))
+# At startup, resolve the upstream hosts, open pooled connections and spawn preprocessing workers
+UPSTREAM_WARMUP = os.getenv("UPSTREAM_WARMUP", "true").lower() == "true"
+UPSTREAM_WARMUP_CONNECTIONS = int(os.getenv("UPSTREAM_WARMUP_CONNECTIONS", 2))
+
+# Analysis result cache configuration
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 1024))
+CACHE_TTL_S = float(os.getenv("CACHE_TTL_S", 86400))
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "analysis_cache.sqlite3")
+
+# Analysis history (every result, with daily rollups by disease/crop/severity), written behind the request
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "true").lower() == "true"
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "analysis_history.sqlite3")
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", 500))
+HISTORY_FLUSH_INTERVAL_S = float(os.getenv("HISTORY_FLUSH_INTERVAL_S", 1))
+# Records buffered beyond this (e.g. while the disk is stalled) are dropped, not queued without bound
+HISTORY_MAX_PENDING = int(os.getenv("HISTORY_MAX_PENDING", 10000))
+
+# Near-duplicate (perceptual hash) lookup configuration
+PHASH_ENABLED = os.getenv("PHASH_ENABLED", "true").lower() == "true"
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", 6))
+# Largest difference of any mean color channel (0-255) between an image and a near duplicate it may reuse
+PHASH_MAX_COLOR_DISTANCE = int(os.getenv("PHASH_MAX_COLOR_DISTANCE", 24))
+# How often each worker adds hashes that other workers wrote to the cache's disk tier, 0 = off
+PHASH_SYNC_INTERVAL_S = float(os.getenv("PHASH_SYNC_INTERVAL_S", 2))
+# Rows are timestamped just before their write commits, so each sync re-reads this far back
+PHASH_SYNC_OVERLAP_S = 5
+
+# Image preprocessing (decode, EXIF-orient, downscale, re-encode) in a process pool
+PREPROCESS_ENABLED = os.getenv("PREPROCESS_ENABLED", "true").lower() == "true"
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", min(4, os.cpu_count() or 1)))
+PREPROCESS_MAX_EDGE = int(os.getenv("PREPROCESS_MAX_EDGE", 1024))
+PREPROCESS_JPEG_QUALITY = int(os.getenv("PREPROCESS_JPEG_QUALITY", 85))
+
+# Image detail level per upstream call: auto (from local signals), low, high, or off (no hint)
+IMAGE_DETAIL = os.getenv("IMAGE_DETAIL", "auto").lower()
+if IMAGE_DETAIL not in DETAIL_MODES:
+    raise ValueError(f"IMAGE_DETAIL must be one of {', '.join(DETAIL_MODES)}")
+IMAGE_DETAIL_LOW_MAX_EDGE = int(os.getenv("IMAGE_DETAIL_LOW_MAX_EDGE", 512))
+IMAGE_DETAIL_MIN_GREEN_FRACTION = float(os.getenv("IMAGE_DETAIL_MIN_GREEN_FRACTION", 0.4))
+IMAGE_DETAIL_BLUR_THRESHOLD = float(os.getenv("IMAGE_DETAIL_BLUR_THRESHOLD", 4.0))
+# Ask again in high detail when a low-detail answer is unparseable, incomplete or low-confidence
+IMAGE_DETAIL_ESCALATE = os.getenv("IMAGE_DETAIL_ESCALATE", "true").lower() == "true"
+
+# Local triage model: "none", "color" (bundled, offline) or "onnx" (needs onnxruntime)
+TRIAGE_BACKEND = os.getenv("TRIAGE_BACKEND", "none")
+TRIAGE_MODEL_PATH = os.getenv("TRIAGE_MODEL_PATH", "")
+TRIAGE_LABELS_PATH = os.getenv("TRIAGE_LABELS_PATH", "")
+TRIAGE_INPUT_SIZE = int(os.getenv("TRIAGE_INPUT_SIZE", 224))
+TRIAGE_CONFIDENCE_THRESHOLD = float(os.getenv("TRIAGE_CONFIDENCE_THRESHOLD", 0.9))
+TRIAGE_WORKERS = int(os.getenv("TRIAGE_WORKERS", 2))
+TRIAGE_MAX_BATCH_SIZE = int(os.getenv("TRIAGE_MAX_BATCH_SIZE", 16))
+TRIAGE_MAX_WAIT_MS = float(os.getenv("TRIAGE_MAX_WAIT_MS", 5))
+
+WORKER_ID = str(os.getpid())
+
+async def publish_metrics(shared_state: SharedState):
+    """Periodically store this worker's metrics where the other workers' /metrics can add them"""
+    while True:
+        await asyncio.sleep(METRICS_PUBLISH_INTERVAL_S)
+        try:
+            await asyncio.to_thread(shared_state.publish_metrics, WORKER_ID, REGISTRY.snapshot())
+        except Exception as e:
+            print(f"Publishing metrics failed: {e}")
+
+async def sync_phash_index(cache: AnalysisCache, index: HammingIndex, synced_at: float):
+    """Periodically add the perceptual hashes other workers stored since the last sync"""
+    while True:
+        await asyncio.sleep(PHASH_SYNC_INTERVAL_S)
+        started = time.time()
+        try:
+            rows = await asyncio.to_thread(cache.load_phashes, synced_at - PHASH_SYNC_OVERLAP_S)
+        except Exception as e:
+            print(f"Syncing the near-duplicate index failed: {e}")
+            continue
+        # Hashes already indexed (our own writes, the overlap) are no-ops
+        for key, phash, color, expires_at in rows:
+            index.add(phash, key, expires_at=expires_at, color=color)
+        # Also drops hashes whose rows expired, on workers that have stopped adding
+        index.expire()
+        synced_at = started
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled client for the whole app lifetime, so upstream connections are reused
+    app.state.http_client = create_upstream_client(
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY_S,
+        timeout=UPSTREAM_TIMEOUT_S,
+        http2=UPSTREAM_HTTP2,
+    )
+    app.state.shared_state = SharedState(SHARED_STATE_PATH) if SHARED_STATE_PATH else None
+    concurrency = AdaptiveConcurrencyLimiter(
+        initial=UPSTREAM_CONCURRENCY_INITIAL,
+        minimum=UPSTREAM_CONCURRENCY_MIN,
+        maximum=UPSTREAM_CONCURRENCY_MAX,
+    )
+    app.state.scheduler = FairScheduler.from_config(
+        concurrency,
+        SCHEDULER_LANES,
+        api_keys=SCHEDULER_API_KEYS,
+        tenant_caps=SCHEDULER_TENANT_CAPS,
+        default_tenant_cap=SCHEDULER_TENANT_MAX_CONCURRENCY,
+    ) if SCHEDULER_ENABLED else None
+    app.state.upstream_limiter = UpstreamLimiter(
+        requests_per_minute=UPSTREAM_RPM,
+        tokens_per_minute=UPSTREAM_TPM,
+        concurrency=concurrency,
+        shared=app.state.shared_state,
+        scheduler=app.state.scheduler,
+    )
+    # Entries leave the index when they expire or the LRU evicts them, so it stays as large as the cache
+    app.state.phash_index = HammingIndex(
+        max_distance=PHASH_MAX_DISTANCE, max_color_distance=PHASH_MAX_COLOR_DISTANCE
+    ) if PHASH_ENABLED and CACHE_ENABLED else None
+    app.state.analysis_cache = AnalysisCache(
+        max_entries=CACHE_MAX_ENTRIES,
+        ttl_seconds=CACHE_TTL_S,
+        db_path=CACHE_DB_PATH or None,
+        on_evict=app.state.phash_index.remove if app.state.phash_index is not None else None,
+    ) if CACHE_ENABLED else None
+    phash_loaded_at = time.time()
+    if app.state.phash_index is not None:
+        for key, phash, color, expires_at in app.state.analysis_cache.load_phashes():
+            app.state.phash_index.add(phash, key, expires_at=expires_at, color=color)
+    # Spawned (not forked) workers, so they never inherit the event loop or open sockets
+    app.state.preprocess_executor = ProcessPoolExecutor(
+        max_workers=PREPROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    ) if PREPROCESS_WORKERS > 0 else None
+    triage_backend = create_triage_backend(
+        TRIAGE_BACKEND,
+        model_path=TRIAGE_MODEL_PATH,
+        labels_path=TRIAGE_LABELS_PATH,
+        input_size=TRIAGE_INPUT_SIZE,
+    )
+    app.state.triage_executor = ThreadPoolExecutor(
+        max_workers=TRIAGE_WORKERS, thread_name_prefix="triage"
+    ) if triage_backend is not None else None
+    app.state.triage = Triage(
+        triage_backend,
+        confidence_threshold=TRIAGE_CONFIDENCE_THRESHOLD,
+        max_batch_size=TRIAGE_MAX_BATCH_SIZE,
+        max_wait_ms=TRIAGE_MAX_WAIT_MS,
+        executor=app.state.triage_executor,
+    ) if triage_backend is not None else None
+    app.state.crop_analyzer = CropAnalyzer(
+        os.getenv("OPENROUTER_API_KEY"),
+        http_client=app.state.http_client,
+        cache=app.state.analysis_cache,
+        phash_index=app.state.phash_index,
+        preprocess_executor=app.state.preprocess_executor,
+        preprocess_enabled=PREPROCESS_ENABLED,
+        max_image_edge=PREPROCESS_MAX_EDGE,
+        jpeg_quality=PREPROCESS_JPEG_QUALITY,
+        detail_policy=DetailPolicy(
+            mode=IMAGE_DETAIL,
+            low_max_edge=IMAGE_DETAIL_LOW_MAX_EDGE,
+            min_green_fraction=IMAGE_DETAIL_MIN_GREEN_FRACTION,
+            blur_threshold=IMAGE_DETAIL_BLUR_THRESHOLD,
+            escalate=IMAGE_DETAIL_ESCALATE,
+        ),
+        limiter=app.state.upstream_limiter,
+        resilience=ResilientCaller(
+            parse_targets(OPENROUTER_MODELS, OPENROUTER_BASE_URL.rstrip("/") + "/chat/completions"),
+            max_attempts=UPSTREAM_MAX_ATTEMPTS,
+            retry_base_delay_s=UPSTREAM_RETRY_BASE_DELAY_S,
+            retry_max_delay_s=UPSTREAM_RETRY_MAX_DELAY_S,
+            hedge_percentile=UPSTREAM_HEDGE_PERCENTILE,
+            breaker_failure_threshold=UPSTREAM_BREAKER_FAILURES,
+            breaker_reset_timeout_s=UPSTREAM_BREAKER_RESET_S,
+        ),
+        streaming=UPSTREAM_STREAMING,
+        prompt_caching=PROMPT_CACHING_ENABLED,
+        triage=app.state.triage,
+    )
+    
+    app.state.history = HistoryStore(
+        HISTORY_DB_PATH,
+        batch_size=HISTORY_BATCH_SIZE,
+        flush_interval_s=HISTORY_FLUSH_INTERVAL_S,
+        max_pending=HISTORY_MAX_PENDING,
+    ) if HISTORY_ENABLED and HISTORY_DB_PATH else None
+    if app.state.history is not None:
+        await app.state.history.start()
+    
+    async def run_analysis_job(image_data: bytes, filename: str) -> Dict[str, Any]:
+        start_time = time.time()
+        analysis_result = await app.state.crop_analyzer.analyze_crop_image(image_data, filename)
+        response = build_analysis_response(analysis_result, filename, start_time).model_dump()
+        record_history(response, "job")
+        return response
+    
+    app.state.job_queue = create_job_queue(
+        JOB_QUEUE_BACKEND,
+        run_analysis_job,
+        workers=JOB_WORKERS,
+        max_queued=JOB_QUEUE_MAX_SIZE,
+        result_ttl_seconds=JOB_RESULT_TTL_S,
+        # Queued images wait in memory, so they count against the upload budget too
+        budget=upload_budget,
+    )
+    await app.state.job_queue.start()
+    
+    # Gauges are read from live state when /metrics is scraped
+    limiter = app.state.upstream_limiter
+    REGISTRY.gauge_callback(
+        "crop_analyzer_upstream_concurrency_limit", "Current adaptive upstream concurrency limit",
+        lambda: limiter.stats()["concurrency_limit"],
+    )
+    REGISTRY.gauge_callback(
+        "crop_analyzer_upstream_in_flight", "Upstream requests in flight", lambda: limiter.stats()["in_flight"]
+    )
+    REGISTRY.gauge_callback(
+        "crop_analyzer_upstream_queue_depth", "Requests waiting for an upstream slot", lambda: limiter.stats()["queue_depth"]
+    )
+    scheduler = app.state.scheduler
+    if scheduler is not None:
+        REGISTRY.gauge_callback(
+            "crop_analyzer_scheduler_queued", "Upstream calls waiting for a slot, by priority lane",
+            scheduler.queued, ["lane"],
+        )
+        REGISTRY.gauge_callback(
+            "crop_analyzer_scheduler_in_flight", "Upstream calls in flight, by priority lane",
+            scheduler.in_flight, ["lane"],
+        )
+    job_queue = app.state.job_queue
+    REGISTRY.gauge_callback(
+        "crop_analyzer_jobs", "Analysis jobs by state",
+        lambda: {(state,): job_queue.stats()[state] for state in ("queued", "running")}, ["state"],
+    )
+    lag_monitor = None
+    if EVENT_LOOP_LAG_INTERVAL_MS > 0:
+        lag_monitor = asyncio.create_task(monitor_event_loop_lag(EVENT_LOOP_LAG_INTERVAL_MS / 1000))
+    metrics_publisher = None
+    if app.state.shared_state is not None and METRICS_PUBLISH_INTERVAL_S > 0:
+        metrics_publisher = asyncio.create_task(publish_metrics(app.state.shared_state))
+    phash_sync = None
+    if (
+        app.state.phash_index is not None
+        and app.state.analysis_cache.stats()["disk_enabled"]
+        and PHASH_SYNC_INTERVAL_S > 0
+    ):
+        # Other workers (app.serve) write to the same disk tier after this index was loaded
+        phash_sync = asyncio.create_task(
+            sync_phash_index(app.state.analysis_cache, app.state.phash_index, phash_loaded_at)
+        )
+    
+    app.state.warmup = None
+    if UPSTREAM_WARMUP:
+        app.state.warmup = await warm_up(
+            app.state.http_client,
+            [target.url for target in app.state.crop_analyzer.resilience.targets],
+            connections=UPSTREAM_WARMUP_CONNECTIONS,
+            preprocess_executor=app.state.preprocess_executor,
+            preprocess_workers=PREPROCESS_WORKERS,
+        )
+        print(f"Worker {WORKER_ID} warmed up in {app.state.warmup['duration_ms']}ms")
+    try:
+        yield
+    finally:
+        if lag_monitor is not None:
+            lag_monitor.cancel()
+        if phash_sync is not None:
+            phash_sync.cancel()
+        await app.state.job_queue.stop(drain_timeout_s=JOB_DRAIN_TIMEOUT_S)
+        # Streams still being read for their usage, so their tokens are counted before the metrics snapshot
+        await app.state.crop_analyzer.wait_for_drains()
+        if app.state.history is not None:
+            # After the job queue, so results of drained jobs are written too
+            await app.state.history.stop()
+            app.state.history.close()
+        if metrics_publisher is not None:
+            metrics_publisher.cancel()
+            # Final snapshot, so the counters of this worker stay in the totals after it exits
+            await asyncio.to_thread(app.state.shared_state.publish_metrics, WORKER_ID, REGISTRY.snapshot())
+        await app.state.http_client.aclose()
+        if app.state.preprocess_executor is not None:
+            app.state.preprocess_executor.shutdown(wait=False, cancel_futures=True)
+        if app.state.triage_executor is not None:
+            app.state.triage_executor.shutdown(wait=False, cancel_futures=True)
+        if app.state.analysis_cache is not None:
+            app.state.analysis_cache.close()
+        if app.state.shared_state is not None:
+            await app.state.upstream_limiter.flush()
+            app.state.shared_state.close()
+
+app = FastAPI(title="AI Crop Disease Analyzer", lifespan=lifespan)
 
 # Get allowed origins from environment or use defaults
 allowed_origins = os.getenv("ALLOWED_ORIGINS", "").split(",") if os.getenv("ALLOWED_ORIGINS") else [
@@ -25,7 +408,38 @@ allowed_origins = os.getenv("ALLOWED_ORIGINS", "").split(",") if os.getenv("ALLO
     "http://127.0.0.1:8080",
 ]
 
-# Add CORS middleware
+# Web interface, rendered and precompressed once; served from memory with validators
+web_ui = WebAssets(
+    os.path.join(os.path.dirname(__file__), "web"),
+    context={"max_file_size_mb": MAX_FILE_SIZE_MB},
+)
+
+# Bound upload bodies while they stream in, before multipart parsing buffers them
+upload_budget = UploadBudget(UPLOAD_INFLIGHT_BUDGET_MB * 1024 * 1024)
+app.add_middleware(
+    UploadLimitMiddleware,
+    limits={
+        "/api/analyze": MAX_FILE_SIZE_BYTES + MULTIPART_OVERHEAD_BYTES,
+        "/api/analyze/stream": MAX_FILE_SIZE_BYTES + MULTIPART_OVERHEAD_BYTES,
+        "/api/analyze/batch": MAX_BATCH_SIZE_MB * 1024 * 1024,
+        "/api/jobs": MAX_FILE_SIZE_BYTES + MULTIPART_OVERHEAD_BYTES,
+    },
+    # Batch parts are spooled to disk by the multipart parser and read one item at a
+    # time, so only single-image uploads are charged against the in-memory budget
+    budgeted_paths={"/api/analyze", "/api/analyze/stream", "/api/jobs"},
+    budget=upload_budget,
+    details={
+        "/api/analyze": f"File size must be less than {MAX_FILE_SIZE_MB}MB",
+        "/api/analyze/stream": f"File size must be less than {MAX_FILE_SIZE_MB}MB",
+        "/api/analyze/batch": f"Batch size must be less than {MAX_BATCH_SIZE_MB}MB",
+        "/api/jobs": f"File size must be less than {MAX_FILE_SIZE_MB}MB",
+    },
+)
+
+# Request metrics; added after the upload limiter so its rejections are counted too
+app.add_middleware(MetricsMiddleware, server_timing=SERVER_TIMING_ENABLED)
+
+# Add CORS middleware (added last so it also wraps upload-limit rejections)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=allowed_origins,
@@ -34,10 +448,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configuration
-MAX_FILE_SIZE_MB = int(os.getenv("MAX_FILE_SIZE_MB", 10))
-MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
-
 class AnalysisResponse(BaseModel):
     disease_type: str
     severity_level: int
@@ -45,308 +455,68 @@ class AnalysisResponse(BaseModel):
     crop_type: str
     filename: str
     response_time_ms: int
+    cache_status: str = "miss"
+    preprocessing: Optional[Dict[str, Any]] = None
+    model: Optional[str] = None
+    attempts: int = 0
+    triage: Optional[Dict[str, Any]] = None
+    image_detail: Optional[Dict[str, Any]] = None
+    image_digest: Optional[str] = None
+
+def build_analysis_response(analysis_result: Dict[str, Any], filename: str, start_time: float) -> AnalysisResponse:
+    return AnalysisResponse(
+        disease_type=analysis_result["disease_type"],
+        severity_level=analysis_result["severity_level"],
+        affected_area_percentage=analysis_result["affected_area_percentage"],
+        crop_type=analysis_result["crop_type"],
+        filename=filename,
+        response_time_ms=int((time.time() - start_time) * 1000),
+        cache_status=analysis_result.get("cache_status", "miss"),
+        preprocessing=analysis_result.get("preprocessing"),
+        model=analysis_result.get("model"),
+        attempts=analysis_result.get("attempts", 0),
+        triage=analysis_result.get("triage"),
+        image_detail=analysis_result.get("image_detail"),
+        image_digest=analysis_result.get("image_digest"),
+    )
+
+def classify_request(request: Request, bulk: bool = False) -> Optional[Flow]:
+    """Scheduling lane and tenant of a request; bulk endpoints start from the lowest lane"""
+    scheduler = app.state.scheduler
+    if scheduler is None:
+        return None
+    return scheduler.classify(request, scheduler.bottom_lane if bulk else scheduler.top_lane)
+
+def record_history(response: Dict[str, Any], source: str) -> None:
+    """Hand a response to the history store's write-behind buffer (no I/O on the request path)"""
+    if app.state.history is not None:
+        app.state.history.record(response, source)
 
 @app.get("/", response_class=HTMLResponse)
-async def root():
-    html_content = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>🌾 AI Crop Disease Analyzer</title>
-        <style>
-            body {
-                font-family: Arial, sans-serif;
-                max-width: 800px;
-                margin: 0 auto;
-                padding: 20px;
-                background-color: #f8f9fa;
-            }
-            .container {
-                background: white;
-                padding: 30px;
-                border-radius: 10px;
-                box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-            }
-            .upload-area {
-                border: 2px dashed #28a745;
-                border-radius: 10px;
-                padding: 40px;
-                text-align: center;
-                margin: 20px 0;
-                background-color: #f8fff8;
-                transition: background-color 0.3s;
-            }
-            .upload-area:hover {
-                background-color: #e8f5e8;
-            }
-            .upload-area.dragover {
-                background-color: #d4edda;
-                border-color: #155724;
-            }
-            input[type="file"] {
-                margin: 10px 0;
-            }
-            button {
-                background-color: #28a745;
-                color: white;
-                padding: 12px 24px;
-                border: none;
-                border-radius: 5px;
-                cursor: pointer;
-                font-size: 16px;
-                margin: 10px 5px;
-            }
-            button:hover {
-                background-color: #218838;
-            }
-            button:disabled {
-                background-color: #6c757d;
-                cursor: not-allowed;
-            }
-            .result {
-                background-color: #f8f9fa;
-                border: 1px solid #e9ecef;
-                border-radius: 8px;
-                padding: 20px;
-                margin-top: 20px;
-            }
-            .result-grid {
-                display: grid;
-                grid-template-columns: 1fr 1fr;
-                gap: 15px;
-                margin-top: 15px;
-            }
-            .result-item {
-                background: white;
-                padding: 15px;
-                border-radius: 5px;
-                border-left: 4px solid #28a745;
-            }
-            .result-label {
-                font-weight: bold;
-                color: #495057;
-                font-size: 14px;
-                margin-bottom: 5px;
-            }
-            .result-value {
-                font-size: 18px;
-                color: #212529;
-            }
-            .severity-bar {
-                width: 100%;
-                height: 20px;
-                background-color: #e9ecef;
-                border-radius: 10px;
-                overflow: hidden;
-                margin-top: 5px;
-            }
-            .severity-fill {
-                height: 100%;
-                border-radius: 10px;
-                transition: width 0.3s ease;
-            }
-            .loading {
-                text-align: center;
-                color: #6c757d;
-            }
-            .error {
-                color: #dc3545;
-                background-color: #f8d7da;
-                border: 1px solid #f5c6cb;
-                padding: 15px;
-                border-radius: 5px;
-                margin-top: 20px;
-            }
-            .image-preview {
-                max-width: 300px;
-                max-height: 300px;
-                border-radius: 8px;
-                margin: 10px 0;
-                box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-            }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>🌾 AI Crop Disease Analyzer</h1>
-            <p>Upload a crop image to analyze for diseases, severity, and crop type identification.</p>
-            
-            <div class="upload-area" id="uploadArea">
-                <div>
-                    <h3>📸 Upload Crop Image</h3>
-                    <p>Drag and drop an image here or click to select</p>
-                    <input type="file" id="imageFile" accept="image/*" style="display: none;">
-                    <button onclick="document.getElementById('imageFile').click()">
-                        📁 Choose Image
-                    </button>
-                </div>
-                <div id="preview"></div>
-            </div>
-            
-            <button id="analyzeBtn" onclick="analyzeCrop()" disabled>
-                🔬 Analyze Crop
-            </button>
-            
-            <div id="result"></div>
-        </div>
-
-        <script>
-            const uploadArea = document.getElementById('uploadArea');
-            const imageFile = document.getElementById('imageFile');
-            const analyzeBtn = document.getElementById('analyzeBtn');
-            const resultDiv = document.getElementById('result');
-            const previewDiv = document.getElementById('preview');
-            
-            let selectedFile = null;
-            
-            // Drag and drop functionality
-            uploadArea.addEventListener('dragover', (e) => {
-                e.preventDefault();
-                uploadArea.classList.add('dragover');
-            });
-            
-            uploadArea.addEventListener('dragleave', () => {
-                uploadArea.classList.remove('dragover');
-            });
-            
-            uploadArea.addEventListener('drop', (e) => {
-                e.preventDefault();
-                uploadArea.classList.remove('dragover');
-                const files = e.dataTransfer.files;
-                if (files.length > 0) {
-                    handleFileSelect(files[0]);
-                }
-            });
-            
-            imageFile.addEventListener('change', (e) => {
-                if (e.target.files.length > 0) {
-                    handleFileSelect(e.target.files[0]);
-                }
-            });
-            
-            function handleFileSelect(file) {
-                if (!file.type.startsWith('image/')) {
-                    alert('Please select an image file');
-                    return;
-                }
-                
-                if (file.size > MAX_FILE_SIZE_PLACEHOLDER * 1024 * 1024) {
-                    alert('File size must be less than MAX_FILE_SIZE_PLACEHOLDERMB');
-                    return;
-                }
-                
-                selectedFile = file;
-                analyzeBtn.disabled = false;
-                
-                // Show image preview
-                const reader = new FileReader();
-                reader.onload = (e) => {
-                    previewDiv.innerHTML = '<img src="' + e.target.result + '" alt="Preview" class="image-preview">';
-                };
-                reader.readAsDataURL(file);
-            }
-            
-            async function analyzeCrop() {
-                if (!selectedFile) {
-                    alert('Please select an image first');
-                    return;
-                }
-                
-                analyzeBtn.disabled = true;
-                analyzeBtn.textContent = '🔄 Analyzing...';
-                resultDiv.innerHTML = '<div class="loading">🔬 Analyzing crop image for diseases...</div>';
-                
-                const formData = new FormData();
-                formData.append('file', selectedFile);
-                
-                try {
-                    const response = await fetch('/api/analyze', {
-                        method: 'POST',
-                        body: formData
-                    });
-                    
-                    if (!response.ok) {
-                        const errorData = await response.json();
-                        throw new Error(errorData.detail || 'Analysis failed');
-                    }
-                    
-                    const data = await response.json();
-                    displayResults(data);
-                } catch (error) {
-                    resultDiv.innerHTML = '<div class="error">❌ Error: ' + error.message + '</div>';
-                } finally {
-                    analyzeBtn.disabled = false;
-                    analyzeBtn.textContent = '🔬 Analyze Crop';
-                }
-            }
-            
-            function displayResults(data) {
-                const severityColor = getSeverityColor(data.severity_level);
-                const severityWidth = (data.severity_level / 10) * 100;
-                
-                const html = `
-                    <div class="result">
-                        <h3>📊 Analysis Results</h3>
-                        <div class="result-grid">
-                            <div class="result-item">
-                                <div class="result-label">🦠 Disease Type</div>
-                                <div class="result-value">${data.disease_type}</div>
-                            </div>
-                            <div class="result-item">
-                                <div class="result-label">🌱 Crop Type</div>
-                                <div class="result-value">${data.crop_type}</div>
-                            </div>
-                            <div class="result-item">
-                                <div class="result-label">⚠️ Severity Level</div>
-                                <div class="result-value">${data.severity_level}/10</div>
-                                <div class="severity-bar">
-                                    <div class="severity-fill" style="width: ${severityWidth}%; background-color: ${severityColor}"></div>
-                                </div>
-                            </div>
-                            <div class="result-item">
-                                <div class="result-label">📏 Affected Area</div>
-                                <div class="result-value">${data.affected_area_percentage}%</div>
-                            </div>
-                        </div>
-                        <p style="margin-top: 15px; color: #6c757d; font-size: 14px;">
-                            📄 File: ${data.filename} | ⏱️ Analysis time: ${data.response_time_ms}ms
-                        </p>
-                    </div>
-                `;
-                
-                resultDiv.innerHTML = html;
-            }
-            
-            function getSeverityColor(severity) {
-                if (severity <= 2) return '#28a745'; // Green - healthy/mild
-                if (severity <= 4) return '#ffc107'; // Yellow - moderate
-                if (severity <= 7) return '#fd7e14'; // Orange - concerning
-                return '#dc3545'; // Red - severe
-            }
-        </script>
-    </body>
-    </html>
-    """
-    
-    # Replace placeholder with actual value
-    html_content = html_content.replace("MAX_FILE_SIZE_PLACEHOLDER", str(MAX_FILE_SIZE_MB))
-    html_content = html_content.replace("MAX_FILE_SIZE_PLACEHOLDERMB", str(MAX_FILE_SIZE_MB) + "MB")
-    return html_content
+async def root(request: Request):
+    return web_ui.respond(web_ui.page, request)
+
+@app.get("/assets/{name}")
+async def web_asset(name: str, request: Request):
+    asset = web_ui.get(f"/assets/{name}")
+    if asset is None:
+        raise HTTPException(status_code=404, detail="Asset not found")
+    return web_ui.respond(asset, request)
 
 @app.post("/api/analyze", response_model=AnalysisResponse)
-async def analyze_crop(file: UploadFile = File(...)):
+async def analyze_crop(request: Request, file: UploadFile = File(...)):
     start_time = time.time()
     
     # Validate file
     if not file.content_type or not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
+    flow = classify_request(request)
     
-    # Read file content
-    file_content = await file.read()
-    
-    # Check file size
-    if len(file_content) > MAX_FILE_SIZE_BYTES:
-        raise HTTPException(status_code=400, detail=f"File size must be less than {MAX_FILE_SIZE_MB}MB")
+    # Read file content in chunks, stopping as soon as it passes the size limit
+    with stage("upload_read"):
+        file_content = await read_upload_limited(
+            file, MAX_FILE_SIZE_BYTES, f"File size must be less than {MAX_FILE_SIZE_MB}MB"
+        )
     
     # Get API key from environment
     openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
@@ -355,22 +525,18 @@ async def analyze_crop(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail="OpenRouter API key not configured")
     
     try:
-        # Initialize crop analyzer
-        analyzer = CropAnalyzer(openrouter_api_key)
-        
-        # Analyze the crop image
-        analysis_result = await analyzer.analyze_crop_image(file_content, file.filename)
+        # Shared crop analyzer, backed by the pooled upstream client
+        analyzer = app.state.crop_analyzer
         
-        response_time_ms = int((time.time() - start_time) * 1000)
+        # Analyze the crop image; abandoned if the client disconnects or X-Request-Deadline-Ms passes
+        with scheduling(flow):
+            analysis_result = await run_cancellable(
+                request, lambda: analyzer.analyze_crop_image(file_content, file.filename)
+            )
         
-        return AnalysisResponse(
-            disease_type=analysis_result["disease_type"],
-            severity_level=analysis_result["severity_level"],
-            affected_area_percentage=analysis_result["affected_area_percentage"],
-            crop_type=analysis_result["crop_type"],
-            filename=file.filename,
-            response_time_ms=response_time_ms
-        )
+        response = build_analysis_response(analysis_result, file.filename, start_time)
+        record_history(response.model_dump(), "analyze")
+        return response
         
     except HTTPException:
         raise
@@ -378,6 +544,276 @@ async def analyze_crop(file: UploadFile = File(...)):
         response_time_ms = int((time.time() - start_time) * 1000)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/analyze/stream")
+async def analyze_crop_stream(request: Request, file: UploadFile = File(...)):
+    """
+    Analyze an image and stream Server-Sent Events: a `field` event for each analysis
+    field as soon as the model has produced it, then a `result` event with the full
+    response, or an `error` event.
+    """
+    start_time = time.time()
+    
+    if not file.content_type or not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="File must be an image")
+    flow = classify_request(request)
+    
+    with stage("upload_read"):
+        file_content = await read_upload_limited(
+            file, MAX_FILE_SIZE_BYTES, f"File size must be less than {MAX_FILE_SIZE_MB}MB"
+        )
+    
+    if not os.getenv("OPENROUTER_API_KEY"):
+        raise HTTPException(status_code=500, detail="OpenRouter API key not configured")
+    
+    events: asyncio.Queue = asyncio.Queue()
+    
+    def on_field(field: str, value: str) -> None:
+        events.put_nowait(("field", {"field": field, "value": value}))
+    
+    async def run_analysis() -> None:
+        try:
+            # Disconnects end the event stream, which cancels this task; only the deadline is watched here
+            with scheduling(flow):
+                analysis_result = await run_cancellable(
+                    request,
+                    lambda: app.state.crop_analyzer.analyze_crop_image(file_content, file.filename, on_field=on_field),
+                    watch_disconnect=False,
+                )
+            response = build_analysis_response(analysis_result, file.filename, start_time).model_dump()
+            record_history(response, "stream")
+            events.put_nowait(("result", response))
+        except HTTPException as e:
+            events.put_nowait(("error", {"status_code": e.status_code, "detail": e.detail}))
+        except Exception as e:
+            events.put_nowait(("error", {"status_code": 500, "detail": str(e)}))
+    
+    async def event_stream():
+        task = asyncio.create_task(run_analysis())
+        try:
+            while True:
+                event, data = await events.get()
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                if event != "field":
+                    return
+        finally:
+            # The browser went away: stop the analysis (shared work continues for other waiters)
+            task.cancel()
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/api/analyze/batch")
+async def analyze_crop_batch(request: Request, files: List[UploadFile] = File(...)):
+    """
+    Analyze many images, uploaded as files and/or zip archives.
+    Results are streamed as NDJSON in completion order, one line per image,
+    followed by a summary line. Failed images are reported inline.
+    """
+    if not os.getenv("OPENROUTER_API_KEY"):
+        raise HTTPException(status_code=500, detail="OpenRouter API key not configured")
+    flow = classify_request(request, bulk=True)
+    
+    # Items are read while the response streams, after this handler has returned
+    files = detach_uploads(files)
+    try:
+        items = expand_batch_uploads(files, MAX_FILE_SIZE_BYTES, f"File size must be less than {MAX_FILE_SIZE_MB}MB")
+        if not items:
+            raise HTTPException(status_code=400, detail="No images found in upload")
+    except BaseException:
+        await close_uploads(files)
+        raise
+    
+    analyzer = app.state.crop_analyzer
+    
+    async def process(group: List[BatchItem]) -> List[Any]:
+        start_time = time.time()
+        outcomes: List[Any] = [None] * len(group)
+        images = []
+        positions = []
+        for position, item in enumerate(group):
+            try:
+                if not item.content_type.startswith('image/'):
+                    raise HTTPException(status_code=400, detail="File must be an image")
+                images.append((await item.read(), item.filename))
+                positions.append(position)
+            except Exception as e:
+                outcomes[position] = e
+        
+        if images:
+            with scheduling(flow):
+                if BATCH_PACK_SIZE > 1:
+                    results = await analyzer.analyze_crop_images(images, pack_size=BATCH_PACK_SIZE)
+                else:
+                    try:
+                        results = [await analyzer.analyze_crop_image(*images[0])]
+                    except Exception as e:
+                        results = [e]
+            for position, result in zip(positions, results):
+                outcomes[position] = result
+        
+        for position, result in enumerate(outcomes):
+            if isinstance(result, dict):
+                response = build_analysis_response(result, group[position].filename, start_time).model_dump()
+                # Per-image share of upstream tokens; absent for cache hits
+                response["usage"] = result.get("usage")
+                record_history(response, "batch")
+                outcomes[position] = response
+        return outcomes
+    
+    async def stream_results():
+        batch_start = time.time()
+        succeeded = failed = 0
+        totals = {
+            "prompt_tokens": 0.0, "completion_tokens": 0.0, "cached_tokens": 0.0, "upstream_calls": 0.0, "analyzed": 0
+        }
+        try:
+            async for outcome in run_batch(items, process, BATCH_CONCURRENCY, group_size=BATCH_PACK_SIZE):
+                if "error" in outcome:
+                    failed += 1
+                else:
+                    succeeded += 1
+                    usage = outcome["result"].get("usage")
+                    if usage:
+                        totals["analyzed"] += 1
+                        for key in ("prompt_tokens", "completion_tokens", "cached_tokens", "upstream_calls"):
+                            totals[key] += usage.get(key, 0)
+                yield json.dumps(outcome) + "\n"
+        finally:
+            await close_uploads(files)
+        elapsed_s = time.time() - batch_start
+        analyzed = totals["analyzed"]
+        yield json.dumps({"summary": {
+            "total": len(items),
+            "succeeded": succeeded,
+            "failed": failed,
+            "elapsed_ms": int(elapsed_s * 1000),
+            "mode": "packed" if BATCH_PACK_SIZE > 1 else "single",
+            "pack_size": BATCH_PACK_SIZE,
+            # Images answered by the model (not cache), and their share of upstream cost
+            "analyzed_upstream": analyzed,
+            "upstream_calls": round(totals["upstream_calls"]),
+            "tokens_per_image": round((totals["prompt_tokens"] + totals["completion_tokens"]) / analyzed, 1) if analyzed else None,
+            "cached_tokens": round(totals["cached_tokens"]),
+            "images_per_second": round(succeeded / elapsed_s, 2) if elapsed_s > 0 else None,
+        }}) + "\n"
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+@app.post("/api/jobs", status_code=202)
+async def submit_job(request: Request, file: UploadFile = File(...)):
+    """
+    Queue an image for analysis and return a job id immediately.
+    Poll GET /api/jobs/{job_id} or subscribe to GET /api/jobs/{job_id}/events.
+    """
+    if not file.content_type or not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="File must be an image")
+    flow = classify_request(request, bulk=True)
+    
+    with stage("upload_read"):
+        file_content = await read_upload_limited(
+            file, MAX_FILE_SIZE_BYTES, f"File size must be less than {MAX_FILE_SIZE_MB}MB"
+        )
+    
+    if not os.getenv("OPENROUTER_API_KEY"):
+        raise HTTPException(status_code=500, detail="OpenRouter API key not configured")
+    
+    try:
+        # The job runs in the submission's context, so it keeps this request's lane and tenant
+        with scheduling(flow):
+            job = await app.state.job_queue.submit(file_content, file.filename)
+    except JobQueueFull as e:
+        raise HTTPException(
+            status_code=429,
+            detail="Analysis queue is full, please retry later",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/api/jobs/{job.id}",
+        "events_url": f"/api/jobs/{job.id}/events",
+    }
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = app.state.job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-Sent Events stream of job status changes, ending when the job finishes"""
+    if app.state.job_queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def event_stream():
+        async for job in app.state.job_queue.subscribe(job_id):
+            yield f"event: {job.status}\ndata: {json.dumps(job.to_dict())}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def require_history() -> HistoryStore:
+    if app.state.history is None:
+        raise HTTPException(status_code=404, detail="Analysis history is disabled")
+    return app.state.history
+
+@app.get("/api/history")
+async def analysis_history(
+    disease_type: Optional[str] = None,
+    crop_type: Optional[str] = None,
+    image_digest: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    limit: int = Query(100, ge=1, le=1000),
+):
+    """
+    Stored analyses, newest first, filtered by disease, crop, image digest and/or time
+    (unix seconds). For the next page pass the last record's recorded_at as `until`.
+    """
+    history = require_history()
+    records = await asyncio.to_thread(
+        history.query, disease_type, crop_type, image_digest, since, until, limit
+    )
+    return {"records": records, "next_until": records[-1]["recorded_at"] if len(records) == limit else None}
+
+@app.get("/api/history/daily")
+async def analysis_history_daily(
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    group_by: str = "disease_crop",
+    disease_type: Optional[str] = None,
+    crop_type: Optional[str] = None,
+):
+    """Analyses per UTC day by disease, crop or both (default: the last 30 days), from the rollups"""
+    history = require_history()
+    if group_by not in ROLLUP_GROUPS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {', '.join(ROLLUP_GROUPS)}")
+    since_day, until_day = parse_day(since, 30), parse_day(until, 0)
+    rows = await asyncio.to_thread(history.daily_counts, since_day, until_day, group_by, disease_type, crop_type)
+    return {"since": since_day, "until": until_day, "group_by": group_by, "days": rows}
+
+@app.get("/api/history/severity")
+async def analysis_history_severity(
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    disease_type: Optional[str] = None,
+    crop_type: Optional[str] = None,
+):
+    """Severity histogram (analyses per level 1-10) over a range of UTC days, from the rollups"""
+    history = require_history()
+    since_day, until_day = parse_day(since, 30), parse_day(until, 0)
+    histogram = await asyncio.to_thread(history.severity_histogram, since_day, until_day, disease_type, crop_type)
+    return {"since": since_day, "until": until_day, "histogram": histogram}
+
 @app.get("/api/health")
 async def health_check():
     """Health check endpoint"""
@@ -385,9 +821,40 @@ async def health_check():
         "status": "healthy",
         "message": "AI Crop Disease Analyzer API is running",
         "openrouter_configured": os.getenv("OPENROUTER_API_KEY") is not None,
-        "max_file_size_mb": MAX_FILE_SIZE_MB
+        "max_file_size_mb": MAX_FILE_SIZE_MB,
+        "worker": WORKER_ID,
+        "shared_state": app.state.shared_state.path if app.state.shared_state is not None else None,
+        "warmup": app.state.warmup,
+        "upload_budget": upload_budget.stats(),
+        "web_ui": web_ui.stats(),
+        "upstream_pool": get_pool_stats(app.state.http_client),
+        "upstream_limiter": app.state.upstream_limiter.stats(),
+        "scheduler": app.state.scheduler.stats() if app.state.scheduler is not None else None,
+        "upstream_resilience": app.state.crop_analyzer.resilience.stats(),
+        "upstream_usage": app.state.crop_analyzer.usage_stats(),
+        "image_detail": app.state.crop_analyzer.detail_stats(),
+        "single_flight": app.state.crop_analyzer.single_flight.stats(),
+        "jobs": app.state.job_queue.stats(),
+        "history": app.state.history.stats() if app.state.history is not None else None,
+        "cache": app.state.analysis_cache.stats() if app.state.analysis_cache is not None else None,
+        "triage": app.state.triage.stats() if app.state.triage is not None else None,
+        "near_duplicates": {
+            "indexed_hashes": len(app.state.phash_index),
+            "max_distance": app.state.phash_index.max_distance,
+            "hits": app.state.crop_analyzer.near_duplicate_hits,
+        } if app.state.phash_index is not None else None
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: stage latency histograms, request and error counters, queue gauges"""
+    others = []
+    if app.state.shared_state is not None:
+        # Totals across all worker processes, whichever one answers the scrape
+        others = await asyncio.to_thread(app.state.shared_state.metric_snapshots, WORKER_ID)
+    return Response(REGISTRY.render(others), media_type=CONTENT_TYPE)
+
+# Development server; for production run `python -m app.serve` (multiple workers, graceful drain)
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 5000))
@@ -0,0 +1,60 @@
+"""
+Production entry point: several uvicorn worker processes behind one port.
+
+    python -m app.serve
+
+Workers share the upstream rate-limit buckets, the Retry-After pause and their
+metrics through a SQLite file (SHARED_STATE_PATH), and the analysis cache through
+its disk tier (CACHE_DB_PATH); each worker adds the perceptual hashes the others
+cached to its near-duplicate index every PHASH_SYNC_INTERVAL_S. uvloop and httptools are used when installed. On
+SIGTERM each worker stops accepting connections, lets in-flight requests finish
+for up to GRACEFUL_TIMEOUT_S and drains its job queue (JOB_DRAIN_TIMEOUT_S).
+"""
+
+import importlib.util
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WORKERS = int(os.getenv("WORKERS", os.cpu_count() or 1))
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", 5000))
+GRACEFUL_TIMEOUT_S = float(os.getenv("GRACEFUL_TIMEOUT_S", 30))
+
+
+def main():
+    import uvicorn
+
+    from app.services.shared_state import SharedState
+
+    if WORKERS > 1:
+        # Set before the workers start, so every one of them opens the same file
+        path = os.environ.setdefault("SHARED_STATE_PATH", "shared_state.sqlite3")
+        if path:
+            shared_state = SharedState(path)
+            shared_state.reset()
+            shared_state.close()
+        if os.getenv("JOB_QUEUE_BACKEND", "memory") == "memory":
+            print("JOB_QUEUE_BACKEND=memory keeps jobs per worker; poll with sticky sessions or use one worker")
+
+    has_uvloop = importlib.util.find_spec("uvloop") is not None
+    has_httptools = importlib.util.find_spec("httptools") is not None
+    print(
+        f"Starting {WORKERS} worker(s) on {HOST}:{PORT} "
+        f"(loop={'uvloop' if has_uvloop else 'asyncio'}, http={'httptools' if has_httptools else 'h11'})"
+    )
+    uvicorn.run(
+        "app.main:app",
+        host=HOST,
+        port=PORT,
+        workers=WORKERS,
+        loop="uvloop" if has_uvloop else "asyncio",
+        http="httptools" if has_httptools else "h11",
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT_S,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import asyncio
+import io
+import mimetypes
+import zipfile
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Any, List, Union, AsyncIterator
+
+from fastapi import HTTPException, UploadFile
+
+from app.services.upload_limits import read_upload_limited
+
+ZIP_CONTENT_TYPES = ("application/zip", "application/x-zip-compressed")
+
+
+@dataclass
+class BatchItem:
+    """One image of a batch; its bytes are only read when the item is processed"""
+    index: int
+    filename: str
+    content_type: str
+    read: Callable[[], Awaitable[bytes]]
+
+
+def detach_uploads(files: List[UploadFile]) -> List[UploadFile]:
+    """
+    Take over the spooled files behind the uploads, so they can still be read from a
+    streaming response after the endpoint has returned. Before FastAPI 0.118 the
+    framework closes a request's uploads at that point; it now closes empty stand-ins,
+    and the caller closes the returned uploads (see close_uploads).
+    """
+    detached = []
+    for file in files:
+        detached.append(UploadFile(file.file, size=file.size, filename=file.filename, headers=file.headers))
+        file.file = io.BytesIO()
+    return detached
+
+
+async def close_uploads(files: List[UploadFile]) -> None:
+    for file in files:
+        await file.close()
+
+
+def is_zip_upload(file: UploadFile) -> bool:
+    return file.content_type in ZIP_CONTENT_TYPES or (file.filename or "").lower().endswith(".zip")
+
+
+def expand_batch_uploads(files: List[UploadFile], max_file_bytes: int, size_detail: str) -> List[BatchItem]:
+    """
+    Flatten uploaded files and zip archives into batch items.
+    Zip members are read lazily from the spooled archive, and their declared size is
+    checked up front so an oversized member is never decompressed.
+    """
+
+    items = []
+    for file in files:
+        if not is_zip_upload(file):
+            items.append(BatchItem(
+                index=len(items),
+                filename=file.filename or f"image-{len(items)}",
+                content_type=file.content_type or "",
+                read=lambda file=file: read_upload_limited(file, max_file_bytes, size_detail),
+            ))
+            continue
+
+        try:
+            archive = zipfile.ZipFile(file.file)
+        except zipfile.BadZipFile:
+            raise HTTPException(status_code=400, detail=f"{file.filename} is not a valid zip archive")
+
+        for info in archive.infolist():
+            if info.is_dir() or info.filename.startswith("__MACOSX/"):
+                continue
+            content_type = mimetypes.guess_type(info.filename)[0] or ""
+            items.append(BatchItem(
+                index=len(items),
+                filename=info.filename,
+                content_type=content_type,
+                read=lambda archive=archive, info=info: _read_zip_member(archive, info, max_file_bytes, size_detail),
+            ))
+    return items
+
+
+async def _read_zip_member(archive: zipfile.ZipFile, info: zipfile.ZipInfo, max_bytes: int, detail: str) -> bytes:
+    if info.file_size > max_bytes:
+        raise HTTPException(status_code=400, detail=detail)
+
+    def read() -> bytes:
+        with archive.open(info) as member:
+            return member.read(max_bytes + 1)
+
+    content = await asyncio.to_thread(read)
+    if len(content) > max_bytes:
+        raise HTTPException(status_code=400, detail=detail)
+    return content
+
+
+async def run_batch(
+    items: List[BatchItem],
+    process: Callable[[List[BatchItem]], Awaitable[List[Union[Dict[str, Any], Exception]]]],
+    concurrency: int,
+    group_size: int = 1,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Process items in groups of `group_size` with at most `concurrency` groups in
+    flight, and yield each item's outcome as soon as its group finishes. `process`
+    returns one result or exception per item; a failing item yields an error
+    record instead of aborting the batch.
+    """
+
+    semaphore = asyncio.Semaphore(concurrency)
+    group_size = max(1, group_size)
+
+    async def run_group(group: List[BatchItem]) -> List[Dict[str, Any]]:
+        async with semaphore:
+            try:
+                results = await process(group)
+            except Exception as e:
+                results = [e] * len(group)
+        return [_outcome(item, result) for item, result in zip(group, results)]
+
+    tasks = [
+        asyncio.create_task(run_group(items[start:start + group_size]))
+        for start in range(0, len(items), group_size)
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            for outcome in await next_done:
+                yield outcome
+    finally:
+        # The client went away mid-stream: stop the remaining work
+        for task in tasks:
+            task.cancel()
+
+
+def _outcome(item: BatchItem, result: Union[Dict[str, Any], Exception]) -> Dict[str, Any]:
+    if isinstance(result, HTTPException):
+        error = {"status_code": result.status_code, "detail": result.detail}
+    elif isinstance(result, Exception):
+        error = {"status_code": 500, "detail": str(result)}
+    else:
+        return {"index": item.index, "filename": item.filename, "result": result}
+    return {"index": item.index, "filename": item.filename, "error": error}
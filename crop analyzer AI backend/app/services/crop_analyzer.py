@@ -1,51 +1,59 @@
 import httpx
-import base64
+import asyncio
 import json
 import re
-from typing import Dict, Any, Optional
+import time
+from concurrent.futures import Executor
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional, Set, Tuple, Union, AsyncIterator, Callable
 from fastapi import HTTPException
 
-class CropAnalyzer:
-    def __init__(self, openrouter_api_key: str):
-        self.api_key = openrouter_api_key
-        self.base_url = "https://openrouter.ai/api/v1/chat/completions"
-        
-    async def analyze_crop_image(self, image_data: bytes, filename: str) -> Dict[str, Any]:
-        """
-        Analyze crop image for disease detection using OpenRouter AI
-        Returns dict with disease_type, severity_level, affected_area_percentage, crop_type
-        """
-        
-        if not self.api_key or self.api_key == "":
-            raise HTTPException(status_code=500, detail="OpenRouter API key not configured")
-        
-        try:
-            # Convert image to base64
-            base64_image = base64.b64encode(image_data).decode('utf-8')
-            
-            # Analyze with AI
-            return await self._analyze_with_ai(base64_image, filename)
-            
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error analyzing crop image: {str(e)}")
-    
-    async def _analyze_with_ai(self, base64_image: str, filename: str) -> Dict[str, Any]:
-        """Use OpenRouter AI for crop disease analysis"""
-        
-        system_prompt = """You are an expert agricultural pathologist specializing in crop disease detection and analysis.
+from app.services.image_detail import DetailPolicy
+from app.services.image_preprocessor import detect_mime_type, preprocess_image
+from app.services.metrics import (
+    DETAIL_ESCALATIONS,
+    DETAIL_PROMPT_TOKENS,
+    DETAIL_UPSTREAM_SECONDS,
+    PARSE_FAILURES,
+    UPSTREAM_ERRORS,
+    UPSTREAM_TOKENS,
+    record_stage,
+    stage,
+    timed,
+)
+from app.services.perceptual_hash import HammingIndex, image_signature
+from app.services.request_body import ImageData, StreamedJSONBody
+from app.services.request_context import check_deadline
+from app.services.request_templates import RequestTemplate, compile_template, prompt_version
+from app.services.rate_limiter import UpstreamLimiter, parse_retry_after
+from app.services.resilience import ResilientCaller, UpstreamError, UpstreamTarget, request_sent
+from app.services.result_cache import AnalysisCache
+from app.services.singleflight import SingleFlight
+from app.services.triage import Triage
+from app.services.xml_stream import ANALYSIS_FIELDS, IncrementalXMLParser, parse_fields
 
-Your task is to analyze crop images and provide detailed disease assessment information in XML format.
+# Called with (field, raw value) as each analysis field arrives from a streamed answer
+FieldCallback = Callable[[str, str], None]
 
-Analyze the uploaded crop image and return your findings in this exact XML structure:
+DEFAULT_MODEL = "openai/gpt-4o-mini"
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 
-<analysis>
-    <disease_type>disease_name_or_healthy</disease_type>
-    <severity_level>1-10</severity_level>
-    <affected_area_percentage>0-100</affected_area_percentage>
-    <crop_type>crop_name</crop_type>
-</analysis>
+# Bump whenever result parsing changes; prompt text changes are picked up by PROMPT_VERSION's hash
+PROMPT_REVISION = "1"
 
-Guidelines:
+ANALYSIS_FAILED = "Analysis Failed"
+
+# Label for calls sent without a detail hint (the provider's default)
+DEFAULT_DETAIL = "default"
+
+# Longest a stream whose answer is already complete is read on for its usage before the connection is dropped
+STREAM_DRAIN_TIMEOUT_S = 30
+
+# Rough prompt cost of one image plus instructions, charged against the tokens-per-minute
+# bucket before a call and corrected with the real usage afterwards
+ESTIMATED_TOKENS_PER_IMAGE = 1000
+
+ANALYSIS_GUIDELINES = """Guidelines:
 
 1. **Disease Type**: Identify the specific disease (e.g., "Late Blight", "Powdery Mildew", "Rust", "Bacterial Spot", "Mosaic Virus") or "Healthy" if no disease is detected. Be specific with disease names.
 
@@ -66,80 +74,920 @@ Focus on:
 - Fungal growth, mold, or unusual textures
 - Deformed growth patterns
 - Insect damage vs disease symptoms
-- Overall plant health indicators
+- Overall plant health indicators"""
+
+SYSTEM_PROMPT = f"""You are an expert agricultural pathologist specializing in crop disease detection and analysis.
+
+Your task is to analyze crop images and provide detailed disease assessment information in XML format.
+
+Analyze the uploaded crop image and return your findings in this exact XML structure:
+
+<analysis>
+    <confidence>high|medium|low</confidence>
+    <disease_type>disease_name_or_healthy</disease_type>
+    <severity_level>1-10</severity_level>
+    <affected_area_percentage>0-100</affected_area_percentage>
+    <crop_type>crop_name</crop_type>
+</analysis>
+
+Confidence: how sure you are of the disease and crop identification. Use "low" when the image is too small, blurry or unclear to judge.
+
+{ANALYSIS_GUIDELINES}
 
 Return ONLY the XML structure, no additional text or explanations."""
 
-        user_prompt = f"Please analyze this crop image for disease detection. Filename: {filename}"
-        
+# Several images in one completion, so the long instructions are paid for once per call
+PACKED_SYSTEM_PROMPT = f"""You are an expert agricultural pathologist specializing in crop disease detection and analysis.
+
+Your task is to analyze crop images and provide detailed disease assessment information in XML format.
+
+You will receive several crop images in one message. Each image is preceded by a text label "Image N", where N is its index starting at 0. Analyze every image independently and return one analysis block per image, using the image's index, in this exact XML structure:
+
+<analyses>
+    <analysis index="0">
+        <disease_type>disease_name_or_healthy</disease_type>
+        <severity_level>1-10</severity_level>
+        <affected_area_percentage>0-100</affected_area_percentage>
+        <crop_type>crop_name</crop_type>
+    </analysis>
+    <analysis index="1">
+        ...
+    </analysis>
+</analyses>
+
+{ANALYSIS_GUIDELINES}
+
+Return ONLY the XML structure with exactly one <analysis> block per image, no additional text or explanations."""
+
+# Scopes cached results, so they are invalidated whenever either prompt changes
+PROMPT_VERSION = prompt_version(PROMPT_REVISION, SYSTEM_PROMPT, PACKED_SYSTEM_PROMPT)
+
+SYSTEM_PROMPTS = {"single": SYSTEM_PROMPT, "packed": PACKED_SYSTEM_PROMPT}
+
+def _cached_tokens(usage: Dict[str, Any]) -> int:
+    """Prompt tokens the provider served from its prompt cache"""
+    return (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+class CropAnalyzer:
+    def __init__(
+        self,
+        openrouter_api_key: str,
+        http_client: Optional[httpx.AsyncClient] = None,
+        cache: Optional[AnalysisCache] = None,
+        phash_index: Optional[HammingIndex] = None,
+        preprocess_executor: Optional[Executor] = None,
+        preprocess_enabled: bool = True,
+        max_image_edge: int = 1024,
+        jpeg_quality: int = 85,
+        limiter: Optional[UpstreamLimiter] = None,
+        resilience: Optional[ResilientCaller] = None,
+        streaming: bool = True,
+        triage: Optional[Triage] = None,
+        prompt_caching: bool = True,
+        detail_policy: Optional[DetailPolicy] = None,
+    ):
+        self.api_key = openrouter_api_key
+        # Ordered models with retries, hedging and failover; by default one model, one attempt
+        self.resilience = resilience or ResilientCaller(
+            [UpstreamTarget(DEFAULT_MODEL, OPENROUTER_URL)], max_attempts=1, hedge_percentile=0
+        )
+        # The primary model scopes cache keys; fallback answers are cached under it too
+        self.base_url = self.resilience.targets[0].url
+        self.model = self.resilience.targets[0].model
+        # Shared, app-lifetime client; when absent a short-lived one is opened per call
+        self.http_client = http_client
+        self.cache = cache
+        # Near-duplicate lookup; results themselves live in the cache
+        self.phash_index = phash_index if cache is not None else None
+        self.near_duplicate_hits = 0
+        # Image preprocessing runs off the event loop; None uses the default thread pool
+        self.preprocess_executor = preprocess_executor
+        self.preprocess_enabled = preprocess_enabled
+        self.max_image_edge = max_image_edge
+        self.jpeg_quality = jpeg_quality
+        # Per-image detail level (low/high) chosen from local signals during preprocessing
+        self.detail_policy = detail_policy
+        self.detail_calls = {
+            level: {"calls": 0, "prompt_tokens": 0, "latency_s": 0.0} for level in ("low", "high", DEFAULT_DETAIL)
+        }
+        self.detail_escalations: Dict[str, int] = {}
+        # Local classifier answering obvious cases before the vision model
+        self.triage = triage
+        # Stream single-image completions and answer once every field has arrived
+        self.streaming = streaming
+        # Streams read to the end in the background after their answer was returned
+        self._drains: Set["asyncio.Task[Dict[str, Any]]"] = set()
+        self.stream_drains = {"drained": 0, "abandoned": 0}
+        # Rate and concurrency limits shared by every upstream call
+        self.limiter = limiter
+        # Identical concurrent uploads share one upstream analysis
+        self.single_flight = SingleFlight()
+        self.usage_by_mode = {
+            mode: {"calls": 0, "images": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+            for mode in ("single", "packed")
+        }
+        # Static part of every request, serialised once per model and mode; the system
+        # prompt is marked for provider prompt caching where the model supports it
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
             "HTTP-Referer": "http://localhost:3000",
             "X-Title": "AI Crop Disease Analyzer"
         }
+        self.templates: Dict[Tuple[str, str], RequestTemplate] = {
+            (target.model, mode): compile_template(
+                target, SYSTEM_PROMPTS[mode], headers,
+                # Packed answers are parsed as a whole, so only single-image calls stream
+                stream=streaming and mode == "single",
+                prompt_caching=prompt_caching,
+            )
+            for target in self.resilience.targets
+            for mode in SYSTEM_PROMPTS
+        }
+
+    @asynccontextmanager
+    async def _client(self) -> AsyncIterator[httpx.AsyncClient]:
+        """Yield the shared upstream client, or a temporary one if none was injected"""
+        if self.http_client is not None:
+            yield self.http_client
+            return
+        async with httpx.AsyncClient(timeout=30.0) as client:
+            yield client
         
-        data = {
-            "model": "openai/gpt-4o-mini",
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {
-                    "role": "user", 
-                    "content": [
-                        {"type": "text", "text": user_prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            "temperature": 0.1,
-            "max_tokens": 300
+    async def analyze_crop_image(
+        self, image_data: bytes, filename: str, on_field: Optional[FieldCallback] = None
+    ) -> Dict[str, Any]:
+        """
+        Analyze crop image for disease detection using OpenRouter AI
+        Returns dict with disease_type, severity_level, affected_area_percentage, crop_type,
+        the model that produced it, the image's sha256 (image_digest) and cache_status
+        ("hit", "near_hit", "coalesced" or "miss"),
+        plus preprocessing stats, upstream token usage and attempts on a miss.
+        on_field, if given, receives each field as soon as the streamed answer contains it
+        (only when this call runs the upstream analysis itself).
+        """
+        
+        self._require_api_key()
+        
+        cache_key, cached = await self._lookup_cached(image_data)
+        if cached is not None:
+            cached["image_digest"] = AnalysisCache.image_digest(cache_key)
+            return cached
+        
+        result, shared = await self.single_flight.do(
+            cache_key, lambda: self._analyze_uncached(image_data, filename, cache_key, on_field)
+        )
+        # Every caller gets its own copy; followers are marked so they can see no upstream call was made
+        result = dict(result, image_digest=AnalysisCache.image_digest(cache_key))
+        if shared:
+            result["cache_status"] = "coalesced"
+            result["usage"] = None
+            result["attempts"] = 0
+        return result
+    
+    async def _analyze_uncached(
+        self, image_data: bytes, filename: str, cache_key: str, on_field: Optional[FieldCallback] = None
+    ) -> Dict[str, Any]:
+        """Preprocess, near-duplicate lookup, local triage and upstream analysis of a cache miss"""
+        
+        prepared = await self._prepare_image(image_data)
+        near_duplicate = await self._lookup_prepared(prepared)
+        if near_duplicate is not None:
+            return near_duplicate
+        
+        local_result, triage_info = await self._triage(prepared)
+        if local_result is not None:
+            return local_result
+        
+        upstream_start = time.perf_counter()
+        try:
+            # Analyze with AI; the image is base64-encoded while the request body streams out
+            result, usage = await self._analyze_with_detail(image_data, prepared, filename, on_field)
+            
+        except HTTPException:
+            # Keep upstream status codes (e.g. 503 with Retry-After when rate limited)
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error analyzing crop image: {str(e)}")
+        
+        result = await self._finish(cache_key, prepared, result, usage)
+        if triage_info is not None:
+            self.triage.record_escalation_ms((time.perf_counter() - upstream_start) * 1000)
+            result["triage"] = triage_info
+        return result
+    
+    async def analyze_crop_images(
+        self, images: List[Tuple[bytes, str]], pack_size: int = 4
+    ) -> List[Union[Dict[str, Any], Exception]]:
+        """
+        Analyze several images, packing up to pack_size cache misses into one
+        completion so the system prompt is sent once per pack instead of once per
+        image. Images whose block is missing or unparseable in the packed answer are
+        retried with a single-image call. Returns one result or exception per input.
+        """
+        
+        self._require_api_key()
+        
+        outcomes: List[Union[Dict[str, Any], Exception, None]] = [None] * len(images)
+        cache_keys: List[str] = [""] * len(images)
+        to_prepare = []
+        for i, (image_data, _filename) in enumerate(images):
+            cache_keys[i], cached = await self._lookup_cached(image_data)
+            if cached is not None:
+                outcomes[i] = cached
+            else:
+                to_prepare.append(i)
+        
+        prepared_list = await asyncio.gather(
+            # Packed calls send full-detail images; detail selection is for single-image calls
+            *(self._prepare_image(images[i][0], choose_detail=False) for i in to_prepare), return_exceptions=True
+        )
+        pending = []
+        prepared_by_index = {}
+        for i, prepared in zip(to_prepare, prepared_list):
+            if isinstance(prepared, Exception):
+                outcomes[i] = prepared
+                continue
+            near_duplicate = await self._lookup_prepared(prepared)
+            if near_duplicate is not None:
+                outcomes[i] = near_duplicate
+                continue
+            prepared_by_index[i] = prepared
+            pending.append(i)
+        
+        # Triage all misses together, so the local model sees them as one batch
+        triage_infos: Dict[int, Dict[str, Any]] = {}
+        if self.triage is not None and pending:
+            triaged = await asyncio.gather(*(self._triage(prepared_by_index[i]) for i in pending))
+            escalated = []
+            for i, (local_result, triage_info) in zip(pending, triaged):
+                if local_result is not None:
+                    outcomes[i] = local_result
+                else:
+                    triage_infos[i] = triage_info
+                    escalated.append(i)
+            pending = escalated
+        
+        for start in range(0, len(pending), max(1, pack_size)):
+            group = pending[start:start + max(1, pack_size)]
+            group_results: List[Optional[Dict[str, Any]]] = [None] * len(group)
+            usage: Dict[str, Any] = {}
+            if len(group) > 1:
+                try:
+                    group_results, usage = await self._analyze_packed_with_ai([
+                        (prepared_by_index[i]["data"],
+                         images[i][1],
+                         prepared_by_index[i]["mime_type"])
+                        for i in group
+                    ])
+                except HTTPException as e:
+                    print(f"Packed analysis of {len(group)} images failed, falling back to single calls: {e.detail}")
+            
+            # Split the shared call's usage evenly across the images it answered
+            shared_usage = self._split_usage(usage, len(group))
+            for i, result in zip(group, group_results):
+                prepared = prepared_by_index[i]
+                if result is not None:
+                    outcomes[i] = await self._finish(cache_keys[i], prepared, result, shared_usage)
+                    continue
+                try:
+                    result, single_usage = await self._analyze_with_ai(
+                        prepared["data"], images[i][1], prepared["mime_type"], wait_for_usage=True
+                    )
+                    outcomes[i] = await self._finish(
+                        cache_keys[i], prepared, result, self._add_usage(shared_usage, single_usage)
+                    )
+                except Exception as e:
+                    outcomes[i] = e
+        
+        for i, triage_info in triage_infos.items():
+            if isinstance(outcomes[i], dict):
+                outcomes[i]["triage"] = triage_info
+        for i, outcome in enumerate(outcomes):
+            if isinstance(outcome, dict):
+                outcome["image_digest"] = AnalysisCache.image_digest(cache_keys[i])
+        
+        return outcomes
+    
+    def _require_api_key(self) -> None:
+        if not self.api_key or self.api_key == "":
+            raise HTTPException(status_code=500, detail="OpenRouter API key not configured")
+    
+    @timed("cache_lookup")
+    async def _lookup_cached(self, image_data: bytes) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Exact-bytes cache lookup; returns (cache_key, result or None).
+        The key is computed even without a cache, as it also identifies in-flight work.
+        """
+        cache_key = AnalysisCache.make_key(image_data, self.model, PROMPT_VERSION)
+        if self.cache is None:
+            return cache_key, None
+        cached = await self.cache.get(cache_key)
+        if cached is None:
+            return cache_key, None
+        result, _tier = cached
+        result["cache_status"] = "hit"
+        return cache_key, result
+    
+    @timed("near_duplicate")
+    async def _lookup_prepared(self, prepared: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Near-duplicate lookup by the perceptual hash of a prepared image"""
+        if self.phash_index is None or prepared["phash"] is None:
+            return None
+        result = await self._lookup_near_duplicate(prepared["phash"], prepared["color"])
+        if result is not None:
+            result["cache_status"] = "near_hit"
+        return result
+    
+    @timed("triage")
+    async def _triage(self, prepared: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """
+        Classify a prepared image locally. Returns (result, triage metadata): the result
+        is set when the local model is confident enough to answer without the vision model.
+        Local answers are not cached, so disabling triage never serves them later.
+        """
+        if self.triage is None:
+            return None, None
+        prediction, local = await self.triage.classify(prepared["data"])
+        triage_info = self.triage.describe(prediction, escalated=not local)
+        if not local:
+            return None, triage_info
+        result = self.triage.result(prediction)
+        result["model"] = self.triage.model
+        result["cache_status"] = "miss"
+        result["preprocessing"] = prepared["stats"]
+        result["usage"] = None
+        result["attempts"] = 0
+        result["triage"] = triage_info
+        return result, triage_info
+    
+    async def _finish(
+        self, cache_key: str, prepared: Dict[str, Any], result: Dict[str, Any], usage: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """Cache a fresh upstream result and attach per-request metadata"""
+        
+        phash, color = prepared["phash"], prepared["color"]
+        result = dict(result, model=usage.get("model"))
+        # Only used to decide on detail escalation
+        result.pop("confidence", None)
+        # Fallback results are not cached, so a later upload gets a fresh attempt
+        if self.cache is not None and result["disease_type"] != ANALYSIS_FAILED:
+            await self.cache.set(cache_key, result, phash=phash, color=color)
+            if phash is not None and self.phash_index is not None:
+                self.phash_index.add(
+                    phash, cache_key, expires_at=time.time() + self.cache.retention_seconds, color=color
+                )
+        
+        result = dict(result)
+        result["cache_status"] = "miss"
+        result["preprocessing"] = prepared["stats"]
+        result["image_detail"] = prepared.get("detail")
+        result["usage"] = usage
+        result["attempts"] = usage.get("attempts", 0)
+        return result
+    
+    @timed("preprocess")
+    async def _prepare_image(self, image_data: bytes, choose_detail: bool = True) -> Dict[str, Any]:
+        """
+        Produce the bytes sent upstream, their real MIME type and the perceptual hash,
+        and with choose_detail the image detail level (low-detail images are prepared
+        at the policy's smaller size). Decoding and resizing are CPU-bound, so they run
+        in the preprocessing executor and never on the event loop.
+        """
+        
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        
+        if not self.preprocess_enabled:
+            signature = None
+            if self.phash_index is not None:
+                signature = await loop.run_in_executor(self.preprocess_executor, image_signature, image_data)
+            phash, color = signature or (None, None)
+            return {
+                "data": image_data,
+                "mime_type": detect_mime_type(image_data) or "image/jpeg",
+                "phash": phash,
+                "color": color,
+                "stats": None,
+            }
+        
+        try:
+            processed = await loop.run_in_executor(
+                self.preprocess_executor, preprocess_image,
+                image_data, self.max_image_edge, self.jpeg_quality, self.detail_policy if choose_detail else None,
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        stats = {key: value for key, value in processed.items() if key not in ("data", "detail", "phash", "color")}
+        # Wall time seen by the request, including executor queueing and IPC
+        stats["timings_ms"]["total_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        detail = processed["detail"]
+        return {
+            "data": processed["data"],
+            "mime_type": processed["mime_type"],
+            # Mutable: records the escalation, if any, for the response
+            "detail": dict(detail, escalated=None) if detail is not None else None,
+            "phash": processed["phash"],
+            "color": processed["color"],
+            "stats": stats,
         }
+    
+    async def _lookup_near_duplicate(self, phash: int, color: int) -> Optional[Dict[str, Any]]:
+        """Return the cached result of the nearest visually identical image of about the same color, if any"""
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
+        # Only reuse results produced by the current model and prompt
+        scope = f"{self.model}:{PROMPT_VERSION}:"
+        for _distance, candidate, key in self.phash_index.search(phash, color=color):
+            if not key.startswith(scope):
+                continue
+            cached = await self.cache.get(key, record_stats=False)
+            if cached is None:
+                # Entry expired or was evicted, drop the stale pointer
+                self.phash_index.remove(candidate, key)
+                continue
+            self.near_duplicate_hits += 1
+            return cached[0]
+        return None
+    
+    async def _analyze_with_detail(
+        self, image_data: bytes, prepared: Dict[str, Any], filename: str, on_field: Optional[FieldCallback] = None
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Single-image analysis at the detail level chosen during preprocessing. A low-detail
+        answer that is unparseable, incomplete or low-confidence is asked again in high
+        detail, from the upload prepared at full size, and the usage then covers both
+        calls. Returns (result, per-image usage).
+        """
+        
+        detail = prepared.get("detail")
+        level = detail["level"] if detail is not None else None
+        result, usage = await self._analyze_with_ai(prepared["data"], filename, prepared["mime_type"], on_field, level)
+        if level != "low":
+            return result, self._split_usage(usage, 1)
+        
+        reason = self._escalation_reason(result)
+        if reason is None or not self.detail_policy.escalate:
+            return result, self._split_usage(usage, 1)
+        
+        detail["escalated"] = reason
+        self.detail_escalations[reason] = self.detail_escalations.get(reason, 0) + 1
+        DETAIL_ESCALATIONS.inc(reason=reason)
+        full = await self._prepare_image(image_data, choose_detail=False)
+        high_result, high_usage = await self._analyze_with_ai(full["data"], filename, full["mime_type"], on_field, "high")
+        # A failed high-detail answer does not replace a usable low-detail one
+        if high_result["disease_type"] == ANALYSIS_FAILED and result["disease_type"] != ANALYSIS_FAILED:
+            high_result = result
+        return high_result, self._add_usage(self._split_usage(usage, 1), high_usage)
+    
+    @staticmethod
+    def _escalation_reason(result: Dict[str, Any]) -> Optional[str]:
+        """Why a low-detail answer should be asked again in high detail, None if it is good enough"""
+        if result["disease_type"] == ANALYSIS_FAILED:
+            return "unparseable"
+        if result.get("confidence") == "low":
+            return "low_confidence"
+        if "unknown" in (result["disease_type"].lower(), result["crop_type"].lower()):
+            return "incomplete"
+        return None
+    
+    async def _analyze_with_ai(
+        self,
+        image: bytes,
+        filename: str,
+        mime_type: str = "image/jpeg",
+        on_field: Optional[FieldCallback] = None,
+        detail: Optional[str] = None,
+        wait_for_usage: bool = False,
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Use OpenRouter AI for crop disease analysis; returns (result, usage).
+        A streamed answer is returned as soon as it is complete, and its usage then only
+        holds what had arrived by that point, unless wait_for_usage is set; token
+        accounting always uses the full usage.
+        """
+        
+        user_prompt = f"Please analyze this crop image for disease detection. Filename: {filename}"
+        
+        image_url: Dict[str, Any] = {"url": ImageData(image, mime_type)}
+        if detail is not None:
+            image_url["detail"] = detail
+        content = [
+            {"type": "text", "text": user_prompt},
+            {"type": "image_url", "image_url": image_url},
+        ]
+        
+        call_start = time.perf_counter()
+        ai_response, usage, pending = await self._request_completion(
+            "single", content, max_tokens=300, on_field=on_field, wait_for_usage=wait_for_usage
+        )
+        elapsed_s = time.perf_counter() - call_start
+        
+        def account(usage: Dict[str, Any]) -> None:
+            self._record_usage("single", 1, usage)
+            self._record_detail(detail or DEFAULT_DETAIL, usage, elapsed_s, len(image), filename)
+        
+        self._account(usage, pending, account)
+        
+        # Parse XML response
+        try:
+            with stage("parse"):
+                parsed_result = self._parse_xml_response(ai_response)
+                return self._validate_and_format_result(parsed_result), usage
+        except Exception as e:
+            PARSE_FAILURES.inc(mode="single")
+            print(f"AI returned unparseable response: {ai_response}")
+            print(f"Parse error: {e}")
+            # Return fallback response
+            return self._create_fallback_response(), usage
+    
+    async def _analyze_packed_with_ai(
+        self, images: List[Tuple[bytes, str, str]]
+    ) -> Tuple[List[Optional[Dict[str, Any]]], Dict[str, Any]]:
+        """
+        Analyze (image bytes, filename, mime_type) tuples in one completion.
+        Returns one result per image, None where the answer has no usable block.
+        """
+        
+        content = [{"type": "text", "text": f"Please analyze these {len(images)} crop images for disease detection."}]
+        for index, (image, filename, mime_type) in enumerate(images):
+            content.append({"type": "text", "text": f"Image {index} (filename: {filename})"})
+            content.append({"type": "image_url", "image_url": {"url": ImageData(image, mime_type)}})
+        
+        ai_response, usage, pending = await self._request_completion("packed", content, max_tokens=300 * len(images))
+        self._account(usage, pending, lambda usage: self._record_usage("packed", len(images), usage))
+        
+        results: List[Optional[Dict[str, Any]]] = [None] * len(images)
+        parse_start = time.perf_counter()
+        for match in re.finditer(r'<analysis\s+index="(\d+)"\s*>(.*?)</analysis>', ai_response, re.DOTALL):
+            index = int(match.group(1))
+            block = match.group(2)
+            if index >= len(images) or results[index] is not None:
+                continue
+            # A block without any of the expected tags is treated as unparseable
+            if not re.search(r'<(disease_type|severity_level|affected_area_percentage|crop_type)>', block):
+                continue
+            results[index] = self._validate_and_format_result(self._parse_xml_response(block))
+        
+        record_stage("parse", time.perf_counter() - parse_start)
+        
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            PARSE_FAILURES.inc(len(missing), mode="packed")
+            print(f"Packed response missing analyses for images {missing}: {ai_response}")
+        return results, usage
+    
+    @timed("upstream")
+    async def _request_completion(
+        self,
+        mode: str,
+        user_content: List[Dict[str, Any]],
+        max_tokens: int,
+        on_field: Optional[FieldCallback] = None,
+        wait_for_usage: bool = False,
+    ) -> Tuple[str, Dict[str, Any], Optional["asyncio.Task[Dict[str, Any]]"]]:
+        """
+        Chat completion ("single" or "packed" system prompt) with retries, hedging and model failover.
+        Returns (message content, usage, pending), usage also carrying the answering model and
+        attempt count. Streaming templates read the answer incrementally and return as soon as
+        all analysis fields have closed; the rest of the stream is then read in the background
+        and pending resolves to the final usage (None when usage is already final).
+        """
+        
+        if on_field is not None:
+            # Hedged or retried streams may report the same field again; forward each once
+            reported = set()
+            user_callback = on_field
+            
+            def on_field(field: str, value: str) -> None:
+                if field not in reported:
+                    reported.add(field)
+                    user_callback(field, value)
+        
+        (content, usage, pending), target, attempts = await self.resilience.call(
+            lambda target: self._post_completion(
+                self.templates[(target.model, mode)], user_content, max_tokens, on_field
+            ),
+            reports_sent=True,
+        )
+        if pending is not None and wait_for_usage:
+            # Shielded: a caller going away must not cut the drain short
+            usage = await asyncio.shield(pending)
+            pending = None
+        usage = dict(usage, model=usage.get("model") or target.model, attempts=attempts)
+        return content, usage, pending
+    
+    @staticmethod
+    def _account(
+        usage: Dict[str, Any],
+        pending: Optional["asyncio.Task[Dict[str, Any]]"],
+        account: Callable[[Dict[str, Any]], None],
+    ) -> None:
+        """Call account with the final usage of a call: now, or once its stream has been drained"""
+        if pending is None:
+            account(usage)
+            return
+        
+        def drained(task: "asyncio.Task[Dict[str, Any]]") -> None:
+            if not task.cancelled():
+                account(dict(usage, **{key: value for key, value in task.result().items() if value is not None}))
+        
+        pending.add_done_callback(drained)
+    
+    async def _post_completion(
+        self,
+        template: RequestTemplate,
+        user_content: List[Dict[str, Any]],
+        max_tokens: int,
+        on_field: Optional[FieldCallback] = None,
+    ) -> Tuple[str, Dict[str, Any], Optional["asyncio.Task[Dict[str, Any]]"]]:
+        """
+        POST one chat completion to OpenRouter; returns (message content, usage, pending),
+        pending being the background drain of a stream returned early (see _read_stream)
+        """
+        
+        images = sum(1 for part in user_content if part["type"] == "image_url")
+        estimated_tokens = images * ESTIMATED_TOKENS_PER_IMAGE + max_tokens
+        
+        # Only the user message is serialised per call; images are base64-encoded in chunks as the body is sent
+        body = template.body(user_content, max_tokens)
+        headers = dict(template.headers, **{"Content-Length": str(body.content_length)})
+        
+        async with self._client() as client, self._permit(estimated_tokens) as permit:
+            # Waiting for the permit may have used up the caller's deadline
+            check_deadline(self.resilience.expected_latency_s(template.model) or 0.0)
+            request_sent()
             try:
-                response = await client.post(self.base_url, headers=headers, json=data)
-                response.raise_for_status()
-                
-                result = response.json()
-                ai_response = result["choices"][0]["message"]["content"].strip()
+                pending = None
+                if template.stream:
+                    content, usage, pending = await self._read_stream(client, template, headers, body, permit, on_field)
+                else:
+                    response = await client.post(template.url, headers=headers, content=body)
+                    self._raise_for_status(response, template.model, permit)
+                    
+                    result = response.json()
+                    # OpenRouter reports the model that actually served the request
+                    usage = dict(result.get("usage") or {}, model=result.get("model"))
+                    content = result["choices"][0]["message"]["content"].strip()
                 
-                # Parse XML response
-                try:
-                    parsed_result = self._parse_xml_response(ai_response)
-                    return self._validate_and_format_result(parsed_result)
-                except Exception as e:
-                    print(f"AI returned unparseable response: {ai_response}")
-                    print(f"Parse error: {e}")
-                    # Return fallback response
-                    return self._create_fallback_response()
+                if permit is not None:
+                    if pending is None:
+                        permit.succeeded(usage.get("total_tokens"))
+                    else:
+                        # The slot is free once the answer is in; the token estimate is corrected when the usage arrives
+                        permit.succeeded()
+                        pending.add_done_callback(
+                            lambda task: task.cancelled() or permit.settle(task.result().get("total_tokens"))
+                        )
+                return content, usage, pending
                     
+            except HTTPException:
+                raise
             except httpx.HTTPStatusError as e:
-                print(f"OpenRouter API HTTP error: {e.response.status_code} - {e.response.text}")
-                raise HTTPException(status_code=500, detail=f"OpenRouter API error: {e.response.status_code}")
+                status = e.response.status_code
+                UPSTREAM_ERRORS.inc(model=template.model, status=str(status))
+                print(f"OpenRouter API HTTP error: {status} - {e.response.text}")
+                raise UpstreamError(500, f"OpenRouter API error: {status}", upstream_status=status)
             except Exception as e:
+                UPSTREAM_ERRORS.inc(model=template.model, status="transport")
                 print(f"OpenRouter API error: {str(e)}")
-                raise HTTPException(status_code=500, detail=f"AI analysis failed: {str(e)}")
+                raise UpstreamError(500, f"AI analysis failed: {str(e)}")
+    
+    async def _read_stream(
+        self,
+        client: httpx.AsyncClient,
+        template: RequestTemplate,
+        headers: Dict[str, str],
+        body: StreamedJSONBody,
+        permit: Any,
+        on_field: Optional[FieldCallback],
+    ) -> Tuple[str, Dict[str, Any], Optional["asyncio.Task[Dict[str, Any]]"]]:
+        """
+        Consume an SSE completion, feeding content deltas to the incremental parser.
+        Returns as soon as every field has closed, with the usage known so far and a task
+        that reads the rest of the stream (the final usage chunk and [DONE]) in the
+        background and resolves to the final usage. Reading to the end lets the
+        connection go back to the pool instead of being closed.
+        """
+        
+        parser = IncrementalXMLParser()
+        usage: Dict[str, Any] = {}
+        model = None
+        response: Optional[httpx.Response] = await client.send(
+            client.build_request("POST", template.url, headers=headers, content=body), stream=True
+        )
+        try:
+            if response.is_error:
+                await response.aread()
+            self._raise_for_status(response, template.model, permit)
+            
+            if response.headers.get("content-type", "").startswith("application/json"):
+                # Endpoint ignored "stream": read it as a regular completion
+                await response.aread()
+                result = response.json()
+                content = result["choices"][0]["message"]["content"].strip()
+                for field, value in parser.feed(content):
+                    if on_field is not None:
+                        on_field(field, value)
+                return content, dict(result.get("usage") or {}, model=result.get("model")), None
+            
+            chunks = self._stream_chunks(response)
+            async for chunk in chunks:
+                model = chunk.get("model") or model
+                usage = chunk.get("usage") or usage
+                for choice in chunk.get("choices") or []:
+                    delta = (choice.get("delta") or {}).get("content")
+                    if not delta:
+                        continue
+                    for field, value in parser.feed(delta):
+                        if on_field is not None:
+                            on_field(field, value)
+                if parser.complete:
+                    # The drain owns the response from here on
+                    pending = asyncio.create_task(self._drain_stream(response, chunks, usage, model or template.model))
+                    self._drains.add(pending)
+                    pending.add_done_callback(self._drains.discard)
+                    response = None
+                    return parser.text.strip(), dict(usage, model=model), pending
+        finally:
+            if response is not None:
+                await response.aclose()
+        
+        return parser.text.strip(), dict(usage, model=model), None
+    
+    @staticmethod
+    async def _stream_chunks(response: httpx.Response) -> AsyncIterator[Dict[str, Any]]:
+        """Parsed data events of an SSE completion, read to the end of the body"""
+        async for line in response.aiter_lines():
+            # Skip blank separators and ": OPENROUTER PROCESSING" keep-alive comments
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                # Keep reading: only a response read to its end is returned to the pool
+                continue
+            chunk = json.loads(payload)
+            if chunk.get("error"):
+                code = chunk["error"].get("code")
+                raise UpstreamError(
+                    500,
+                    f"OpenRouter API error: {chunk['error'].get('message', 'stream failed')}",
+                    upstream_status=code if isinstance(code, int) else None,
+                )
+            yield chunk
+    
+    async def _drain_stream(
+        self,
+        response: httpx.Response,
+        chunks: AsyncIterator[Dict[str, Any]],
+        usage: Dict[str, Any],
+        model: str,
+    ) -> Dict[str, Any]:
+        """Read the rest of a stream whose answer was already returned; resolves to the final usage"""
+        
+        async def read_rest() -> None:
+            nonlocal usage, model
+            async for chunk in chunks:
+                model = chunk.get("model") or model
+                usage = chunk.get("usage") or usage
+        
+        try:
+            await asyncio.wait_for(read_rest(), timeout=STREAM_DRAIN_TIMEOUT_S)
+            self.stream_drains["drained"] += 1
+        except Exception as e:
+            # The answer is already out; only the usage and the connection are lost
+            self.stream_drains["abandoned"] += 1
+            print(f"Reading the rest of an upstream stream failed: {e!r}")
+        finally:
+            await response.aclose()
+        return dict(usage, model=model)
+    
+    async def wait_for_drains(self) -> None:
+        """Wait for streams still being read in the background (each is bounded by STREAM_DRAIN_TIMEOUT_S)"""
+        if self._drains:
+            await asyncio.gather(*self._drains, return_exceptions=True)
+    
+    def _raise_for_status(self, response: httpx.Response, model: str, permit: Any) -> None:
+        """Turn an upstream 429 into a 503 with Retry-After and pause the limiter; raise on other errors"""
+        if response.status_code == 429:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if permit is not None:
+                permit.rate_limited(retry_after)
+            UPSTREAM_ERRORS.inc(model=model, status="429")
+            print(f"OpenRouter rate limit hit, retry after {retry_after:.1f}s")
+            raise UpstreamError(
+                503,
+                "AI service is rate limited, please retry later",
+                upstream_status=429,
+                retry_after_s=retry_after,
+                headers={"Retry-After": str(max(1, round(retry_after)))},
+            )
+        response.raise_for_status()
+    
+    @asynccontextmanager
+    async def _permit(self, estimated_tokens: int) -> AsyncIterator[Any]:
+        """Wait for the upstream limiter, if any; yields its permit or None"""
+        if self.limiter is None:
+            yield None
+            return
+        async with self.limiter.permit(estimated_tokens) as permit:
+            yield permit
+    
+    def _record_detail(self, level: str, usage: Dict[str, Any], elapsed_s: float, image_bytes: int, filename: str) -> None:
+        """Input tokens and latency per single-image call, by detail level, so savings can be measured"""
+        prompt_tokens = usage.get("prompt_tokens") or 0
+        stats = self.detail_calls[level]
+        stats["calls"] += 1
+        stats["prompt_tokens"] += prompt_tokens
+        stats["latency_s"] += elapsed_s
+        DETAIL_PROMPT_TOKENS.inc(prompt_tokens, detail=level)
+        DETAIL_UPSTREAM_SECONDS.observe(elapsed_s, detail=level)
+        print(
+            f"Analyzed {filename}: detail={level} image_kb={image_bytes / 1024:.0f} "
+            f"prompt_tokens={prompt_tokens} latency_ms={elapsed_s * 1000:.0f}"
+        )
+    
+    def detail_stats(self) -> Dict[str, Any]:
+        """Calls, prompt tokens and latency per detail level, and escalations from low to high"""
+        levels = {
+            level: {
+                "calls": stats["calls"],
+                "prompt_tokens_per_call": round(stats["prompt_tokens"] / stats["calls"], 1) if stats["calls"] else None,
+                "mean_latency_ms": round(stats["latency_s"] / stats["calls"] * 1000) if stats["calls"] else None,
+            }
+            for level, stats in self.detail_calls.items()
+        }
+        return {
+            "mode": self.detail_policy.mode if self.detail_policy is not None else "off",
+            "levels": levels,
+            "escalations": dict(self.detail_escalations),
+        }
+    
+    def _record_usage(self, mode: str, images: int, usage: Dict[str, Any]) -> None:
+        stats = self.usage_by_mode[mode]
+        stats["calls"] += 1
+        stats["images"] += images
+        stats["prompt_tokens"] += usage.get("prompt_tokens") or 0
+        stats["completion_tokens"] += usage.get("completion_tokens") or 0
+        stats["cached_tokens"] += _cached_tokens(usage)
+        model = usage.get("model") or self.model
+        UPSTREAM_TOKENS.inc(usage.get("prompt_tokens") or 0, model=model, type="prompt")
+        UPSTREAM_TOKENS.inc(usage.get("completion_tokens") or 0, model=model, type="completion")
+        UPSTREAM_TOKENS.inc(_cached_tokens(usage), model=model, type="cached")
+    
+    @staticmethod
+    def _split_usage(usage: Dict[str, Any], images: int) -> Dict[str, Any]:
+        """Per-image share of one upstream call"""
+        return {
+            "prompt_tokens": (usage.get("prompt_tokens") or 0) / images,
+            "completion_tokens": (usage.get("completion_tokens") or 0) / images,
+            "cached_tokens": _cached_tokens(usage) / images,
+            "upstream_calls": 1 / images if usage else 0,
+            "model": usage.get("model"),
+            "attempts": usage.get("attempts", 0),
+        }
+    
+    @staticmethod
+    def _add_usage(first: Dict[str, Any], second: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "prompt_tokens": first.get("prompt_tokens", 0) + (second.get("prompt_tokens") or 0),
+            "completion_tokens": first.get("completion_tokens", 0) + (second.get("completion_tokens") or 0),
+            "cached_tokens": first.get("cached_tokens", 0) + _cached_tokens(second),
+            "upstream_calls": first.get("upstream_calls", 0) + 1,
+            "model": second.get("model"),
+            "attempts": first.get("attempts", 0) + second.get("attempts", 0),
+        }
+    
+    def usage_stats(self) -> Dict[str, Any]:
+        """Upstream calls, images and tokens per image, single-image vs packed calls, and stream drains"""
+        report: Dict[str, Any] = {"stream_drains": dict(self.stream_drains, in_progress=len(self._drains))}
+        for mode, stats in self.usage_by_mode.items():
+            tokens = stats["prompt_tokens"] + stats["completion_tokens"]
+            report[mode] = dict(
+                stats,
+                tokens_per_image=round(tokens / stats["images"], 1) if stats["images"] else None,
+                # Share of prompt tokens served from the provider's prompt cache
+                cached_prompt_share=round(stats["cached_tokens"] / stats["prompt_tokens"], 3) if stats["prompt_tokens"] else None,
+            )
+        return report
     
     def _parse_xml_response(self, xml_response: str) -> Dict[str, Any]:
         """Parse XML response into structured data"""
         
-        # Extract each field using regex
-        disease_type_match = re.search(r'<disease_type>(.*?)</disease_type>', xml_response, re.DOTALL)
-        severity_match = re.search(r'<severity_level>(.*?)</severity_level>', xml_response, re.DOTALL)
-        affected_area_match = re.search(r'<affected_area_percentage>(.*?)</affected_area_percentage>', xml_response, re.DOTALL)
-        crop_type_match = re.search(r'<crop_type>(.*?)</crop_type>', xml_response, re.DOTALL)
+        # Extract all fields in a single pass
+        fields = parse_fields(xml_response, ANALYSIS_FIELDS + ("confidence",))
+        if not any(field in fields for field in ANALYSIS_FIELDS):
+            raise ValueError("No analysis fields in response")
         
-        return {
-            "disease_type": disease_type_match.group(1).strip() if disease_type_match else "Unknown",
-            "severity_level": severity_match.group(1).strip() if severity_match else "1",
-            "affected_area_percentage": affected_area_match.group(1).strip() if affected_area_match else "0",
-            "crop_type": crop_type_match.group(1).strip() if crop_type_match else "Unknown"
+        parsed = {
+            "disease_type": fields.get("disease_type", "Unknown"),
+            "severity_level": fields.get("severity_level", "1"),
+            "affected_area_percentage": fields.get("affected_area_percentage", "0"),
+            "crop_type": fields.get("crop_type", "Unknown")
         }
+        if "confidence" in fields:
+            parsed["confidence"] = fields["confidence"]
+        return parsed
     
     def _validate_and_format_result(self, parsed_result: Dict[str, Any]) -> Dict[str, Any]:
         """Validate and format the analysis result"""
@@ -166,17 +1014,20 @@ Return ONLY the XML structure, no additional text or explanations."""
         if severity <= 2 and affected_area == 0 and disease_type.lower() not in ["healthy", "none"]:
             disease_type = "Healthy"
         
-        return {
+        result = {
             "disease_type": disease_type,
             "severity_level": severity,
             "affected_area_percentage": affected_area,
             "crop_type": crop_type
         }
+        if "confidence" in parsed_result:
+            result["confidence"] = str(parsed_result["confidence"]).strip().lower()
+        return result
     
     def _create_fallback_response(self) -> Dict[str, Any]:
         """Create a fallback response when AI analysis fails"""
         return {
-            "disease_type": "Analysis Failed",
+            "disease_type": ANALYSIS_FAILED,
             "severity_level": 1,
             "affected_area_percentage": 0,
             "crop_type": "Unknown"
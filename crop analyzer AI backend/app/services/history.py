@@ -0,0 +1,336 @@
+import asyncio
+import datetime
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from app.services.crop_analyzer import ANALYSIS_FAILED
+from app.services.triage import NO_CROP_DETECTED
+
+# Columns of the daily rollups a query can group by
+ROLLUP_GROUPS = {
+    "disease": ("disease_type",),
+    "crop": ("crop_type",),
+    "disease_crop": ("disease_type", "crop_type"),
+}
+
+_RECORD_COLUMNS = (
+    "recorded_at", "day", "image_digest", "model", "latency_ms", "disease_type", "crop_type",
+    "severity_level", "affected_area_percentage", "cache_status", "source", "filename", "outcome",
+)
+
+# Only these records are counted in the rollups
+DIAGNOSIS = "diagnosis"
+
+SEVERITY_LEVELS = range(1, 11)
+
+
+def outcome(result: Dict[str, Any]) -> str:
+    """
+    What a response says about the field: a diagnosis, or a fallback answer (failed),
+    an image without a crop (no_crop) or a near-duplicate of an image already analyzed
+    """
+    if result["disease_type"] == ANALYSIS_FAILED:
+        return "failed"
+    if result["disease_type"] == NO_CROP_DETECTED:
+        return "no_crop"
+    if result.get("cache_status") == "near_hit":
+        return "near_duplicate"
+    return DIAGNOSIS
+
+
+def _day(timestamp: float) -> str:
+    """UTC calendar day, the rollup bucket"""
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+
+def parse_day(value: Optional[str], default_days_ago: int) -> str:
+    """YYYY-MM-DD query parameter; defaults to default_days_ago days before today (UTC)"""
+    if value is None or not value.strip():
+        return _day(time.time() - default_days_ago * 86400)
+    try:
+        return datetime.date.fromisoformat(value.strip()).isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid date '{value}', expected YYYY-MM-DD")
+
+
+class HistoryStore:
+    """
+    Every analysis result, kept in a SQLite file (WAL) for dashboards and auditing.
+
+    Writes are write-behind: record() only appends to an in-memory buffer and a
+    background task inserts it in batches of up to batch_size rows, one transaction
+    per batch, off the request path. The same transaction adds the batch to the
+    daily rollups (analyses per day, disease, crop and severity level), so aggregate
+    queries read a few hundred rollup rows instead of scanning the history. The
+    rollups count diagnoses only, and each image (by digest) once per day, so repeat
+    uploads served from the cache or coalesced do not inflate them. The buffer is
+    bounded (max_pending); records beyond it, and those buffered when the process
+    dies, are lost and counted as dropped. Several workers may share a file.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = 500,
+        flush_interval_s: float = 1.0,
+        max_pending: int = 10000,
+    ):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.flush_interval_s = flush_interval_s
+        self.max_pending = max_pending
+        self._pending: List[Tuple[Any, ...]] = []
+        self._wake = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+
+        # One connection for the writer and one for queries: in WAL mode readers never wait for the writer
+        self._write_lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS analyses ("
+            "id INTEGER PRIMARY KEY, recorded_at REAL NOT NULL, day TEXT NOT NULL, image_digest TEXT, "
+            "model TEXT, latency_ms INTEGER, disease_type TEXT NOT NULL, crop_type TEXT NOT NULL, "
+            "severity_level INTEGER NOT NULL, affected_area_percentage REAL NOT NULL, "
+            "cache_status TEXT, source TEXT, filename TEXT, outcome TEXT)"
+        )
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(analyses)")]
+        if "outcome" not in columns:
+            self._db.execute("ALTER TABLE analyses ADD COLUMN outcome TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS analyses_recorded_at ON analyses (recorded_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS analyses_disease ON analyses (disease_type, recorded_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS analyses_crop ON analyses (crop_type, recorded_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS analyses_digest ON analyses (image_digest)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS daily_rollups ("
+            "day TEXT NOT NULL, disease_type TEXT NOT NULL, crop_type TEXT NOT NULL, severity_level INTEGER NOT NULL, "
+            "analyses INTEGER NOT NULL, affected_area_sum REAL NOT NULL, latency_ms_sum INTEGER NOT NULL, "
+            "PRIMARY KEY (day, disease_type, crop_type, severity_level)) WITHOUT ROWID"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS daily_rollups_disease ON daily_rollups (disease_type, day)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS daily_rollups_crop ON daily_rollups (crop_type, day)")
+        # Images already counted in a day's rollups
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rollup_digests ("
+            "day TEXT NOT NULL, image_digest TEXT NOT NULL, PRIMARY KEY (day, image_digest)) WITHOUT ROWID"
+        )
+        self._read_lock = threading.Lock()
+        self._reader = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.write_errors = 0
+        self.last_batch_ms = 0.0
+
+    async def start(self) -> None:
+        self._flusher = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the background flusher and write out whatever is still buffered"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    def record(self, result: Dict[str, Any], source: str, recorded_at: Optional[float] = None) -> None:
+        """Buffer an analysis response (as returned to the client); never blocks"""
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        recorded_at = recorded_at if recorded_at is not None else time.time()
+        self._pending.append((
+            recorded_at,
+            _day(recorded_at),
+            result.get("image_digest"),
+            result.get("model"),
+            result.get("response_time_ms"),
+            result["disease_type"],
+            result["crop_type"],
+            int(result["severity_level"]),
+            float(result["affected_area_percentage"]),
+            result.get("cache_status"),
+            source,
+            result.get("filename"),
+            outcome(result),
+        ))
+        self.recorded += 1
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval_s)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except sqlite3.Error as e:
+                self.write_errors += 1
+                self.dropped += len(batch)
+                print(f"Writing {len(batch)} history records failed: {e}")
+
+    def _write(self, batch: List[Tuple[Any, ...]]) -> None:
+        start = time.perf_counter()
+        with self._write_lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    f"INSERT INTO analyses ({', '.join(_RECORD_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' for _ in _RECORD_COLUMNS)})",
+                    batch,
+                )
+                # Pre-aggregate the batch, so each rollup row is updated once per transaction
+                rollups: Dict[Tuple[str, str, str, int], List[float]] = {}
+                for row in batch:
+                    _recorded_at, day, digest, _model, latency_ms, disease, crop, severity, area = row[:9]
+                    if row[_RECORD_COLUMNS.index("outcome")] != DIAGNOSIS:
+                        continue
+                    if digest is not None and not self._db.execute(
+                        "INSERT OR IGNORE INTO rollup_digests (day, image_digest) VALUES (?, ?)", (day, digest)
+                    ).rowcount:
+                        # Already counted today (in this batch, an earlier one or by another worker)
+                        continue
+                    totals = rollups.setdefault((day, disease, crop, severity), [0, 0.0, 0])
+                    totals[0] += 1
+                    totals[1] += area
+                    totals[2] += latency_ms or 0
+                self._db.executemany(
+                    "INSERT INTO daily_rollups "
+                    "(day, disease_type, crop_type, severity_level, analyses, affected_area_sum, latency_ms_sum) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (day, disease_type, crop_type, severity_level) DO UPDATE SET "
+                    "analyses = analyses + excluded.analyses, "
+                    "affected_area_sum = affected_area_sum + excluded.affected_area_sum, "
+                    "latency_ms_sum = latency_ms_sum + excluded.latency_ms_sum",
+                    [key + tuple(totals) for key, totals in rollups.items()],
+                )
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+        self.written += len(batch)
+        self.batches += 1
+        self.last_batch_ms = round((time.perf_counter() - start) * 1000, 2)
+
+    def _select(self, sql: str, params: List[Any]) -> List[Dict[str, Any]]:
+        with self._read_lock:
+            cursor = self._reader.execute(sql, params)
+            columns = [description[0] for description in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def query(
+        self,
+        disease_type: Optional[str] = None,
+        crop_type: Optional[str] = None,
+        image_digest: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: int = 100,
+    ) -> List[Dict[str, Any]]:
+        """
+        Individual records, newest first. Every filter is served by an index; page
+        backwards by passing the last record's recorded_at as `until` (exclusive).
+        """
+        conditions, params = [], []
+        for column, value in (("disease_type", disease_type), ("crop_type", crop_type), ("image_digest", image_digest)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("recorded_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("recorded_at < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._select(
+            f"SELECT id, {', '.join(_RECORD_COLUMNS)} FROM analyses {where} "
+            f"ORDER BY recorded_at DESC, id DESC LIMIT ?",
+            params + [limit],
+        )
+
+    def _rollup_filter(
+        self, since_day: str, until_day: str, disease_type: Optional[str], crop_type: Optional[str]
+    ) -> Tuple[str, List[Any]]:
+        conditions, params = ["day >= ?", "day <= ?"], [since_day, until_day]
+        for column, value in (("disease_type", disease_type), ("crop_type", crop_type)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        return " AND ".join(conditions), params
+
+    def daily_counts(
+        self,
+        since_day: str,
+        until_day: str,
+        group_by: str = "disease_crop",
+        disease_type: Optional[str] = None,
+        crop_type: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Analyses per day and disease and/or crop (both days inclusive), with mean severity and affected area"""
+        columns = ", ".join(ROLLUP_GROUPS[group_by])
+        where, params = self._rollup_filter(since_day, until_day, disease_type, crop_type)
+        rows = self._select(
+            f"SELECT day, {columns}, SUM(analyses) AS analyses, "
+            f"SUM(severity_level * analyses) AS severity_sum, SUM(affected_area_sum) AS affected_area_sum "
+            f"FROM daily_rollups WHERE {where} GROUP BY day, {columns} ORDER BY day, {columns}",
+            params,
+        )
+        for row in rows:
+            analyses = row["analyses"]
+            row["mean_severity"] = round(row.pop("severity_sum") / analyses, 2)
+            row["mean_affected_area_percentage"] = round(row.pop("affected_area_sum") / analyses, 2)
+        return rows
+
+    def severity_histogram(
+        self,
+        since_day: str,
+        until_day: str,
+        disease_type: Optional[str] = None,
+        crop_type: Optional[str] = None,
+    ) -> Dict[int, int]:
+        """Analyses per severity level (1-10) over a range of days"""
+        where, params = self._rollup_filter(since_day, until_day, disease_type, crop_type)
+        rows = self._select(
+            f"SELECT severity_level, SUM(analyses) AS analyses FROM daily_rollups WHERE {where} "
+            f"GROUP BY severity_level ORDER BY severity_level",
+            params,
+        )
+        histogram = {level: 0 for level in SEVERITY_LEVELS}
+        for row in rows:
+            histogram[row["severity_level"]] = row["analyses"]
+        return histogram
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "recorded": self.recorded,
+            "written": self.written,
+            "pending": len(self._pending),
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "write_errors": self.write_errors,
+            "last_batch_ms": self.last_batch_ms,
+        }
+
+    def close(self) -> None:
+        with self._write_lock:
+            self._db.close()
+        with self._read_lock:
+            self._reader.close()
@@ -0,0 +1,79 @@
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, ImageFilter, ImageStat
+
+DETAIL_MODES = ("auto", "low", "high", "off")
+
+# Discrete Laplacian; offset keeps negative responses inside the 8-bit range
+_LAPLACIAN = ImageFilter.Kernel((3, 3), (0, 1, 0, 1, -4, 1, 0, 1, 0), scale=1, offset=128)
+
+# Edge the sharpness is measured at, so it does not depend on the upload's resolution
+SHARPNESS_EDGE = 512
+
+
+def image_signals(image: Image.Image, roi_share: float = 0.6) -> Dict[str, float]:
+    """
+    Cheap local cues for how much resolution an analysis needs: the fraction of green
+    (and of green plus yellow/brown, i.e. leaf including lesions) in the central
+    region of interest, and sharpness as the Laplacian's standard deviation.
+    """
+
+    width, height = image.size
+    margin_x, margin_y = int(width * (1 - roi_share) / 2), int(height * (1 - roi_share) / 2)
+    roi = image.crop((margin_x, margin_y, width - margin_x, height - margin_y))
+    roi = roi.convert("RGB").resize((64, 64), Image.BILINEAR).convert("HSV")
+    green = yellow_brown = 0
+    for hue, saturation, value in roi.getdata():
+        # Shadows and grey background carry no colour information
+        if value < 30 or saturation < 40:
+            continue
+        degrees = hue * 360 / 255
+        if 65 <= degrees < 170:
+            green += 1
+        elif 15 <= degrees < 65:
+            yellow_brown += 1
+    pixels = 64 * 64
+
+    gray = image.convert("L")
+    gray.thumbnail((SHARPNESS_EDGE, SHARPNESS_EDGE))
+    sharpness = ImageStat.Stat(gray.filter(_LAPLACIAN)).stddev[0]
+    return {
+        "green_fraction": round(green / pixels, 3),
+        "plant_fraction": round((green + yellow_brown) / pixels, 3),
+        "sharpness": round(sharpness, 2),
+    }
+
+
+@dataclass(frozen=True)
+class DetailPolicy:
+    """
+    Chooses the image detail level sent to the vision model. Low detail is a single
+    small image (a fraction of the prompt tokens of high detail's tiles) and is used
+    where extra resolution adds nothing: small or blurry images, and close-ups where
+    the leaf fills the frame. Everything else (field scenes, small lesions) goes high.
+    Low-detail answers that come back unparseable or low-confidence are re-asked in
+    high detail, so the policy can be aggressive.
+    """
+    mode: str = "auto"
+    # Longest edge of the image sent in low detail
+    low_max_edge: int = 512
+    # Close-up: this much of the central region is green
+    min_green_fraction: float = 0.4
+    # Laplacian standard deviation below which the image is too blurry to gain from high detail
+    blur_threshold: float = 4.0
+    escalate: bool = True
+
+    def choose(self, signals: Dict[str, float], dimensions: Tuple[int, int]) -> Tuple[Optional[str], str]:
+        """(detail level, or None to send no hint; reason)"""
+        if self.mode == "off":
+            return None, "disabled"
+        if self.mode in ("low", "high"):
+            return self.mode, "configured"
+        if max(dimensions) <= self.low_max_edge:
+            return "low", "small"
+        if signals["sharpness"] < self.blur_threshold:
+            return "low", "blurry"
+        if signals["green_fraction"] >= self.min_green_fraction:
+            return "low", "close_up"
+        return "high", "detailed"
@@ -0,0 +1,125 @@
+import io
+import time
+from typing import Dict, Any, Optional
+
+from PIL import Image, ImageOps
+
+from app.services.image_detail import DetailPolicy, image_signals
+from app.services.perceptual_hash import signature_from_image
+
+# Formats the vision model accepts as-is, by Pillow format name
+SUPPORTED_MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+    "GIF": "image/gif",
+}
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+def detect_mime_type(image_data: bytes) -> Optional[str]:
+    """Sniff the image format from its magic bytes"""
+    if image_data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if image_data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
+        return "image/webp"
+    if image_data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return None
+
+
+def _ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 2)
+
+
+def preprocess_image(
+    image_data: bytes, max_edge: int = 1024, jpeg_quality: int = 85, detail_policy: Optional[DetailPolicy] = None
+) -> Dict[str, Any]:
+    """
+    Decode, EXIF-orient, downscale and re-encode an upload for the vision model.
+
+    Runs inside a worker process, so it is a plain function over bytes. JPEGs use
+    draft mode to decode directly at a reduced scale. Images that are already small,
+    upright and in a supported format are passed through untouched.
+    With a detail_policy, local signals pick the detail level to request ("detail");
+    for low detail only a copy at the policy's low_max_edge is encoded.
+    Raises ValueError if the bytes are not a decodable image.
+    """
+
+    timings = {}
+    start = time.perf_counter()
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        source_format = image.format
+        orientation = image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        original_size = image.size
+        if source_format == "JPEG":
+            image.draft("RGB", (max_edge, max_edge))
+        image.load()
+    except Exception:
+        raise ValueError("File is not a valid image")
+    timings["decode_ms"] = _ms(start)
+
+    start = time.perf_counter()
+    if orientation != 1:
+        image = ImageOps.exif_transpose(image)
+    timings["orient_ms"] = _ms(start)
+
+    start = time.perf_counter()
+    resized = max(original_size) > max_edge
+    if resized:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS, reducing_gap=2.0)
+    timings["resize_ms"] = _ms(start)
+
+    start = time.perf_counter()
+    phash, color = signature_from_image(image) or (None, None)
+    timings["phash_ms"] = _ms(start)
+
+    detail = None
+    if detail_policy is not None and detail_policy.mode != "off":
+        start = time.perf_counter()
+        low = image
+        if max(image.size) > detail_policy.low_max_edge:
+            low = image.copy()
+            low.thumbnail((detail_policy.low_max_edge, detail_policy.low_max_edge), Image.BICUBIC, reducing_gap=1.0)
+        signals = image_signals(low)
+        level, reason = detail_policy.choose(signals, image.size)
+        detail = {"level": level, "reason": reason, "signals": signals}
+        if level == "low" and low is not image:
+            # The full-size image is only prepared again if the analysis escalates to high detail
+            image, resized = low, True
+        timings["detail_ms"] = _ms(start)
+
+    start = time.perf_counter()
+    if not resized and orientation == 1 and source_format in SUPPORTED_MIME_TYPES:
+        output = image_data
+        mime_type = SUPPORTED_MIME_TYPES[source_format]
+    else:
+        if image.mode not in ("RGB", "L"):
+            # JPEG has no alpha channel, flatten transparency onto white
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image.convert("RGBA"), mask=image.convert("RGBA").getchannel("A"))
+            image = background
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=jpeg_quality, optimize=True)
+        output = buffer.getvalue()
+        mime_type = "image/jpeg"
+    timings["encode_ms"] = _ms(start)
+
+    return {
+        "data": output,
+        "mime_type": mime_type,
+        "detail": detail,
+        "phash": phash,
+        "color": color,
+        "source_format": source_format,
+        "original_dimensions": list(original_size),
+        "dimensions": list(image.size),
+        "original_bytes": len(image_data),
+        "processed_bytes": len(output),
+        "bytes_saved": len(image_data) - len(output),
+        "timings_ms": timings,
+    }
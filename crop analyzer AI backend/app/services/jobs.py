@@ -0,0 +1,251 @@
+import asyncio
+import contextvars
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+
+from app.services.upload_limits import UploadBudget
+
+JobHandler = Callable[[bytes, str], Awaitable[Dict[str, Any]]]
+
+TERMINAL_STATUSES = ("succeeded", "failed")
+
+
+class JobQueueFull(Exception):
+    """Raised by submit() when the queue cannot take more work"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Job queue is full")
+        self.retry_after = retry_after
+
+
+@dataclass
+class Job:
+    id: str
+    filename: str
+    status: str = "queued"
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[Dict[str, Any]] = None
+    # Bumped on every status change so subscribers can wait for the next one
+    version: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "filename": self.filename,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobQueue(ABC):
+    """
+    Interface for asynchronous analysis jobs. Submissions return immediately;
+    workers drain the queue and clients poll or subscribe for the outcome.
+    """
+
+    @abstractmethod
+    async def start(self) -> None: ...
+
+    @abstractmethod
+    async def stop(self, drain_timeout_s: float = 0) -> None:
+        """Stop the workers, first giving queued and running jobs up to drain_timeout_s to finish"""
+
+    @abstractmethod
+    async def submit(self, image_data: bytes, filename: str) -> Job:
+        """Enqueue a job, raising JobQueueFull instead of waiting when at capacity"""
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[Job]: ...
+
+    @abstractmethod
+    def subscribe(self, job_id: str) -> AsyncIterator[Job]:
+        """Yield the job on every status change until it finishes"""
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]: ...
+
+
+class InMemoryJobQueue(JobQueue):
+    """
+    In-process job queue: a bounded asyncio.Queue drained by a fixed pool of
+    worker tasks. Finished jobs are kept for result_ttl_seconds so clients can
+    collect them. Jobs do not survive a restart. Each job runs in a copy of the
+    context it was submitted from (e.g. the submitter's scheduling lane and tenant).
+
+    Queued images stay in memory until their job finishes, so with a budget
+    their bytes are charged to it (the same one that bounds uploads in flight)
+    and a submit that does not fit is rejected like a full queue.
+    """
+
+    def __init__(
+        self,
+        handler: JobHandler,
+        workers: int = 4,
+        max_queued: int = 100,
+        result_ttl_seconds: float = 3600,
+        budget: Optional[UploadBudget] = None,
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.max_queued = max_queued
+        self.result_ttl_seconds = result_ttl_seconds
+        self.budget = budget
+        self._held_bytes = 0
+        self._queue: "asyncio.Queue[tuple]" = asyncio.Queue(maxsize=max_queued)
+        self._jobs: Dict[str, Job] = {}
+        self._changed: Dict[str, asyncio.Event] = {}
+        self._worker_tasks: List[asyncio.Task] = []
+        self._running = 0
+        self._avg_duration_s = 5.0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    async def start(self) -> None:
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout_s: float = 0) -> None:
+        if drain_timeout_s > 0 and self._worker_tasks:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=drain_timeout_s)
+            except asyncio.TimeoutError:
+                print(f"Job queue not drained after {drain_timeout_s}s; failing {self._queue.qsize() + self._running} jobs")
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        # Jobs nobody picked up: fail them and hand their bytes back
+        while not self._queue.empty():
+            job, image_data, _context = self._queue.get_nowait()
+            self._update(job, status="failed", finished_at=time.time(),
+                         error={"status_code": 503, "detail": "Server shutting down"})
+            self._release(len(image_data))
+            self._queue.task_done()
+
+    async def submit(self, image_data: bytes, filename: str) -> Job:
+        self._expire_finished()
+        job = Job(id=uuid.uuid4().hex, filename=filename)
+        if self._queue.full() or (self.budget is not None and not self.budget.try_reserve(len(image_data))):
+            self.rejected += 1
+            raise JobQueueFull(self.retry_after())
+        self._held_bytes += len(image_data)
+        self._queue.put_nowait((job, image_data, contextvars.copy_context()))
+        self._jobs[job.id] = job
+        self._changed[job.id] = asyncio.Event()
+        self.submitted += 1
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def subscribe(self, job_id: str) -> AsyncIterator[Job]:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        seen = -1
+        while True:
+            if job.version != seen:
+                seen = job.version
+                yield job
+                if job.status in TERMINAL_STATUSES:
+                    return
+            changed = self._changed.get(job_id)
+            if changed is None:
+                return
+            await changed.wait()
+
+    def retry_after(self) -> int:
+        """Seconds until a queue slot is likely to free up"""
+        backlog = self._queue.qsize() + self._running
+        return max(1, int(self._avg_duration_s * backlog / max(1, self.workers)))
+
+    async def _worker(self) -> None:
+        while True:
+            job, image_data, context = await self._queue.get()
+            self._running += 1
+            self._update(job, status="running", started_at=time.time())
+            try:
+                # Runs in (a copy of) the submitter's context; create_task(context=) needs Python 3.11
+                result = await context.run(asyncio.create_task, self.handler(image_data, job.filename))
+                self._update(job, status="succeeded", result=result, finished_at=time.time())
+                self.completed += 1
+            except asyncio.CancelledError:
+                self._update(job, status="failed", finished_at=time.time(),
+                             error={"status_code": 503, "detail": "Server shutting down"})
+                raise
+            except HTTPException as e:
+                self._update(job, status="failed", finished_at=time.time(),
+                             error={"status_code": e.status_code, "detail": e.detail})
+                self.failed += 1
+            except Exception as e:
+                self._update(job, status="failed", finished_at=time.time(),
+                             error={"status_code": 500, "detail": str(e)})
+                self.failed += 1
+            finally:
+                self._running -= 1
+                self._release(len(image_data))
+                self._queue.task_done()
+                duration = (job.finished_at or time.time()) - (job.started_at or time.time())
+                # Exponential moving average of job duration, for Retry-After estimates
+                self._avg_duration_s = 0.8 * self._avg_duration_s + 0.2 * duration
+
+    def _release(self, size: int) -> None:
+        self._held_bytes -= size
+        if self.budget is not None:
+            self.budget.release(size)
+
+    def _update(self, job: Job, **changes: Any) -> None:
+        for name, value in changes.items():
+            setattr(job, name, value)
+        job.version += 1
+        # Wake current subscribers and arm a fresh event for the next change
+        changed = self._changed.get(job.id)
+        if changed is not None:
+            changed.set()
+        if job.status not in TERMINAL_STATUSES:
+            self._changed[job.id] = asyncio.Event()
+
+    def _expire_finished(self) -> None:
+        cutoff = time.time() - self.result_ttl_seconds
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished_at is not None and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+            self._changed.pop(job_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "workers": self.workers,
+            "queued": self._queue.qsize(),
+            "max_queued": self.max_queued,
+            "held_bytes": self._held_bytes,
+            "running": self._running,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_duration_s": round(self._avg_duration_s, 2),
+        }
+
+
+def create_job_queue(backend: str, handler: JobHandler, **options: Any) -> JobQueue:
+    """Build the configured job queue implementation"""
+    if backend == "memory":
+        return InMemoryJobQueue(handler, **options)
+    raise ValueError(f"Unknown job queue backend: {backend}")
@@ -0,0 +1,332 @@
+import asyncio
+import functools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelKey = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, Any]) -> LabelKey:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self, values: Optional[Dict[LabelKey, Any]] = None) -> List[str]:
+        values = self.collect() if values is None else values
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"] + self.samples(values)
+
+    def collect(self) -> Dict[LabelKey, Any]:
+        """Current value per label set"""
+        raise NotImplementedError
+
+    def samples(self, values: Dict[LabelKey, Any]) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+    @staticmethod
+    def merge(first: Any, second: Any) -> Any:
+        """Combine the values of one label set from two worker processes"""
+        return first + second
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def collect(self) -> Dict[LabelKey, float]:
+        return dict(self.values)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: per-bucket (non-cumulative) counts, then sum and count
+        self.values: Dict[LabelKey, List[float]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [0.0] * (len(self.buckets) + 3)
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[position] += 1
+                break
+        else:
+            state[len(self.buckets)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def collect(self) -> Dict[LabelKey, List[float]]:
+        return {key: list(state) for key, state in self.values.items()}
+
+    @staticmethod
+    def merge(first: List[float], second: List[float]) -> List[float]:
+        return [a + b for a, b in zip(first, second)]
+
+    def samples(self, values: Dict[LabelKey, List[float]]) -> List[str]:
+        lines = []
+        for key, state in sorted(values.items()):
+            cumulative = 0.0
+            for position, bound in enumerate(self.buckets + (float("inf"),)):
+                cumulative += state[position]
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {_format_value(cumulative)}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {_format_value(state[-1])}")
+        return lines
+
+
+class GaugeCallback(_Metric):
+    """Gauge read at scrape time from a callback returning a value, or {label values: value}"""
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], Union[Optional[float], Dict[LabelKey, Optional[float]]]],
+        labelnames: Sequence[str] = (),
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def collect(self) -> Dict[LabelKey, float]:
+        try:
+            value = self.callback()
+        except Exception as e:
+            print(f"Metric {self.name} callback failed: {e}")
+            return {}
+        values = value if isinstance(value, dict) else {(): value}
+        return {key: sample for key, sample in values.items() if sample is not None}
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        # Re-registering a name replaces it, so app restarts in one process don't duplicate gauges
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge_callback(
+        self, name: str, documentation: str, callback: Callable[[], Any], labelnames: Sequence[str] = ()
+    ) -> GaugeCallback:
+        return self.register(GaugeCallback(name, documentation, callback, labelnames))
+
+    def snapshot(self) -> Dict[str, Dict[str, list]]:
+        """JSON-serialisable values, for other worker processes to add to their scrapes"""
+        snapshot: Dict[str, Dict[str, list]] = {"values": {}, "gauges": {}}
+        for metric in self._metrics.values():
+            section = "gauges" if isinstance(metric, GaugeCallback) else "values"
+            snapshot[section][metric.name] = [[list(key), value] for key, value in metric.collect().items()]
+        return snapshot
+
+    def render(self, others: Sequence[Dict[str, Dict[str, list]]] = ()) -> str:
+        """Prometheus text exposition format; others are snapshots of other workers, summed in"""
+        lines = []
+        for metric in self._metrics.values():
+            values = metric.collect()
+            for snapshot in others:
+                for section in ("values", "gauges"):
+                    for key, value in snapshot.get(section, {}).get(metric.name, []):
+                        key = tuple(key)
+                        values[key] = metric.merge(values[key], value) if key in values else value
+            lines.extend(metric.render(values))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "crop_analyzer_stage_seconds", "Time spent per analysis stage", ["stage"]
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "crop_analyzer_http_request_seconds", "HTTP request duration until the response starts", ["method", "path"]
+)
+REQUESTS = REGISTRY.counter(
+    "crop_analyzer_http_requests_total", "HTTP responses by status", ["method", "path", "status"]
+)
+UPSTREAM_TOKENS = REGISTRY.counter(
+    "crop_analyzer_upstream_tokens_total", "Tokens reported in OpenRouter usage", ["model", "type"]
+)
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "crop_analyzer_upstream_errors_total", "Failed OpenRouter calls by status", ["model", "status"]
+)
+PARSE_FAILURES = REGISTRY.counter(
+    "crop_analyzer_parse_failures_total", "Model answers without a usable analysis", ["mode"]
+)
+DETAIL_PROMPT_TOKENS = REGISTRY.counter(
+    "crop_analyzer_detail_prompt_tokens_total", "Prompt tokens of single-image calls by image detail level", ["detail"]
+)
+DETAIL_UPSTREAM_SECONDS = REGISTRY.histogram(
+    "crop_analyzer_detail_upstream_seconds", "Single-image upstream call duration by image detail level", ["detail"]
+)
+DETAIL_ESCALATIONS = REGISTRY.counter(
+    "crop_analyzer_detail_escalations_total", "Low-detail answers asked again in high detail", ["reason"]
+)
+CANCELLED_REQUESTS = REGISTRY.counter(
+    "crop_analyzer_cancelled_requests_total",
+    "Analyses abandoned because the client disconnected or its deadline passed, by stage reached",
+    ["reason", "stage"],
+)
+CANCELLED_SECONDS = REGISTRY.counter(
+    "crop_analyzer_cancelled_seconds_total", "Time spent on analyses that were then abandoned", ["reason"]
+)
+SCHEDULER_WAIT_SECONDS = REGISTRY.histogram(
+    "crop_analyzer_scheduler_wait_seconds", "Time upstream calls waited for a slot, by priority lane", ["lane"]
+)
+EVENT_LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "crop_analyzer_event_loop_lag_seconds", "How late the event loop woke a periodic timer",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
+# Stage durations (ms) of the current request, for the Server-Timing header
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+
+
+def record_stage(name: str, seconds: float) -> None:
+    STAGE_SECONDS.observe(seconds, stage=name)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds * 1000
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time a block as an analysis stage; works around awaits too"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def timed(name: str) -> Callable:
+    """Decorator timing every call of an async function as a stage"""
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with stage(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def monitor_event_loop_lag(interval_s: float) -> None:
+    """Sleep in a loop and record how much later than requested each wake-up came"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval_s)
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - start - interval_s))
+
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    return ", ".join(f"{name};dur={duration:.1f}" for name, duration in timings.items())
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware recording request duration and responses by status, labelled
+    by route template. With server_timing, per-stage durations collected while the
+    request ran are sent in a Server-Timing header (stages finished before the response
+    starts; for streamed responses that is only the upload).
+    """
+
+    def __init__(self, app: ASGIApp, server_timing: bool = False):
+        self.app = app
+        self.server_timing = server_timing
+        self._route_paths: Optional[set] = None
+
+    def _path_label(self, scope: Scope) -> str:
+        route = scope.get("route")
+        if route is not None and hasattr(route, "path"):
+            return route.path
+        # Rejected before routing (e.g. by the upload limiter): keep exact static paths only
+        if self._route_paths is None and scope.get("app") is not None:
+            self._route_paths = {getattr(r, "path", None) for r in scope["app"].routes}
+        return scope["path"] if scope["path"] in (self._route_paths or ()) else "other"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        timings: Dict[str, float] = {}
+        token = _request_timings.set(timings)
+        status = 500
+
+        async def send_with_metrics(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                elapsed = time.perf_counter() - start
+                REQUEST_SECONDS.observe(elapsed, method=scope["method"], path=self._path_label(scope))
+                if self.server_timing:
+                    timings["total"] = elapsed * 1000
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", server_timing_header(timings).encode("latin-1")))
+                    message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            _request_timings.reset(token)
+            REQUESTS.inc(method=scope["method"], path=self._path_label(scope), status=str(status))
@@ -0,0 +1,217 @@
+import heapq
+import io
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+HASH_BITS = 64
+
+if hasattr(int, "bit_count"):
+    def popcount(value: int) -> int:
+        return value.bit_count()
+else:  # Python < 3.10
+    def popcount(value: int) -> int:
+        return bin(value).count("1")
+
+
+# Mean absolute difference between neighbouring thumbnail pixels (grey levels) below which an
+# image is too flat for its hash to identify it: flat images of any colour hash to (nearly) 0
+MIN_MEAN_GRADIENT = 2.0
+# Hashes with fewer set (or unset) bits than this carry too little structure to be told apart
+MIN_BALANCE_BITS = 4
+
+
+def image_signature(image_data: bytes, hash_size: int = 8) -> Optional[Tuple[int, int]]:
+    """
+    (dHash, mean color) of encoded image bytes, see signature_from_image.
+    Returns None if the bytes cannot be decoded or the image is too flat to be identified by its hash.
+    """
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        # JPEG draft mode decodes at a reduced scale, which is much faster for large photos
+        image.draft("RGB", (hash_size * 8, hash_size * 8))
+        image = ImageOps.exif_transpose(image)
+        return signature_from_image(image, hash_size)
+    except Exception:
+        return None
+
+
+def signature_from_image(image: Image.Image, hash_size: int = 8) -> Optional[Tuple[int, int]]:
+    """
+    64-bit difference hash of an image (the sign of the horizontal gradient on a 9x8
+    grayscale thumbnail, robust to resizing and recompression) and its mean color
+    packed as 0xRRGGBB, which tells apart images whose structure is alike.
+    None if the image has too little structure for the hash to identify it.
+    """
+    thumbnail = image.convert("RGB").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    phash = dhash_from_thumbnail(list(thumbnail.convert("L").getdata()), hash_size)
+    if phash is None:
+        return None
+    red, green, blue = thumbnail.resize((1, 1), Image.BOX).getpixel((0, 0))
+    return phash, (red << 16) | (green << 8) | blue
+
+
+def dhash_from_thumbnail(pixels: List[int], hash_size: int = 8) -> Optional[int]:
+    """
+    dHash bits from the row-major pixels of a (hash_size + 1) x hash_size grayscale image;
+    None if the image is too flat or its hash too uniform to identify it
+    """
+    value = 0
+    gradient = 0
+    width = hash_size + 1
+    for row in range(hash_size):
+        offset = row * width
+        for col in range(hash_size):
+            left, right = pixels[offset + col], pixels[offset + col + 1]
+            value = (value << 1) | (left > right)
+            gradient += abs(left - right)
+    bits = hash_size * hash_size
+    ones = popcount(value)
+    if gradient / bits < MIN_MEAN_GRADIENT or min(ones, bits - ones) < MIN_BALANCE_BITS:
+        return None
+    return value
+
+
+def color_distance(a: int, b: int) -> int:
+    """Largest per-channel difference between two 0xRRGGBB colors"""
+    return max(abs(((a >> shift) & 0xFF) - ((b >> shift) & 0xFF)) for shift in (16, 8, 0))
+
+
+class HammingIndex:
+    """
+    Multi-index hashing over 64-bit hashes.
+
+    Each hash is split into 4 chunks of 16 bits with one table per chunk. By the
+    pigeonhole principle, two hashes within distance d agree on at least one chunk
+    up to d // 4 bits, so a query only probes the chunk neighbourhoods and verifies
+    the few candidates found there. Buckets are compact arrays, so millions of
+    hashes fit in memory. Entries added with an expiry are dropped once it passes,
+    so the index only holds what the cache still holds. Searches given a color only
+    match entries added with a color within max_color_distance of it.
+    """
+
+    CHUNKS = 4
+    CHUNK_BITS = HASH_BITS // CHUNKS
+    CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+    def __init__(self, max_distance: int = 6, max_color_distance: int = 24):
+        self.max_distance = max_distance
+        self.max_color_distance = max_color_distance
+        self._tables: List[Dict[int, array]] = [{} for _ in range(self.CHUNKS)]
+        self._values: Dict[int, List[str]] = {}
+        self._colors: Dict[Tuple[int, str], int] = {}
+        # (expires_at, hash, value), soonest first
+        self._expiry: List[Tuple[float, int, str]] = []
+        self._neighbour_masks = self._masks_within(max_distance // self.CHUNKS)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def _masks_within(self, radius: int) -> List[int]:
+        """All chunk XOR masks with at most `radius` bits set"""
+        masks = [0]
+        frontier = [0]
+        for _ in range(radius):
+            next_frontier = []
+            for mask in frontier:
+                top = mask.bit_length()
+                for bit in range(top, self.CHUNK_BITS):
+                    next_frontier.append(mask | (1 << bit))
+            masks.extend(next_frontier)
+            frontier = next_frontier
+        return masks
+
+    def add(
+        self, hash_value: int, value: str, expires_at: Optional[float] = None, color: Optional[int] = None
+    ) -> None:
+        """
+        Index value under hash_value (and the image's mean color, if given); with expires_at,
+        it is removed once that (wall-clock) time passes
+        """
+        self.expire()
+        values = self._values.get(hash_value)
+        if values is not None:
+            if value in values:
+                # Already indexed, keeps the expiry it was first added with
+                return
+            values.append(value)
+        else:
+            self._values[hash_value] = [value]
+            for i, table in enumerate(self._tables):
+                chunk = (hash_value >> (i * self.CHUNK_BITS)) & self.CHUNK_MASK
+                bucket = table.get(chunk)
+                if bucket is None:
+                    table[chunk] = array("Q", [hash_value])
+                else:
+                    bucket.append(hash_value)
+        if color is not None:
+            self._colors[(hash_value, value)] = color
+        if expires_at is not None:
+            heapq.heappush(self._expiry, (expires_at, hash_value, value))
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Remove the entries whose expiry has passed, returning how many"""
+        if now is None:
+            now = time.time()
+        removed = 0
+        while self._expiry and self._expiry[0][0] <= now:
+            _expires_at, hash_value, value = heapq.heappop(self._expiry)
+            removed += self.remove(hash_value, value)
+        return removed
+
+    def remove(self, hash_value: int, value: str) -> bool:
+        values = self._values.get(hash_value)
+        if values is None or value not in values:
+            return False
+        values.remove(value)
+        self._colors.pop((hash_value, value), None)
+        if values:
+            return True
+        del self._values[hash_value]
+        for i, table in enumerate(self._tables):
+            chunk = (hash_value >> (i * self.CHUNK_BITS)) & self.CHUNK_MASK
+            bucket = table[chunk]
+            bucket.remove(hash_value)
+            if not bucket:
+                del table[chunk]
+        return True
+
+    def search(
+        self, hash_value: int, max_distance: Optional[int] = None, color: Optional[int] = None
+    ) -> List[Tuple[int, int, str]]:
+        """
+        Return (distance, stored_hash, value) tuples within max_distance, nearest first;
+        with color, only entries whose color is within max_color_distance of it
+        """
+
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+        masks = self._neighbour_masks
+
+        seen = set()
+        matches = []
+        for i, table in enumerate(self._tables):
+            chunk = (hash_value >> (i * self.CHUNK_BITS)) & self.CHUNK_MASK
+            for mask in masks:
+                bucket = table.get(chunk ^ mask)
+                if bucket is None:
+                    continue
+                for candidate in bucket:
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+                    distance = popcount(candidate ^ hash_value)
+                    if distance <= max_distance:
+                        matches.extend(
+                            (distance, candidate, value) for value in self._values[candidate]
+                            if color is None or self._color_matches(candidate, value, color)
+                        )
+
+        matches.sort()
+        return matches
+
+    def _color_matches(self, hash_value: int, value: str, color: int) -> bool:
+        stored = self._colors.get((hash_value, value))
+        return stored is not None and color_distance(stored, color) <= self.max_color_distance
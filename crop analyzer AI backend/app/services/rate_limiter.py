@@ -0,0 +1,355 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, Dict, Optional, Set, Union
+
+from app.services.shared_state import SharedState
+
+if TYPE_CHECKING:
+    from app.services.scheduler import FairScheduler
+
+
+def parse_retry_after(value: Optional[str], default: float = 1.0) -> float:
+    """Retry-After as seconds; accepts delta-seconds or an HTTP date"""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+def _write_behind(pending: Set["asyncio.Task[Any]"], fn: Callable[..., Any], *args: Any) -> None:
+    """
+    Run a blocking shared-state write in a thread without waiting for it, so neither
+    the event loop nor the caller is held up by SQLite; pending keeps the task alive
+    """
+    task = asyncio.get_running_loop().create_task(asyncio.to_thread(fn, *args))
+    pending.add(task)
+
+    def done(task: "asyncio.Task[Any]") -> None:
+        pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Shared-state write failed: {task.exception()}")
+
+    task.add_done_callback(done)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at rate_per_minute, holding at most capacity.
+    Waiters are served in FIFO order. A request larger than the capacity is let
+    through once the bucket is full, and actual usage can be settled afterwards,
+    leaving the bucket in debt.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate_per_second)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1.0) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= min(amount, self.capacity):
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((min(amount, self.capacity) - self.tokens) / self.rate_per_second)
+
+    def settle(self, delta: float) -> None:
+        """Correct an earlier estimate once the real cost is known (positive = used more)"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+
+class SharedTokenBucket:
+    """
+    TokenBucket whose level lives in SharedState, so every worker process draws from
+    one budget. Waiters within a process are still served in FIFO order; the level is
+    refilled from wall-clock time, which all processes agree on. SQLite is only
+    touched from threads: settle() writes behind, available() reports the level
+    this process last saw.
+    """
+
+    def __init__(self, state: SharedState, name: str, rate_per_minute: float, capacity: Optional[float] = None):
+        self.state = state
+        self.name = name
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._lock = asyncio.Lock()
+        # (tokens, updated_at) as of this process's last read or write
+        self._seen = (self.capacity, time.time())
+        self._writes: Set["asyncio.Task[Any]"] = set()
+
+    def _level(self, db: Any, now: float) -> float:
+        row = db.execute("SELECT tokens, updated_at FROM token_buckets WHERE name = ?", (self.name,)).fetchone()
+        if row is None:
+            return self.capacity
+        return min(self.capacity, row[0] + max(0.0, now - row[1]) * self.rate_per_second)
+
+    def _store(self, db: Any, tokens: float, now: float) -> None:
+        db.execute(
+            "INSERT OR REPLACE INTO token_buckets (name, tokens, updated_at) VALUES (?, ?, ?)", (self.name, tokens, now)
+        )
+        self._seen = (tokens, now)
+
+    def _take(self, amount: float) -> float:
+        """Take amount if available; otherwise return how long to wait before trying again"""
+        with self.state.transaction() as db:
+            now = time.time()
+            tokens = self._level(db, now)
+            needed = min(amount, self.capacity)
+            if tokens < needed:
+                self._seen = (tokens, now)
+                return (needed - tokens) / self.rate_per_second
+            self._store(db, tokens - amount, now)
+            return 0.0
+
+    async def acquire(self, amount: float = 1.0) -> None:
+        async with self._lock:
+            while True:
+                wait = await asyncio.to_thread(self._take, amount)
+                if wait <= 0:
+                    return
+                await asyncio.sleep(wait)
+
+    def _settle(self, delta: float) -> None:
+        with self.state.transaction() as db:
+            now = time.time()
+            self._store(db, min(self.capacity, self._level(db, now) - delta), now)
+
+    def settle(self, delta: float) -> None:
+        _write_behind(self._writes, self._settle, delta)
+
+    def available(self) -> float:
+        tokens, updated_at = self._seen
+        return min(self.capacity, tokens + max(0.0, time.time() - updated_at) * self.rate_per_second)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD concurrency limit: grows by roughly one slot per window of healthy
+    calls, and shrinks multiplicatively on a rate-limit response or a latency
+    spike against the smoothed baseline. Decreases are spaced out so one burst
+    of failures only counts once.
+    """
+
+    def __init__(
+        self,
+        initial: int = 8,
+        minimum: int = 1,
+        maximum: int = 64,
+        backoff_ratio: float = 0.5,
+        latency_backoff_ratio: float = 0.9,
+        latency_spike_factor: float = 2.0,
+        decrease_interval_s: float = 1.0,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff_ratio = backoff_ratio
+        self.latency_backoff_ratio = latency_backoff_ratio
+        self.latency_spike_factor = latency_spike_factor
+        self.decrease_interval_s = decrease_interval_s
+        self.in_flight = 0
+        self.baseline_latency_s: Optional[float] = None
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self, latency_s: float) -> None:
+        if self.baseline_latency_s is None:
+            self.baseline_latency_s = latency_s
+        if latency_s > self.baseline_latency_s * self.latency_spike_factor:
+            self._decrease(self.latency_backoff_ratio)
+        else:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+        # Slow-moving baseline so a sustained slowdown keeps registering as spikes for a while
+        self.baseline_latency_s = 0.95 * self.baseline_latency_s + 0.05 * latency_s
+
+    def on_rate_limited(self) -> None:
+        self._decrease(self.backoff_ratio)
+
+    def _decrease(self, ratio: float) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self.decrease_interval_s:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.minimum), self.limit * ratio)
+
+
+class Permit:
+    """One admitted upstream call; report its outcome before leaving the limiter"""
+
+    def __init__(self, limiter: "UpstreamLimiter", estimated_tokens: float):
+        self.limiter = limiter
+        self.estimated_tokens = estimated_tokens
+        self.started = time.monotonic()
+
+    def succeeded(self, total_tokens: Optional[float] = None) -> None:
+        self.limiter._on_success(self, total_tokens)
+
+    def settle(self, total_tokens: Optional[float]) -> None:
+        """Correct the token estimate of a call that succeeded before its usage was known"""
+        self.limiter._settle(self, total_tokens)
+
+    def rate_limited(self, retry_after_s: float) -> None:
+        self.limiter._on_rate_limited(retry_after_s)
+
+
+class UpstreamLimiter:
+    """
+    Shared gate in front of every OpenRouter call: requests-per-minute and
+    tokens-per-minute buckets (each optional) plus an AIMD concurrency limit.
+    A 429 pauses all new calls for its Retry-After and halves the concurrency limit.
+    With shared state the buckets and the pause span all worker processes; the
+    concurrency limit stays per process. With a scheduler, concurrency slots are
+    handed out by priority lane and tenant instead of first come, first served,
+    and are taken before the buckets so the lanes also order rate-limited calls.
+    Shared state is read and written from threads, never on the event loop.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        concurrency: Optional[AdaptiveConcurrencyLimiter] = None,
+        shared: Optional[SharedState] = None,
+        scheduler: Optional["FairScheduler"] = None,
+    ):
+        self.shared = shared
+        self.scheduler = scheduler
+        self.request_bucket = self._bucket("upstream_requests", requests_per_minute)
+        self.token_bucket = self._bucket("upstream_tokens", tokens_per_minute)
+        self.concurrency = concurrency or AdaptiveConcurrencyLimiter()
+        self._paused_until = 0.0
+        # The shared pause as of this process's last read
+        self._shared_paused_until = 0.0
+        self._writes: Set["asyncio.Task[Any]"] = set()
+        self.waiting = 0
+        self.admitted = 0
+        self.rate_limited = 0
+
+    def _bucket(self, name: str, rate_per_minute: float) -> Union[TokenBucket, SharedTokenBucket, None]:
+        if rate_per_minute <= 0:
+            return None
+        if self.shared is not None:
+            return SharedTokenBucket(self.shared, name, rate_per_minute)
+        return TokenBucket(rate_per_minute)
+
+    @property
+    def paused_until(self) -> float:
+        """Wall-clock time until which new calls wait after a 429 (other workers' as last read)"""
+        return max(self._paused_until, self._shared_paused_until)
+
+    async def _wait_out_pause(self) -> None:
+        while True:
+            if self.shared is not None:
+                self._shared_paused_until = await asyncio.to_thread(self.shared.get_value, "upstream_paused_until")
+            remaining = self.paused_until - time.time()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+
+    @asynccontextmanager
+    async def permit(self, estimated_tokens: float = 0) -> AsyncIterator[Permit]:
+        self.waiting += 1
+        flow = None
+        holds_concurrency = False
+        try:
+            await self._wait_out_pause()
+            if self.scheduler is not None:
+                flow = await self.scheduler.acquire()
+            try:
+                if self.request_bucket is not None:
+                    await self.request_bucket.acquire(1)
+                if self.token_bucket is not None and estimated_tokens:
+                    await self.token_bucket.acquire(estimated_tokens)
+                if self.scheduler is None:
+                    await self.concurrency.acquire()
+                    holds_concurrency = True
+                # A 429 (here or in another worker) may have paused upstream while this call
+                # queued; keep the slot and check again right before handing out the permit
+                await self._wait_out_pause()
+            except BaseException:
+                if flow is not None:
+                    self.scheduler.release(flow)
+                elif holds_concurrency:
+                    await self.concurrency.release()
+                raise
+        finally:
+            self.waiting -= 1
+
+        self.admitted += 1
+        try:
+            yield Permit(self, estimated_tokens)
+        finally:
+            if flow is not None:
+                self.scheduler.release(flow)
+            else:
+                await self.concurrency.release()
+
+    def _on_success(self, permit: Permit, total_tokens: Optional[float]) -> None:
+        self.concurrency.on_success(time.monotonic() - permit.started)
+        self._settle(permit, total_tokens)
+
+    def _settle(self, permit: Permit, total_tokens: Optional[float]) -> None:
+        if self.token_bucket is not None and total_tokens is not None:
+            self.token_bucket.settle(total_tokens - permit.estimated_tokens)
+
+    async def flush(self) -> None:
+        """Wait for shared-state writes still in flight (before the shared state is closed)"""
+        pending = set(self._writes)
+        for bucket in (self.request_bucket, self.token_bucket):
+            if isinstance(bucket, SharedTokenBucket):
+                pending |= bucket._writes
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def _on_rate_limited(self, retry_after_s: float) -> None:
+        self.rate_limited += 1
+        self._paused_until = max(self._paused_until, time.time() + retry_after_s)
+        if self.shared is not None:
+            _write_behind(self._writes, self.shared.raise_value, "upstream_paused_until", self._paused_until)
+        self.concurrency.on_rate_limited()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "concurrency_limit": int(self.concurrency.limit),
+            "in_flight": self.concurrency.in_flight,
+            "queue_depth": self.waiting,
+            "baseline_latency_ms": round(self.concurrency.baseline_latency_s * 1000)
+            if self.concurrency.baseline_latency_s is not None else None,
+            "requests_available": round(self.request_bucket.available(), 1) if self.request_bucket else None,
+            "tokens_available": round(self.token_bucket.available()) if self.token_bucket else None,
+            "paused_for_s": round(max(0.0, self.paused_until - time.time()), 2),
+            "shared": self.shared is not None,
+            "admitted": self.admitted,
+            "rate_limited": self.rate_limited,
+        }
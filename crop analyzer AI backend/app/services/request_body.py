@@ -0,0 +1,81 @@
+import base64
+import json
+import secrets
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, List
+
+from app.services.metrics import record_stage
+
+# Raw bytes per base64 chunk; a multiple of 3 so chunks encode without padding
+DEFAULT_CHUNK_SIZE = 48 * 1024
+
+
+@dataclass(frozen=True)
+class ImageData:
+    """An image placed in a request as a data URL, base64-encoded while the body is sent"""
+    data: bytes
+    mime_type: str
+
+
+class StreamedJSONBody:
+    """
+    JSON request body whose images are never materialised as base64 strings.
+
+    The payload is serialised once with a placeholder per ImageData, then split into
+    precomputed JSON segments. Iterating the body yields those segments with each
+    image base64-encoded in small chunks straight from a memoryview of its bytes, so
+    a request holds the raw image plus one chunk instead of several full copies.
+    The body can be iterated again (retries, hedged requests) and has a known
+    length, so it is sent with Content-Length rather than chunked. prefix and
+    suffix are pre-encoded JSON placed around the payload (see RequestTemplate).
+    """
+
+    def __init__(self, payload: Any, chunk_size: int = DEFAULT_CHUNK_SIZE, prefix: bytes = b"", suffix: bytes = b""):
+        self.chunk_size = max(3, chunk_size - chunk_size % 3)
+        self.images: List[ImageData] = []
+        marker = f"@@image-{secrets.token_hex(8)}@@"
+        template = json.dumps(self._replace_images(payload, marker), ensure_ascii=False, separators=(",", ":"))
+
+        pieces = template.split(marker)
+        # Segment i precedes image i and ends with the data URL prefix of that image
+        self.segments = [
+            (piece + f"data:{json.dumps(image.mime_type)[1:-1]};base64,").encode("utf-8")
+            for piece, image in zip(pieces, self.images)
+        ]
+        self.segments.append(pieces[-1].encode("utf-8") + suffix)
+        self.segments[0] = prefix + self.segments[0]
+        self.content_length = sum(len(segment) for segment in self.segments) + sum(
+            4 * ((len(image.data) + 2) // 3) for image in self.images
+        )
+
+    def _replace_images(self, value: Any, marker: str) -> Any:
+        if isinstance(value, ImageData):
+            self.images.append(value)
+            return marker
+        if isinstance(value, dict):
+            return {key: self._replace_images(item, marker) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._replace_images(item, marker) for item in value]
+        return value
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for segment, image in zip(self.segments, self.images):
+            yield segment
+            view = memoryview(image.data)
+            encode_s = 0.0
+            for offset in range(0, len(view), self.chunk_size):
+                start = time.perf_counter()
+                chunk = base64.b64encode(view[offset:offset + self.chunk_size])
+                encode_s += time.perf_counter() - start
+                yield chunk
+            record_stage("base64_encode", encode_s)
+        yield self.segments[-1]
+
+    def to_bytes(self) -> bytes:
+        """The whole body at once (for debugging and tests; defeats the purpose otherwise)"""
+        parts = []
+        for segment, image in zip(self.segments, self.images):
+            parts.extend((segment, base64.b64encode(image.data)))
+        parts.append(self.segments[-1])
+        return b"".join(parts)
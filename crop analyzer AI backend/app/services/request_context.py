@@ -0,0 +1,131 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Iterator, Optional, TypeVar
+
+from fastapi import HTTPException, Request
+
+from app.services.metrics import CANCELLED_REQUESTS, CANCELLED_SECONDS
+
+T = TypeVar("T")
+
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+
+# Status for work abandoned because the client went away (nginx convention; nobody reads it)
+CLIENT_CLOSED_REQUEST = 499
+
+
+class DeadlineExceeded(HTTPException):
+    """The caller's deadline passed, or will have passed before an upstream answer could arrive"""
+
+    def __init__(self):
+        super().__init__(status_code=504, detail="Request deadline cannot be met")
+
+
+@dataclass
+class RequestContext:
+    """What the analysis needs to know about the request it is serving"""
+    # time.monotonic() by which the caller needs the answer, None = no deadline
+    deadline: Optional[float] = None
+    # "queued" until a request has been sent upstream, then "upstream"
+    stage: str = "queued"
+    started: float = field(default_factory=time.perf_counter)
+
+    def cancelled(self, reason: str) -> None:
+        CANCELLED_REQUESTS.inc(reason=reason, stage=self.stage)
+        CANCELLED_SECONDS.inc(time.perf_counter() - self.started, reason=reason)
+
+    def remaining_s(self) -> Optional[float]:
+        return self.deadline - time.monotonic() if self.deadline is not None else None
+
+
+_current: ContextVar[Optional[RequestContext]] = ContextVar("request_context", default=None)
+
+
+def current_context() -> Optional[RequestContext]:
+    return _current.get()
+
+
+@contextmanager
+def serving(context: Optional[RequestContext]) -> Iterator[None]:
+    """Work started inside the block (and tasks created in it) is done for `context`"""
+    token = _current.set(context)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def parse_deadline(value: Optional[str]) -> Optional[float]:
+    """X-Request-Deadline-Ms is the caller's remaining budget in milliseconds (relative, so clocks need not agree)"""
+    if value is None or not value.strip():
+        return None
+    try:
+        budget_ms = float(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{DEADLINE_HEADER} must be a number of milliseconds")
+    return time.monotonic() + budget_ms / 1000
+
+
+def check_deadline(expected_s: float = 0.0) -> None:
+    """
+    Called right before an upstream request is sent: raise DeadlineExceeded instead of
+    spending quota on an answer that would arrive after the caller gave up.
+    """
+    context = _current.get()
+    if context is None:
+        return
+    remaining = context.remaining_s()
+    if remaining is not None and remaining < expected_s:
+        context.cancelled("deadline")
+        raise DeadlineExceeded()
+    context.stage = "upstream"
+
+
+async def _wait_for_disconnect(request: Request) -> None:
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def run_cancellable(request: Request, fn: Callable[[], Awaitable[T]], watch_disconnect: bool = True) -> T:
+    """
+    Run fn() for a request and cancel it as soon as the client disconnects
+    (watch_disconnect; only once the body has been read) or its deadline passes.
+    Cancelling reaches the upstream call: a queued call never takes a slot, an
+    in-flight one has its connection closed. Shared (single-flight) work keeps
+    running for other waiters. Cancellations are counted by reason and by stage
+    reached, with the time already spent on them.
+    """
+
+    context = RequestContext(deadline=parse_deadline(request.headers.get(DEADLINE_HEADER)))
+    with serving(context):
+        # The task copies the current context, so the analysis sees this request's deadline
+        task = asyncio.ensure_future(fn())
+    watcher = asyncio.create_task(_wait_for_disconnect(request)) if watch_disconnect else None
+    reason = "disconnect"
+    try:
+        done, _pending = await asyncio.wait(
+            [task] + ([watcher] if watcher is not None else []),
+            timeout=context.remaining_s(),
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        if task in done:
+            return task.result()
+        if watcher is None or watcher not in done:
+            reason = "deadline"
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        if not task.done():
+            # Reached on disconnect, deadline, or when this request itself was cancelled
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            context.cancelled(reason)
+
+    if reason == "deadline":
+        raise DeadlineExceeded()
+    raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
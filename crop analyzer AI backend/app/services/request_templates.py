@@ -0,0 +1,81 @@
+import hashlib
+import json
+from dataclasses import dataclass
+from typing import Any, Dict, List
+
+from app.services.request_body import StreamedJSONBody
+from app.services.resilience import UpstreamTarget
+
+# Providers that only cache prompt prefixes marked with cache_control. OpenAI, DeepSeek
+# and others cache long prefixes automatically, so the marker is left out for them.
+CACHE_CONTROL_MODEL_PREFIXES = ("anthropic/", "google/gemini")
+
+
+def prompt_version(revision: str, *prompts: str) -> str:
+    """Manual revision plus a hash of the prompt text, so editing a prompt changes the version by itself"""
+    digest = hashlib.sha256("\0".join(prompts).encode("utf-8")).hexdigest()[:12]
+    return f"{revision}-{digest}"
+
+
+def supports_cache_control(model: str) -> bool:
+    return model.startswith(CACHE_CONTROL_MODEL_PREFIXES)
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+@dataclass(frozen=True)
+class RequestTemplate:
+    """
+    The static part of one kind of completion request for one model, serialised once:
+    headers, model and sampling options, and the system message. Only the user
+    message and max_tokens are added per call.
+    """
+    model: str
+    url: str
+    headers: Dict[str, str]
+    stream: bool
+    prompt_cache: bool
+    prefix: bytes
+
+    def body(self, user_content: List[Dict[str, Any]], max_tokens: int) -> StreamedJSONBody:
+        return StreamedJSONBody(
+            {"role": "user", "content": user_content},
+            prefix=self.prefix,
+            suffix=f'],"max_tokens":{int(max_tokens)}}}'.encode("utf-8"),
+        )
+
+
+def compile_template(
+    target: UpstreamTarget,
+    system_prompt: str,
+    headers: Dict[str, str],
+    stream: bool = False,
+    temperature: float = 0.1,
+    prompt_caching: bool = True,
+) -> RequestTemplate:
+    """Build the request template for a model; the system prompt is marked for caching where supported"""
+    prompt_cache = prompt_caching and supports_cache_control(target.model)
+    if prompt_cache:
+        system = {
+            "role": "system",
+            "content": [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}],
+        }
+    else:
+        system = {"role": "system", "content": system_prompt}
+
+    options: Dict[str, Any] = {"model": target.model, "temperature": temperature}
+    if stream:
+        options["stream"] = True
+    # '{"model":...,"messages":[{system},' -- the user message and max_tokens follow per call
+    prefix = f'{_dumps(options)[:-1]},"messages":[{_dumps(system)},'
+
+    return RequestTemplate(
+        model=target.model,
+        url=target.url,
+        headers=dict(headers),
+        stream=stream,
+        prompt_cache=prompt_cache,
+        prefix=prefix.encode("utf-8"),
+    )
@@ -0,0 +1,396 @@
+import asyncio
+import random
+import time
+from collections import deque
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, TypeVar
+
+from fastapi import HTTPException
+
+from app.services.request_context import DeadlineExceeded
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class UpstreamTarget:
+    """One model and the chat-completions endpoint that serves it"""
+    model: str
+    url: str
+
+
+def parse_targets(spec: str, default_url: str) -> List[UpstreamTarget]:
+    """
+    Parse an ordered, comma-separated model list. Each entry is either a model id
+    or `model@url` to send that model to a different endpoint.
+    """
+    targets = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        model, _, url = entry.partition("@")
+        targets.append(UpstreamTarget(model=model.strip(), url=url.strip() or default_url))
+    return targets
+
+
+# Upstream statuses worth another attempt besides 5xx: request timeout and rate limiting
+RETRYABLE_STATUSES = {408, 429}
+
+
+class UpstreamError(HTTPException):
+    """
+    A failed upstream call, answered to the client with status_code. upstream_status is
+    the provider's HTTP status (None for transport errors and failed streams), which
+    decides whether the call is retried and whether it counts against the breaker.
+    """
+
+    def __init__(
+        self,
+        status_code: int,
+        detail: str,
+        upstream_status: Optional[int] = None,
+        retry_after_s: Optional[float] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        super().__init__(status_code=status_code, detail=detail, headers=headers)
+        self.upstream_status = upstream_status
+        self.retry_after_s = retry_after_s
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Transport errors, 5xx, 408 and 429 are retried; other upstream 4xx (a bad key,
+    a rejected request) and missed deadlines are not
+    """
+    if isinstance(error, DeadlineExceeded):
+        return False
+    if isinstance(error, UpstreamError):
+        status = error.upstream_status
+        return status is None or status >= 500 or status in RETRYABLE_STATUSES
+    if isinstance(error, HTTPException):
+        return error.status_code >= 500
+    return isinstance(error, Exception)
+
+
+def is_breaker_failure(error: BaseException) -> bool:
+    """Failures that say the model is unhealthy; a 429 is about our quota, not the model"""
+    if isinstance(error, UpstreamError) and error.upstream_status == 429:
+        return False
+    return is_retryable(error)
+
+
+def backoff_delay(retry: int, base_s: float, max_s: float) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(max_s, base_s * (2 ** retry)))
+
+
+class CircuitBreaker:
+    """
+    Per-model breaker: opens after `failure_threshold` consecutive failures,
+    rejects calls for `reset_timeout_s`, then lets a single probe through
+    (half-open) and closes again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout_s: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        """Whether a call may be sent now; does not change state"""
+        if self.state == "closed":
+            return True
+        return not self._probe_in_flight and time.monotonic() - self.opened_at >= self.reset_timeout_s
+
+    def begin(self) -> None:
+        """A call is being sent; past the reset timeout it becomes the half-open probe"""
+        if self.state != "closed":
+            self.state = "half_open"
+            self._probe_in_flight = True
+
+    def abandon(self) -> None:
+        """The call ended without a verdict (cancelled or a client error)"""
+        self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                self.times_opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "times_opened": self.times_opened,
+        }
+
+
+class LatencyTracker:
+    """Sliding window of recent successful call latencies"""
+
+    def __init__(self, window: int = 200):
+        self.samples: deque = deque(maxlen=window)
+
+    def add(self, latency_s: float) -> None:
+        self.samples.append(latency_s)
+
+    def percentile(self, percentile: float, min_samples: int = 20) -> Optional[float]:
+        if len(self.samples) < min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+class _Attempts:
+    def __init__(self):
+        self.sent = 0
+
+
+class _Request:
+    """One upstream request of a call; it counts once it has actually been sent"""
+
+    def __init__(self, attempts: _Attempts, reports_sent: bool):
+        self.attempts = attempts
+        self.sent = asyncio.Event()
+        self.sent_at: Optional[float] = None
+        if not reports_sent:
+            self.mark_sent()
+
+    def mark_sent(self) -> None:
+        if self.sent_at is None:
+            self.sent_at = time.monotonic()
+            self.attempts.sent += 1
+            self.sent.set()
+
+
+_current_request: ContextVar[Optional[_Request]] = ContextVar("upstream_request", default=None)
+
+
+def request_sent() -> None:
+    """
+    Called by a send function once its request goes out, after any wait for a
+    rate-limit or concurrency slot (see ResilientCaller.call)
+    """
+    request = _current_request.get()
+    if request is not None:
+        request.mark_sent()
+
+
+class ResilientCaller:
+    """
+    Runs an upstream call against an ordered list of models with:
+    - retries with exponential backoff and full jitter on 5xx, 408, 429 and transport
+      errors (never sooner than a 429's Retry-After), moving on to the next model
+      after a failure
+    - a hedged duplicate request (to the next model, or the same one if it is the
+      only one) when the first has not answered within the model's latency percentile
+      of being sent (time queued for a rate-limit slot does not count)
+    - a circuit breaker per model, so a degraded model is skipped until it recovers;
+      only 5xx, timeouts and transport errors count against it
+    """
+
+    def __init__(
+        self,
+        targets: List[UpstreamTarget],
+        max_attempts: int = 3,
+        retry_base_delay_s: float = 0.5,
+        retry_max_delay_s: float = 8.0,
+        hedge_percentile: float = 95.0,
+        hedge_min_samples: int = 20,
+        breaker_failure_threshold: int = 5,
+        breaker_reset_timeout_s: float = 30.0,
+    ):
+        if not targets:
+            raise ValueError("At least one upstream model is required")
+        self.targets = targets
+        self.max_attempts = max(1, max_attempts)
+        self.retry_base_delay_s = retry_base_delay_s
+        self.retry_max_delay_s = retry_max_delay_s
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breakers = {
+            target.model: CircuitBreaker(breaker_failure_threshold, breaker_reset_timeout_s)
+            for target in targets
+        }
+        self.latencies = {target.model: LatencyTracker() for target in targets}
+        self.answered_by = {target.model: 0 for target in targets}
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failures = 0
+
+    async def call(
+        self, send: Callable[[UpstreamTarget], Awaitable[T]], reports_sent: bool = False
+    ) -> Tuple[T, UpstreamTarget, int]:
+        """
+        Run send(target) until one succeeds.
+        Returns (result, target that answered, upstream requests sent).
+        With reports_sent, send queues for a slot before its request goes out and calls
+        request_sent() when it does: latencies and the hedge timer start from there, and
+        a request still queued when the call ends is not counted as sent.
+        """
+
+        self.calls += 1
+        attempts = _Attempts()
+        failed: Set[str] = set()
+        last_error: Optional[BaseException] = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                delay = backoff_delay(attempt - 1, self.retry_base_delay_s, self.retry_max_delay_s)
+                retry_after = getattr(last_error, "retry_after_s", None) or 0.0
+                if retry_after > self.retry_max_delay_s:
+                    # Too long to hold the request: the client gets the 503 and its Retry-After
+                    break
+                self.retries += 1
+                await asyncio.sleep(max(delay, retry_after))
+            candidates = self._candidates(failed)
+            if not candidates:
+                break
+            try:
+                result, target = await self._attempt(send, candidates, attempts, reports_sent)
+            except Exception as e:
+                last_error = e
+                if not is_retryable(e):
+                    raise
+                failed.add(candidates[0].model)
+                continue
+            self.answered_by[target.model] += 1
+            return result, target, attempts.sent
+
+        self.failures += 1
+        if last_error is not None:
+            raise last_error
+        raise HTTPException(status_code=503, detail="All AI models are temporarily unavailable")
+
+    def _candidates(self, failed: Set[str]) -> List[UpstreamTarget]:
+        """Models whose breaker lets a call through, preferring ones not yet failed in this call"""
+        allowed = [target for target in self.targets if self.breakers[target.model].allow()]
+        fresh = [target for target in allowed if target.model not in failed]
+        return fresh or allowed
+
+    async def _attempt(
+        self,
+        send: Callable[[UpstreamTarget], Awaitable[T]],
+        candidates: List[UpstreamTarget],
+        attempts: _Attempts,
+        reports_sent: bool = False,
+    ) -> Tuple[T, UpstreamTarget]:
+        primary = candidates[0]
+        first = _Request(attempts, reports_sent)
+        tasks = {asyncio.create_task(self._send(send, primary, first)): primary}
+        hedge_task: Optional[asyncio.Task] = None
+        hedge_after = self._hedge_delay(primary)
+        error: Optional[BaseException] = None
+        try:
+            while tasks:
+                # The hedge timer starts once the first request has left the limiter's queue
+                sent_wait = None
+                timeout = None
+                if hedge_after is not None:
+                    if first.sent_at is None:
+                        sent_wait = asyncio.ensure_future(first.sent.wait())
+                    else:
+                        timeout = max(0.0, first.sent_at + hedge_after - time.monotonic())
+                try:
+                    done, _pending = await asyncio.wait(
+                        list(tasks) + ([sent_wait] if sent_wait is not None else []),
+                        timeout=timeout, return_when=asyncio.FIRST_COMPLETED,
+                    )
+                finally:
+                    if sent_wait is not None:
+                        sent_wait.cancel()
+                done = {task for task in done if task in tasks}
+                if not done:
+                    if sent_wait is not None:
+                        continue
+                    # The first request is slower than usual: race a second one against it
+                    hedge_target = candidates[1] if len(candidates) > 1 else primary
+                    hedge_task = asyncio.create_task(
+                        self._send(send, hedge_target, _Request(attempts, reports_sent))
+                    )
+                    tasks[hedge_task] = hedge_target
+                    self.hedges += 1
+                    hedge_after = None
+                    continue
+                for task in done:
+                    target = tasks.pop(task)
+                    if task.exception() is None:
+                        if task is hedge_task:
+                            self.hedge_wins += 1
+                        return task.result(), target
+                    error = task.exception()
+                # Keep waiting on the other request, but do not hedge after a fast failure
+                hedge_after = None
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _send(
+        self, send: Callable[[UpstreamTarget], Awaitable[T]], target: UpstreamTarget, request: _Request
+    ) -> T:
+        # Runs as its own task, so send's request_sent() reaches this request
+        _current_request.set(request)
+        start = time.monotonic()
+        breaker = self.breakers[target.model]
+        breaker.begin()
+        try:
+            result = await send(target)
+        except asyncio.CancelledError:
+            breaker.abandon()
+            raise
+        except Exception as e:
+            if is_breaker_failure(e):
+                breaker.record_failure()
+            else:
+                breaker.abandon()
+            raise
+        breaker.record_success()
+        # Time upstream only, not time spent queued for a slot
+        self.latencies[target.model].add(time.monotonic() - (request.sent_at or start))
+        return result
+
+    def expected_latency_s(self, model: str) -> Optional[float]:
+        """Median recent latency of a model, None until enough calls were seen"""
+        return self.latencies[model].percentile(50, self.hedge_min_samples)
+
+    def _hedge_delay(self, target: UpstreamTarget) -> Optional[float]:
+        if self.hedge_percentile <= 0:
+            return None
+        return self.latencies[target.model].percentile(self.hedge_percentile, self.hedge_min_samples)
+
+    def stats(self) -> Dict[str, Any]:
+        models = {}
+        for target in self.targets:
+            latency = self.latencies[target.model]
+            hedge_after = self._hedge_delay(target)
+            models[target.model] = dict(
+                self.breakers[target.model].stats(),
+                answered=self.answered_by[target.model],
+                hedge_after_ms=round(hedge_after * 1000) if hedge_after is not None else None,
+                samples=len(latency.samples),
+            )
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failures": self.failures,
+            "models": models,
+        }
@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+
+def _to_signed64(value: int) -> int:
+    """SQLite integers are signed 64-bit"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _to_unsigned64(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+class AnalysisCache:
+    """
+    Content-addressed cache for analysis results.
+
+    Tier 1 is a bounded in-process LRU with a TTL, tier 2 is an optional SQLite
+    file that survives restarts. Keys are derived from the image bytes plus the
+    model and prompt version, so a prompt or model change never serves stale results.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_seconds: float = 86400,
+        db_path: Optional[str] = None,
+        disk_ttl_seconds: Optional[float] = None,
+        on_evict: Optional[Callable[[int, str], None]] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_ttl_seconds = disk_ttl_seconds if disk_ttl_seconds is not None else ttl_seconds
+        # Called with (phash, key) when the LRU drops an entry that has no disk copy
+        self.on_evict = on_evict
+        self._memory: "OrderedDict[str, Tuple[float, Dict[str, Any], Optional[int]]]" = OrderedDict()
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS analysis_cache ("
+                "key TEXT PRIMARY KEY, result TEXT NOT NULL, expires_at REAL NOT NULL, phash INTEGER, stored_at REAL, "
+                "color INTEGER)"
+            )
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(analysis_cache)")]
+            if "phash" not in columns:
+                self._db.execute("ALTER TABLE analysis_cache ADD COLUMN phash INTEGER")
+            if "stored_at" not in columns:
+                self._db.execute("ALTER TABLE analysis_cache ADD COLUMN stored_at REAL")
+            if "color" not in columns:
+                self._db.execute("ALTER TABLE analysis_cache ADD COLUMN color INTEGER")
+            self._db.execute("CREATE INDEX IF NOT EXISTS analysis_cache_stored_at ON analysis_cache (stored_at)")
+            self._db.commit()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def make_key(image_data: bytes, model: str, prompt_version: str) -> str:
+        """Hash of the image bytes, scoped to the model and prompt version"""
+        digest = hashlib.sha256(image_data).hexdigest()
+        return f"{model}:{prompt_version}:{digest}"
+
+    @staticmethod
+    def image_digest(key: str) -> str:
+        """The sha256 of the image bytes a key was made from"""
+        return key.rsplit(":", 1)[1]
+
+    async def get(self, key: str, record_stats: bool = True) -> Optional[Tuple[Dict[str, Any], str]]:
+        """
+        Return (result, tier) on a hit, where tier is "memory" or "disk"; None on a miss.
+        Secondary lookups (e.g. near-duplicate candidates) pass record_stats=False so
+        they do not skew the hit rate.
+        """
+
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires_at, result, _phash = entry
+            if expires_at > time.time():
+                self._memory.move_to_end(key)
+                if record_stats:
+                    self.memory_hits += 1
+                return dict(result), "memory"
+            del self._memory[key]
+            self.expirations += 1
+
+        if self._db is not None:
+            result = await asyncio.to_thread(self._disk_get, key)
+            if result is not None:
+                self._memory_set(key, result)
+                if record_stats:
+                    self.disk_hits += 1
+                return dict(result), "disk"
+
+        if record_stats:
+            self.misses += 1
+        return None
+
+    async def set(
+        self, key: str, result: Dict[str, Any], phash: Optional[int] = None, color: Optional[int] = None
+    ) -> None:
+        """Store a result in both tiers, with the image's perceptual hash and mean color if known"""
+        self._memory_set(key, result, phash)
+        if self._db is not None:
+            await asyncio.to_thread(self._disk_set, key, result, phash, color)
+
+    @property
+    def retention_seconds(self) -> float:
+        """How long a stored entry can be served, from whichever tier keeps it longest"""
+        return self.disk_ttl_seconds if self._db is not None else self.ttl_seconds
+
+    def load_phashes(self, stored_after: Optional[float] = None) -> List[Tuple[str, int, int, float]]:
+        """
+        (key, phash, color, expires_at) of every unexpired disk entry, used to rebuild the
+        near-duplicate index; with stored_after, only entries written since then (by any worker).
+        Entries stored without a color are left out, they could not be matched.
+        """
+        if self._db is None:
+            return []
+        query = (
+            "SELECT key, phash, color, expires_at FROM analysis_cache "
+            "WHERE phash IS NOT NULL AND color IS NOT NULL AND expires_at > ?"
+        )
+        params: Tuple[float, ...] = (time.time(),)
+        if stored_after is not None:
+            query += " AND stored_at > ?"
+            params += (stored_after,)
+        with self._db_lock:
+            rows = self._db.execute(query, params).fetchall()
+        return [(key, _to_unsigned64(phash), color, expires_at) for key, phash, color, expires_at in rows]
+
+    def _memory_set(self, key: str, result: Dict[str, Any], phash: Optional[int] = None) -> None:
+        self._memory[key] = (time.time() + self.ttl_seconds, dict(result), phash)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            evicted_key, (_expires_at, _result, evicted_phash) = self._memory.popitem(last=False)
+            self.evictions += 1
+            # With a disk tier the entry is still served from there until it expires
+            if self._db is None and evicted_phash is not None and self.on_evict is not None:
+                self.on_evict(evicted_phash, evicted_key)
+
+    def _disk_get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT result, expires_at FROM analysis_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] <= time.time():
+                self._db.execute("DELETE FROM analysis_cache WHERE key = ?", (key,))
+                self._db.commit()
+                self.expirations += 1
+                return None
+        return json.loads(row[0])
+
+    def _disk_set(self, key: str, result: Dict[str, Any], phash: Optional[int], color: Optional[int] = None) -> None:
+        now = time.time()
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO analysis_cache (key, result, expires_at, phash, stored_at, color) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, json.dumps(result), now + self.disk_ttl_seconds,
+                 _to_signed64(phash) if phash is not None else None, now, color),
+            )
+            expired = self._db.execute("DELETE FROM analysis_cache WHERE expires_at <= ?", (now,)).rowcount
+            self._db.commit()
+        self.expirations += max(expired, 0)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit-rate and eviction counters"""
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "memory_entries": len(self._memory),
+            "max_entries": self.max_entries,
+            "disk_enabled": self._db is not None,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def close(self) -> None:
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
@@ -0,0 +1,335 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple, Union
+
+from fastapi import HTTPException, Request
+
+from app.services.metrics import SCHEDULER_WAIT_SECONDS
+from app.services.rate_limiter import AdaptiveConcurrencyLimiter
+
+API_KEY_HEADER = "X-API-Key"
+LANE_HEADER = "X-Priority-Lane"
+
+
+@dataclass(frozen=True)
+class Flow:
+    """Who an upstream call is made for: its priority lane and the tenant it is counted against"""
+    lane: str
+    tenant: str
+
+
+class FlowGroup:
+    """
+    The flows of the callers sharing one coalesced upstream call (see SingleFlight).
+    The call is scheduled for the highest-priority caller still waiting, and changes
+    lane while queued when callers join or leave.
+    """
+
+    def __init__(self):
+        self.flows: List[Optional[Flow]] = []
+        self._listeners: List[Callable[[], None]] = []
+
+    def join(self, flow: Optional[Flow]) -> None:
+        self.flows.append(flow)
+        self._changed()
+
+    def leave(self, flow: Optional[Flow]) -> None:
+        self.flows.remove(flow)
+        self._changed()
+
+    def _changed(self) -> None:
+        for listener in list(self._listeners):
+            listener()
+
+
+_current: ContextVar[Optional[Union[Flow, FlowGroup]]] = ContextVar("scheduling_flow", default=None)
+
+
+def current_flow() -> Optional[Flow]:
+    """The caller's own flow (None inside coalesced work, which is scheduled for its group)"""
+    flow = _current.get()
+    return flow if isinstance(flow, Flow) else None
+
+
+@contextmanager
+def scheduling(flow: Optional[Union[Flow, FlowGroup]]) -> Iterator[None]:
+    """Upstream calls made inside the block (and by tasks created in it) are scheduled as `flow`"""
+    token = _current.set(flow)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def parse_pairs(spec: str) -> List[Tuple[str, str]]:
+    """Comma-separated `name=value` entries"""
+    pairs = []
+    for entry in spec.split(","):
+        name, separator, value = entry.strip().partition("=")
+        if not name.strip():
+            continue
+        if not separator:
+            raise ValueError(f"Expected name=value, got '{entry.strip()}'")
+        pairs.append((name.strip(), value.strip()))
+    return pairs
+
+
+@dataclass
+class _Waiter:
+    future: "asyncio.Future[None]"
+    flow: Flow
+    enqueued: float
+
+
+class _Lane:
+    def __init__(self, name: str, weight: float):
+        self.name = name
+        self.weight = weight
+        # Virtual time of this lane's next dispatch; advances by 1/weight per dispatched call
+        self.tag = 0.0
+        # Tenants with waiting calls, served round-robin
+        self.tenants: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self.queued = 0
+        self.in_flight = 0
+        self.dispatched = 0
+
+
+class FairScheduler:
+    """
+    Decides which waiting call gets the next upstream slot (the adaptive concurrency
+    limit), so interactive uploads are not stuck behind bulk work.
+
+    Calls are classified into priority lanes and tenants (see classify). Lanes share
+    the slots by weighted fair queueing: a backlogged lane gets slots in proportion
+    to its weight, an idle lane's share goes to the others, and a lane returning
+    from idle starts at the current virtual time rather than with banked credit.
+    Within a lane tenants take turns, and a tenant at its concurrency cap is skipped
+    until one of its calls finishes. Lanes are listed highest priority first.
+    """
+
+    def __init__(
+        self,
+        concurrency: AdaptiveConcurrencyLimiter,
+        lanes: List[Tuple[str, float]],
+        api_keys: Optional[Dict[str, Tuple[str, Optional[str]]]] = None,
+        tenant_caps: Optional[Dict[str, int]] = None,
+        default_tenant_cap: int = 0,
+    ):
+        if not lanes:
+            raise ValueError("At least one scheduling lane is required")
+        self.concurrency = concurrency
+        self.lanes: Dict[str, _Lane] = {}
+        for name, weight in lanes:
+            if weight <= 0:
+                raise ValueError(f"Lane '{name}' needs a positive weight")
+            self.lanes[name] = _Lane(name, weight)
+        self.priority = {name: rank for rank, (name, _weight) in enumerate(lanes)}
+        self.api_keys = api_keys or {}
+        for tenant, lane in self.api_keys.values():
+            if lane is not None and lane not in self.lanes:
+                raise ValueError(f"API key of tenant '{tenant}' uses unknown lane '{lane}'")
+        self.tenant_caps = tenant_caps or {}
+        self.default_tenant_cap = default_tenant_cap
+        self._tenant_in_flight: Dict[str, int] = {}
+        self._virtual_time = 0.0
+
+    @property
+    def top_lane(self) -> str:
+        return next(iter(self.lanes))
+
+    @property
+    def bottom_lane(self) -> str:
+        return next(reversed(self.lanes))
+
+    @classmethod
+    def from_config(
+        cls,
+        concurrency: AdaptiveConcurrencyLimiter,
+        lanes: str,
+        api_keys: str = "",
+        tenant_caps: str = "",
+        default_tenant_cap: int = 0,
+    ) -> "FairScheduler":
+        """
+        lanes: `name=weight,...` highest priority first; api_keys: `key=tenant[:lane],...`;
+        tenant_caps: `tenant=max_concurrent_calls,...` (0 = no cap)
+        """
+        keys = {}
+        for key, value in parse_pairs(api_keys):
+            tenant, _, lane = value.partition(":")
+            keys[key] = (tenant.strip() or key[:8], lane.strip() or None)
+        return cls(
+            concurrency,
+            [(name, float(weight)) for name, weight in parse_pairs(lanes)],
+            api_keys=keys,
+            tenant_caps={tenant: int(cap) for tenant, cap in parse_pairs(tenant_caps)},
+            default_tenant_cap=default_tenant_cap,
+        )
+
+    def classify(self, request: Request, lane: str) -> Flow:
+        """
+        Flow for a request to an endpoint whose default lane is `lane`. A known API key
+        names the tenant and may assign a lower lane; X-Priority-Lane may lower it
+        further. Nothing raises a request above its endpoint's or its key's lane.
+        Requests without a known key are tenants by client address.
+        """
+        tenant = f"client:{request.client.host}" if request.client else "client:unknown"
+        known = self.api_keys.get(request.headers.get(API_KEY_HEADER, ""))
+        candidates = [lane]
+        if known is not None:
+            tenant = known[0]
+            if known[1] is not None:
+                candidates.append(known[1])
+        requested = request.headers.get(LANE_HEADER)
+        if requested:
+            if requested not in self.lanes:
+                raise HTTPException(status_code=400, detail=f"{LANE_HEADER} must be one of {', '.join(self.lanes)}")
+            candidates.append(requested)
+        return Flow(lane=max(candidates, key=self.priority.__getitem__), tenant=tenant)
+
+    def _cap(self, tenant: str) -> int:
+        return self.tenant_caps.get(tenant, self.default_tenant_cap)
+
+    def _eligible(self, tenant: str) -> bool:
+        cap = self._cap(tenant)
+        return cap <= 0 or self._tenant_in_flight.get(tenant, 0) < cap
+
+    def _flow(self, current: Optional[Union[Flow, FlowGroup]]) -> Flow:
+        internal = Flow(lane=self.top_lane, tenant="internal")
+        if isinstance(current, FlowGroup):
+            flows = [flow or internal for flow in current.flows]
+            # min() keeps the earliest caller among those in the best lane
+            return min(flows, key=lambda flow: self.priority.get(flow.lane, 0)) if flows else internal
+        return current or internal
+
+    def _lane(self, flow: Flow) -> _Lane:
+        return self.lanes.get(flow.lane) or self.lanes[self.top_lane]
+
+    async def acquire(self) -> Flow:
+        """
+        Wait for an upstream slot for the current flow (top lane if none is set, the
+        highest-priority waiter's for coalesced work); returns it for release()
+        """
+        current = _current.get()
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), self._flow(current), time.perf_counter())
+        self._enqueue(waiter)
+        self._dispatch()
+        regroup = None
+        if isinstance(current, FlowGroup):
+            regroup = partial(self._regroup, waiter, current)
+            current._listeners.append(regroup)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted just as the caller went away
+                self.release(waiter.flow)
+            else:
+                self._remove(self._lane(waiter.flow), waiter)
+            raise
+        finally:
+            if regroup is not None:
+                current._listeners.remove(regroup)
+        SCHEDULER_WAIT_SECONDS.observe(time.perf_counter() - waiter.enqueued, lane=self._lane(waiter.flow).name)
+        return waiter.flow
+
+    def _enqueue(self, waiter: _Waiter) -> None:
+        lane = self._lane(waiter.flow)
+        if lane.queued == 0:
+            # Back from idle: no credit for the time it had nothing to send
+            lane.tag = max(lane.tag, self._virtual_time)
+        lane.tenants.setdefault(waiter.flow.tenant, deque()).append(waiter)
+        lane.queued += 1
+
+    def _regroup(self, waiter: _Waiter, group: FlowGroup) -> None:
+        """Move a queued coalesced call to the flow of its highest-priority remaining caller"""
+        if waiter.future.done() or not group.flows:
+            return
+        flow = self._flow(group)
+        if flow == waiter.flow:
+            return
+        self._remove(self._lane(waiter.flow), waiter)
+        waiter.flow = flow
+        self._enqueue(waiter)
+        self._dispatch()
+
+    def release(self, flow: Flow) -> None:
+        self.concurrency.in_flight -= 1
+        self._tenant_in_flight[flow.tenant] -= 1
+        if not self._tenant_in_flight[flow.tenant]:
+            del self._tenant_in_flight[flow.tenant]
+        self._lane(flow).in_flight -= 1
+        self._dispatch()
+
+    def _remove(self, lane: _Lane, waiter: _Waiter) -> None:
+        waiters = lane.tenants.get(waiter.flow.tenant)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            lane.queued -= 1
+            if not waiters:
+                del lane.tenants[waiter.flow.tenant]
+
+    def _next(self) -> Optional[Tuple[_Lane, str]]:
+        """The backlogged lane with the smallest virtual time that has a tenant under its cap"""
+        best: Optional[Tuple[_Lane, str]] = None
+        for lane in self.lanes.values():
+            if not lane.queued or (best is not None and lane.tag >= best[0].tag):
+                continue
+            tenant = next((tenant for tenant in lane.tenants if self._eligible(tenant)), None)
+            if tenant is not None:
+                best = (lane, tenant)
+        return best
+
+    def _dispatch(self) -> None:
+        while self.concurrency.in_flight < int(self.concurrency.limit):
+            chosen = self._next()
+            if chosen is None:
+                return
+            lane, tenant = chosen
+            waiters = lane.tenants[tenant]
+            waiter = waiters.popleft()
+            lane.queued -= 1
+            if waiters:
+                # Round-robin: the tenant goes to the back of its lane
+                lane.tenants.move_to_end(tenant)
+            else:
+                del lane.tenants[tenant]
+            if waiter.future.done():
+                # Cancelled while queued; its task has not run its cleanup yet
+                continue
+            self._virtual_time = lane.tag
+            lane.tag += 1.0 / lane.weight
+            lane.in_flight += 1
+            lane.dispatched += 1
+            self.concurrency.in_flight += 1
+            self._tenant_in_flight[tenant] = self._tenant_in_flight.get(tenant, 0) + 1
+            waiter.future.set_result(None)
+
+    def queued(self) -> Dict[Tuple[str], int]:
+        return {(name,): lane.queued for name, lane in self.lanes.items()}
+
+    def in_flight(self) -> Dict[Tuple[str], int]:
+        return {(name,): lane.in_flight for name, lane in self.lanes.items()}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "lanes": {
+                name: {
+                    "weight": lane.weight,
+                    "queued": lane.queued,
+                    "in_flight": lane.in_flight,
+                    "dispatched": lane.dispatched,
+                    "waiting_tenants": len(lane.tenants),
+                }
+                for name, lane in self.lanes.items()
+            },
+            "tenants_in_flight": len(self._tenant_in_flight),
+            "default_tenant_cap": self.default_tenant_cap,
+            "tenant_caps": self.tenant_caps,
+            "api_keys": len(self.api_keys),
+        }
@@ -0,0 +1,91 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+
+class SharedState:
+    """
+    Small SQLite file shared by the worker processes of one server (see app/serve.py).
+
+    Holds the upstream rate-limit buckets, the Retry-After pause and a metrics
+    snapshot per worker, so limits apply to the server as a whole and /metrics
+    reports totals whichever worker answers the scrape. Every access is a short
+    transaction; writers take the lock up front (BEGIN IMMEDIATE) so read-modify-write
+    updates of a bucket cannot interleave between processes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS token_buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS shared_values (name TEXT PRIMARY KEY, value REAL NOT NULL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS metric_snapshots (worker TEXT PRIMARY KEY, snapshot TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def get_value(self, name: str, default: float = 0.0) -> float:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM shared_values WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else default
+
+    def raise_value(self, name: str, value: float) -> None:
+        """Set a value unless it is already higher (e.g. a pause deadline)"""
+        with self.transaction() as db:
+            db.execute(
+                "INSERT INTO shared_values (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)",
+                (name, value),
+            )
+
+    def publish_metrics(self, worker: str, snapshot: Dict[str, Any]) -> None:
+        with self.transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO metric_snapshots (worker, snapshot, updated_at) VALUES (?, ?, ?)",
+                (worker, json.dumps(snapshot), time.time()),
+            )
+
+    def metric_snapshots(self, exclude_worker: Optional[str] = None, gauge_max_age_s: float = 30.0) -> List[Dict[str, Any]]:
+        """
+        Snapshots published by the other workers. Counters of workers that exited are
+        kept so totals never go backwards; their gauges are dropped once stale.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT worker, snapshot, updated_at FROM metric_snapshots").fetchall()
+        snapshots = []
+        for worker, snapshot, updated_at in rows:
+            if worker == exclude_worker:
+                continue
+            snapshot = json.loads(snapshot)
+            if time.time() - updated_at > gauge_max_age_s:
+                snapshot.pop("gauges", None)
+            snapshots.append(snapshot)
+        return snapshots
+
+    def reset(self) -> None:
+        """Forget per-run state (metrics, pauses) before a server starts; buckets keep their level"""
+        with self.transaction() as db:
+            db.execute("DELETE FROM metric_snapshots")
+            db.execute("DELETE FROM shared_values")
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
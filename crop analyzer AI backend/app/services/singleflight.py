@@ -0,0 +1,111 @@
+import asyncio
+import contextvars
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from app.services.request_context import DeadlineExceeded, RequestContext, current_context, serving
+from app.services.scheduler import FlowGroup, current_flow, scheduling
+
+
+class _Call:
+    def __init__(self, leader: Optional[RequestContext]):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        # The work is done for every waiter, so it may run until the last of their deadlines
+        # and is scheduled for the highest-priority one
+        self.context = RequestContext(deadline=leader.deadline if leader is not None else None)
+        self.flows = FlowGroup()
+
+    def join(self, context: Optional[RequestContext]) -> None:
+        if self.context.deadline is None:
+            return
+        if context is None or context.deadline is None:
+            self.context.deadline = None
+        else:
+            self.context.deadline = max(self.context.deadline, context.deadline)
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key into one execution.
+
+    The first caller starts the work as a task; later callers with the same key
+    await that task instead of starting their own. Each waiter awaits through
+    asyncio.shield, so one waiter being cancelled (e.g. its client disconnected)
+    does not cancel the shared work for the others. The work is only cancelled
+    once every waiter has gone.
+
+    The work does not run in the first caller's context: its deadline is the
+    latest of its waiters' (none if any waiter has none), while each waiter
+    gives up at its own deadline, and its upstream calls are scheduled in the
+    lane of the highest-priority waiter (see FlowGroup).
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self.executions = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Run fn() for key, or join the execution already in flight.
+        Returns (result, shared) where shared is True if another caller started it.
+        Raises DeadlineExceeded if the caller's own deadline passes first.
+        """
+
+        context = current_context()
+        call = self._calls.get(key)
+        if call is not None and call.task.done():
+            # Finished (e.g. failed its deadline) but not forgotten yet: nothing left to join
+            call = None
+        shared = call is not None
+        if call is None:
+            call = _Call(context)
+            call.task = contextvars.Context().run(self._start, call, fn)
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _task, key=key, call=call: self._forget(key, call))
+            self.executions += 1
+        else:
+            call.join(context)
+            self.coalesced += 1
+
+        flow = current_flow()
+        call.flows.join(flow)
+        call.waiters += 1
+        try:
+            remaining = context.remaining_s() if context is not None else None
+            try:
+                return await asyncio.wait_for(asyncio.shield(call.task), timeout=remaining), shared
+            except asyncio.TimeoutError:
+                if call.task.done():
+                    raise
+                context.cancelled("deadline")
+                raise DeadlineExceeded()
+        finally:
+            call.flows.leave(flow)
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # The last interested caller left, nobody needs the result any more
+                call.task.cancel()
+                self.cancelled += 1
+
+    @staticmethod
+    def _start(call: _Call, fn: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        # Runs in an empty context; the task copies what is set here
+        with serving(call.context), scheduling(call.flows):
+            return asyncio.create_task(fn())
+
+    def _forget(self, key: str, call: _Call) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._calls),
+            "upstream_executions": self.executions,
+            "coalesced_calls": self.coalesced,
+            "cancelled_executions": self.cancelled,
+        }
@@ -0,0 +1,163 @@
+import gzip
+import hashlib
+import html
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from fastapi import Request, Response
+
+# Fingerprinted URLs change whenever their content does, so browsers may keep them forever
+IMMUTABLE = "public, max-age=31536000, immutable"
+# The page itself is revalidated on every visit (a 304 when unchanged) so a deploy is picked up at once
+REVALIDATE = "no-cache"
+
+CONTENT_TYPES = {
+    ".html": "text/html; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".js": "text/javascript; charset=utf-8",
+}
+
+# Preferred first; identity is always available
+ENCODINGS = ("br", "gzip", "identity")
+
+_PLACEHOLDER = re.compile(r"\{\{\s*(asset:)?([\w.\-]+)\s*\}\}")
+
+
+def brotli_available() -> bool:
+    """Brotli precompression needs the optional `brotli` package"""
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        # mtime=0 keeps the output, and so the ETag, identical across restarts and workers
+        return gzip.compress(body, compresslevel=9, mtime=0)
+    import brotli
+    return brotli.compress(body, quality=11)
+
+
+@dataclass(frozen=True)
+class Asset:
+    """One file, rendered and compressed once; one representation per content coding"""
+    content_type: str
+    cache_control: str
+    # content coding -> (body, strong ETag)
+    representations: Dict[str, Tuple[bytes, str]]
+
+
+def build_asset(body: bytes, content_type: str, cache_control: str, encodings: Iterable[str]) -> Asset:
+    digest = hashlib.sha256(body).hexdigest()[:20]
+    representations = {"identity": (body, f'"{digest}"')}
+    for encoding in encodings:
+        compressed = _compress(body, encoding)
+        if len(compressed) < len(body):
+            # Each coding is a different representation, so it gets its own strong ETag
+            representations[encoding] = (compressed, f'"{digest}-{encoding}"')
+    return Asset(content_type, cache_control, representations)
+
+
+def negotiate(accept_encoding: str, available: Iterable[str]) -> str:
+    """Most compact available coding the client accepts (q > 0); identity unless explicitly refused"""
+    accepted: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        match = re.search(r"q=([0-9.]+)", params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        if name.strip():
+            accepted[name.strip().lower()] = quality
+    available = set(available)
+    for encoding in ENCODINGS:
+        if encoding in accepted:
+            quality = accepted[encoding]
+        else:
+            quality = accepted.get("*", 1.0 if encoding == "identity" else 0.0)
+        if encoding in available and quality > 0:
+            return encoding
+    return "identity"
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match uses the weak comparison: W/ prefixes are ignored"""
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+class WebAssets:
+    """
+    The web interface, built once at startup: the page is rendered with the server
+    configuration, stylesheets and scripts get content-fingerprinted URLs, and
+    everything is precompressed (gzip, plus brotli when installed). Serving is a
+    dictionary lookup: content negotiation, strong ETags with 304 Not Modified, and
+    long-lived caching for fingerprinted assets.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        context: Dict[str, Any],
+        page: str = "index.html",
+        fingerprinted: Tuple[str, ...] = ("app.css", "app.js"),
+        url_prefix: str = "/assets",
+    ):
+        self.encodings: List[str] = ["gzip"] + (["br"] if brotli_available() else [])
+        self.assets: Dict[str, Asset] = {}
+        urls: Dict[str, str] = {}
+        for name in fingerprinted:
+            with open(os.path.join(directory, name), "rb") as f:
+                body = f.read()
+            stem, extension = os.path.splitext(name)
+            url = f"{url_prefix}/{stem}.{hashlib.sha256(body).hexdigest()[:12]}{extension}"
+            urls[name] = url
+            self.assets[url] = build_asset(body, CONTENT_TYPES[extension], IMMUTABLE, self.encodings)
+
+        with open(os.path.join(directory, page), encoding="utf-8") as f:
+            template = f.read()
+
+        def substitute(match: "re.Match") -> str:
+            if match.group(1):
+                return urls[match.group(2)]
+            return html.escape(str(context[match.group(2)]))
+
+        self.page = build_asset(
+            _PLACEHOLDER.sub(substitute, template).encode("utf-8"),
+            CONTENT_TYPES[os.path.splitext(page)[1]],
+            REVALIDATE,
+            self.encodings,
+        )
+
+    def get(self, url: str) -> Optional[Asset]:
+        return self.assets.get(url)
+
+    def respond(self, asset: Asset, request: Request) -> Response:
+        encoding = negotiate(request.headers.get("accept-encoding", ""), asset.representations)
+        body, etag = asset.representations[encoding]
+        headers = {"ETag": etag, "Cache-Control": asset.cache_control, "Vary": "Accept-Encoding"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type=asset.content_type, headers=headers)
+
+    def stats(self) -> Dict[str, Any]:
+        def sizes(asset: Asset) -> Dict[str, int]:
+            return {encoding: len(body) for encoding, (body, _etag) in asset.representations.items()}
+
+        return {
+            "encodings": self.encodings,
+            "page": sizes(self.page),
+            "assets": {url: sizes(asset) for url, asset in self.assets.items()},
+        }
@@ -0,0 +1,330 @@
+import asyncio
+import io
+import json
+import math
+import os
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from PIL import Image
+
+BUNDLED_MODEL_PATH = os.path.join(os.path.dirname(__file__), "triage_models", "color_histogram_v1.json")
+
+# Labels a triage backend may answer on its own; anything else goes to the vision model
+HEALTHY = "healthy"
+NOT_PLANT = "not_plant"
+LOCAL_LABELS = (HEALTHY, NOT_PLANT)
+# disease_type of a local answer that the image shows no crop
+NO_CROP_DETECTED = "No Crop Detected"
+
+
+@dataclass
+class TriagePrediction:
+    label: str
+    confidence: float
+    crop_type: Optional[str] = None
+
+
+def _softmax(logits: List[float]) -> List[float]:
+    peak = max(logits)
+    exps = [math.exp(value - peak) for value in logits]
+    total = sum(exps)
+    return [value / total for value in exps]
+
+
+class TriageBackend(ABC):
+    """A local image classifier; predict_batch runs in a worker thread"""
+
+    name: str
+
+    @abstractmethod
+    def predict_batch(self, images: List[bytes]) -> List[TriagePrediction]:
+        """Classify encoded images; an undecodable image gets a zero-confidence prediction"""
+
+
+class ColorHistogramBackend(TriageBackend):
+    """
+    Bundled, dependency-free model: a softmax over the fractions of green,
+    yellow/brown, other-hued and unsaturated pixels in a small HSV thumbnail,
+    with weights loaded from JSON.
+    """
+
+    def __init__(self, model_path: str = BUNDLED_MODEL_PATH):
+        with open(model_path) as model_file:
+            model = json.load(model_file)
+        self.name = model["name"]
+        self.input_size = model["input_size"]
+        self.classes = model["classes"]
+        self.weights = model["weights"]
+
+    def features(self, image_data: bytes) -> List[float]:
+        image = Image.open(io.BytesIO(image_data))
+        image.draft("RGB", (self.input_size * 2, self.input_size * 2))
+        image = image.convert("RGB").resize((self.input_size, self.input_size), Image.BILINEAR).convert("HSV")
+
+        green = yellow_brown = other = low_saturation = counted = 0
+        for hue, saturation, value in image.getdata():
+            # Near-black pixels (shadows, background) carry no colour information
+            if value < 30:
+                continue
+            counted += 1
+            if saturation < 40:
+                low_saturation += 1
+                continue
+            degrees = hue * 360 / 255
+            if 15 <= degrees < 65:
+                yellow_brown += 1
+            elif 65 <= degrees < 170:
+                green += 1
+            else:
+                other += 1
+        if not counted:
+            return [0.0, 0.0, 0.0, 1.0, 1.0]
+        return [green / counted, yellow_brown / counted, other / counted, low_saturation / counted, 1.0]
+
+    def predict_batch(self, images: List[bytes]) -> List[TriagePrediction]:
+        predictions = []
+        for image_data in images:
+            try:
+                features = self.features(image_data)
+            except Exception:
+                predictions.append(TriagePrediction(label="unknown", confidence=0.0))
+                continue
+            logits = [sum(w * x for w, x in zip(row, features)) for row in self.weights]
+            probabilities = _softmax(logits)
+            best = max(range(len(probabilities)), key=probabilities.__getitem__)
+            predictions.append(TriagePrediction(label=self.classes[best], confidence=probabilities[best]))
+        return predictions
+
+
+class OnnxTriageBackend(TriageBackend):
+    """
+    ONNX Runtime classifier (needs the optional `onnxruntime` package).
+    The model takes an NCHW float32 batch of ImageNet-normalised RGB images and
+    returns one logit per label. Labels are read from a JSON list; `healthy` and
+    `not_plant` can be answered locally, as can PlantVillage-style
+    `Crop___healthy` labels, which also give the crop type.
+    """
+
+    def __init__(self, model_path: str, labels_path: str, input_size: int = 224, threads: int = 1):
+        try:
+            import numpy
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError("TRIAGE_BACKEND=onnx needs the 'onnxruntime' package (pip install onnxruntime)")
+        self._np = numpy
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        with open(labels_path) as labels_file:
+            self.labels = json.load(labels_file)
+        self.input_size = input_size
+        self.name = f"onnx:{os.path.splitext(os.path.basename(model_path))[0]}"
+        self._mean = numpy.array([0.485, 0.456, 0.406], dtype=numpy.float32)
+        self._std = numpy.array([0.229, 0.224, 0.225], dtype=numpy.float32)
+
+    def _tensor(self, image_data: bytes):
+        np = self._np
+        image = Image.open(io.BytesIO(image_data))
+        image.draft("RGB", (self.input_size * 2, self.input_size * 2))
+        image = image.convert("RGB").resize((self.input_size, self.input_size), Image.BILINEAR)
+        array = (np.asarray(image, dtype=np.float32) / 255.0 - self._mean) / self._std
+        return array.transpose(2, 0, 1)
+
+    def _prediction(self, label: str, confidence: float) -> TriagePrediction:
+        if "___" in label:
+            crop, condition = label.split("___", 1)
+            crop_type = crop.replace("_", " ").strip()
+            if condition.lower() == HEALTHY:
+                return TriagePrediction(label=HEALTHY, confidence=confidence, crop_type=crop_type)
+            return TriagePrediction(label=condition, confidence=confidence, crop_type=crop_type)
+        return TriagePrediction(label=label, confidence=confidence)
+
+    def predict_batch(self, images: List[bytes]) -> List[TriagePrediction]:
+        np = self._np
+        predictions = [TriagePrediction(label="unknown", confidence=0.0) for _ in images]
+        tensors, positions = [], []
+        for position, image_data in enumerate(images):
+            try:
+                tensors.append(self._tensor(image_data))
+                positions.append(position)
+            except Exception:
+                continue
+        if not tensors:
+            return predictions
+
+        logits = self.session.run(None, {self.input_name: np.stack(tensors)})[0]
+        for position, row in zip(positions, logits):
+            probabilities = _softmax([float(value) for value in row])
+            best = max(range(len(probabilities)), key=probabilities.__getitem__)
+            predictions[position] = self._prediction(self.labels[best], probabilities[best])
+        return predictions
+
+
+class MicroBatcher:
+    """
+    Group concurrent single-item calls into one batched call. The first waiting
+    item opens a window of max_wait_ms; the batch runs in the executor when the
+    window closes or max_batch_size items are waiting.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5.0,
+        executor: Optional[Executor] = None,
+    ):
+        self.fn = fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max_wait_ms
+        self.executor = executor
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._running: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait_ms / 1000, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        # Callers that gave up while waiting are dropped from the batch
+        batch = [(item, future) for item, future in batch if not future.done()]
+        if not batch:
+            return
+        self.batches += 1
+        self.items += len(batch)
+        task = asyncio.create_task(self._run(batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self.fn, [item for item, _future in batch])
+        except Exception as e:
+            for _item, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_item, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class Triage:
+    """
+    Local first pass in front of the vision model. Confident `healthy` and
+    `not_plant` predictions are answered directly; everything else escalates.
+    Concurrent requests are classified together through a MicroBatcher.
+    """
+
+    def __init__(
+        self,
+        backend: TriageBackend,
+        confidence_threshold: float = 0.9,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5.0,
+        executor: Optional[Executor] = None,
+    ):
+        self.backend = backend
+        self.confidence_threshold = confidence_threshold
+        self.batcher = MicroBatcher(backend.predict_batch, max_batch_size, max_wait_ms, executor)
+        self.classified = 0
+        self.answered_by_label = {label: 0 for label in LOCAL_LABELS}
+        self.escalated = 0
+        self._triage_ms_total = 0.0
+        self._escalated_ms_total = 0.0
+        self._escalated_timed = 0
+
+    @property
+    def model(self) -> str:
+        return f"local/{self.backend.name}"
+
+    async def classify(self, image_data: bytes) -> Tuple[TriagePrediction, bool]:
+        """Returns (prediction, whether it is confident enough to answer locally)"""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        prediction = await self.batcher.submit(image_data)
+        self._triage_ms_total += (loop.time() - start) * 1000
+        self.classified += 1
+        local = prediction.label in LOCAL_LABELS and prediction.confidence >= self.confidence_threshold
+        if local:
+            self.answered_by_label[prediction.label] += 1
+        else:
+            self.escalated += 1
+        return prediction, local
+
+    def record_escalation_ms(self, elapsed_ms: float) -> None:
+        """Time an escalated image spent in the vision-model path, to estimate the savings"""
+        self._escalated_ms_total += elapsed_ms
+        self._escalated_timed += 1
+
+    def result(self, prediction: TriagePrediction) -> Dict[str, Any]:
+        """Analysis fields for a prediction answered locally"""
+        return {
+            "disease_type": "Healthy" if prediction.label == HEALTHY else NO_CROP_DETECTED,
+            "severity_level": 1,
+            "affected_area_percentage": 0,
+            "crop_type": prediction.crop_type or "Unknown",
+        }
+
+    def describe(self, prediction: TriagePrediction, escalated: bool) -> Dict[str, Any]:
+        return {
+            "backend": self.backend.name,
+            "label": prediction.label,
+            "confidence": round(prediction.confidence, 4),
+            "escalated": escalated,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        answered = sum(self.answered_by_label.values())
+        avg_triage_ms = self._triage_ms_total / self.classified if self.classified else None
+        avg_escalated_ms = self._escalated_ms_total / self._escalated_timed if self._escalated_timed else None
+        saved_ms = None
+        if avg_triage_ms is not None and avg_escalated_ms is not None:
+            saved_ms = answered * max(0.0, avg_escalated_ms - avg_triage_ms)
+        return {
+            "backend": self.backend.name,
+            "confidence_threshold": self.confidence_threshold,
+            "classified": self.classified,
+            "answered_locally": dict(self.answered_by_label),
+            "escalated": self.escalated,
+            "escalation_rate": round(self.escalated / self.classified, 4) if self.classified else None,
+            "avg_triage_ms": round(avg_triage_ms, 2) if avg_triage_ms is not None else None,
+            "avg_escalated_ms": round(avg_escalated_ms, 1) if avg_escalated_ms is not None else None,
+            # Estimate: local answers times the difference between the two paths' average latency
+            "latency_saved_ms": round(saved_ms) if saved_ms is not None else None,
+            "batches": self.batcher.batches,
+            "avg_batch_size": round(self.batcher.items / self.batcher.batches, 2) if self.batcher.batches else None,
+        }
+
+
+def create_triage_backend(backend: str, **options: Any) -> Optional[TriageBackend]:
+    """Build the configured triage backend; "none" disables triage"""
+    if backend == "none":
+        return None
+    if backend == "color":
+        return ColorHistogramBackend(options.get("model_path") or BUNDLED_MODEL_PATH)
+    if backend == "onnx":
+        if not options.get("model_path") or not options.get("labels_path"):
+            raise ValueError("TRIAGE_BACKEND=onnx needs TRIAGE_MODEL_PATH and TRIAGE_LABELS_PATH")
+        return OnnxTriageBackend(
+            options["model_path"], options["labels_path"], input_size=options.get("input_size", 224)
+        )
+    raise ValueError(f"Unknown triage backend: {backend}")
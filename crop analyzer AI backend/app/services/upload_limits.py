@@ -0,0 +1,151 @@
+import json
+from typing import Dict, Any, Optional, Set
+
+from fastapi import HTTPException, UploadFile
+
+
+class UploadBudget:
+    """
+    Global budget of request-body bytes that may be in flight at once.
+    Requests that would exceed it are turned away instead of exhausting memory.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.rejected = 0
+
+    def try_reserve(self, size: int) -> bool:
+        if self.in_flight + size > self.max_bytes:
+            self.rejected += 1
+            return False
+        self.in_flight += size
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return True
+
+    def release(self, size: int) -> None:
+        self.in_flight = max(0, self.in_flight - size)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_bytes": self.max_bytes,
+            "in_flight_bytes": self.in_flight,
+            "peak_in_flight_bytes": self.peak_in_flight,
+            "rejected": self.rejected,
+        }
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware that bounds request bodies on upload routes before they are parsed.
+
+    A declared Content-Length above the route limit is rejected with 413 without
+    reading the body; otherwise bytes are counted as they stream in and the request
+    is aborted as soon as the running total passes the limit. Every body is also
+    charged against the shared UploadBudget, answering 503 with Retry-After when full.
+    """
+
+    def __init__(
+        self,
+        app,
+        limits: Dict[str, int],
+        budget: UploadBudget,
+        details: Optional[Dict[str, str]] = None,
+        budgeted_paths: Optional[Set[str]] = None,
+    ):
+        self.app = app
+        self.limits = limits
+        self.budget = budget
+        # Per-path error messages for oversized bodies
+        self.details = details or {}
+        # Paths charged against the budget; defaults to every limited path
+        self.budgeted_paths = set(limits) if budgeted_paths is None else set(budgeted_paths)
+
+    @staticmethod
+    def _normalize(path: str) -> str:
+        return path.rstrip("/") or "/"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT"):
+            await self.app(scope, receive, send)
+            return
+
+        path = self._normalize(scope["path"])
+        limit = self.limits.get(path)
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = None
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    content_length = int(value)
+                except ValueError:
+                    content_length = None
+                break
+
+        detail = self.details.get(path, "Request body too large")
+        if content_length is not None and content_length > limit:
+            await self._send_error(send, 413, detail)
+            return
+
+        budgeted = path in self.budgeted_paths
+        reserved = 0
+        if budgeted and content_length is not None:
+            if not self.budget.try_reserve(content_length):
+                await self._send_error(send, 503, "Server is busy processing uploads, please retry shortly",
+                                       retry_after=1)
+                return
+            reserved = content_length
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received, reserved
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=detail)
+                # Chunked bodies without Content-Length are charged as they arrive
+                if budgeted and received > reserved:
+                    if not self.budget.try_reserve(received - reserved):
+                        raise HTTPException(status_code=503, detail="Server is busy processing uploads, please retry shortly",
+                                            headers={"Retry-After": "1"})
+                    reserved = received
+            return message
+
+        try:
+            await self.app(scope, limited_receive, send)
+        finally:
+            self.budget.release(reserved)
+
+    @staticmethod
+    async def _send_error(send, status_code: int, detail: str, retry_after: Optional[int] = None):
+        body = json.dumps({"detail": detail}).encode()
+        headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"connection", b"close"),
+        ]
+        if retry_after is not None:
+            headers.append((b"retry-after", str(retry_after).encode()))
+        await send({"type": "http.response.start", "status": status_code, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+
+async def read_upload_limited(file: UploadFile, max_bytes: int, detail: str) -> bytes:
+    """
+    Read an upload without ever holding more than max_bytes + 1 of it.
+    Multipart parsing already spooled the part to disk, so a known size is
+    rejected without reading; otherwise a single bounded read detects overflow
+    without the extra copy a chunk list would need when joined.
+    """
+    if file.size is not None and file.size > max_bytes:
+        raise HTTPException(status_code=400, detail=detail)
+    content = await file.read(max_bytes + 1)
+    if len(content) > max_bytes:
+        raise HTTPException(status_code=400, detail=detail)
+    return content
@@ -0,0 +1,69 @@
+import httpx
+from typing import Dict, Any
+
+
+def http2_available() -> bool:
+    """HTTP/2 support in httpx needs the optional `h2` package"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def create_upstream_client(
+    max_connections: int = 100,
+    max_keepalive_connections: int = 20,
+    keepalive_expiry: float = 30.0,
+    timeout: float = 30.0,
+    connect_timeout: float = 10.0,
+    http2: bool = False,
+) -> httpx.AsyncClient:
+    """
+    Build the app-lifetime HTTP client used for all OpenRouter calls.
+    Connections are kept alive and reused, so only the first request to the
+    upstream pays for the TCP and TLS handshake.
+    """
+
+    if http2 and not http2_available():
+        print("UPSTREAM_HTTP2 requested but the 'h2' package is not installed, falling back to HTTP/1.1")
+        http2 = False
+
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+
+    return httpx.AsyncClient(
+        limits=limits,
+        timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        http2=http2,
+    )
+
+
+def get_pool_stats(client: httpx.AsyncClient) -> Dict[str, Any]:
+    """
+    Report active, idle and waiting connections of the client's pool.
+    httpx has no public API for this, so the httpcore pool is inspected and
+    missing internals degrade to an empty report instead of an error.
+    """
+
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    if pool is None:
+        return {"available": False}
+
+    connections = list(getattr(pool, "connections", []))
+    idle = sum(1 for connection in connections if connection.is_idle())
+    waiting = sum(1 for request in getattr(pool, "_requests", []) if request.is_queued())
+
+    return {
+        "available": True,
+        "http2": bool(getattr(pool, "_http2", False)),
+        "max_connections": getattr(pool, "_max_connections", None),
+        "max_keepalive_connections": getattr(pool, "_max_keepalive_connections", None),
+        "connections": len(connections),
+        "active": len(connections) - idle,
+        "idle": idle,
+        "waiting": waiting,
+    }
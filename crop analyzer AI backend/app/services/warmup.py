@@ -0,0 +1,97 @@
+import asyncio
+import io
+import time
+from concurrent.futures import Executor
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+
+import httpx
+from PIL import Image
+
+from app.services.image_preprocessor import preprocess_image
+
+
+def _ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+def _origins(urls: List[str]) -> List[str]:
+    origins = []
+    for url in urls:
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        if origin not in origins:
+            origins.append(origin)
+    return origins
+
+
+async def _resolve(origin: str) -> None:
+    parts = urlsplit(origin)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    await asyncio.get_running_loop().getaddrinfo(parts.hostname, port)
+
+
+async def _open_connections(client: httpx.AsyncClient, origin: str, connections: int) -> int:
+    """Concurrent HEAD requests so the pool keeps that many handshaken connections; any status will do"""
+    results = await asyncio.gather(
+        *(client.head(origin + "/") for _ in range(connections)), return_exceptions=True
+    )
+    failures = [result for result in results if isinstance(result, Exception)]
+    if failures:
+        raise failures[0]
+    return len(results)
+
+
+def _tiny_jpeg() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), (60, 150, 50)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+async def warm_up(
+    client: httpx.AsyncClient,
+    urls: List[str],
+    connections: int = 2,
+    preprocess_executor: Optional[Executor] = None,
+    preprocess_workers: int = 0,
+) -> Dict[str, Any]:
+    """
+    Do at startup what the first requests would otherwise pay for: resolve the
+    upstream hosts, open `connections` pooled TLS connections per origin, and
+    spawn every preprocessing worker process (interpreter start and PIL import).
+    Failures are logged and reported, never raised; the worker serves either way.
+    """
+
+    start = time.perf_counter()
+    stats: Dict[str, Any] = {"origins": {}, "preprocess_workers": 0, "errors": []}
+
+    for origin in _origins(urls):
+        origin_stats: Dict[str, Any] = {}
+        step = time.perf_counter()
+        try:
+            await _resolve(origin)
+            origin_stats["dns_ms"] = _ms(step)
+            step = time.perf_counter()
+            origin_stats["connections"] = await _open_connections(client, origin, connections)
+            origin_stats["connect_ms"] = _ms(step)
+        except (OSError, httpx.HTTPError) as e:
+            stats["errors"].append(f"{origin}: {type(e).__name__}: {e}")
+        stats["origins"][origin] = origin_stats
+
+    if preprocess_executor is not None and preprocess_workers > 0:
+        step = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        image = _tiny_jpeg()
+        # Submitted together, so the pool spawns a process for each instead of reusing the first
+        results = await asyncio.gather(
+            *(loop.run_in_executor(preprocess_executor, preprocess_image, image) for _ in range(preprocess_workers)),
+            return_exceptions=True,
+        )
+        stats["preprocess_workers"] = sum(1 for result in results if not isinstance(result, Exception))
+        stats["preprocess_ms"] = _ms(step)
+        stats["errors"].extend(f"preprocess: {result}" for result in results if isinstance(result, Exception))
+
+    stats["duration_ms"] = _ms(start)
+    for error in stats["errors"]:
+        print(f"Warm-up: {error}")
+    return stats
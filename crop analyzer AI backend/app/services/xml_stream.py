@@ -0,0 +1,59 @@
+from typing import Dict, List, Sequence, Tuple
+
+ANALYSIS_FIELDS = ("disease_type", "severity_level", "affected_area_percentage", "crop_type")
+
+
+class IncrementalXMLParser:
+    """
+    Extract flat `<field>value</field>` elements from text that arrives in pieces.
+
+    Each feed() scans only the new text (plus a tag-sized overlap), so a streamed
+    answer is parsed in one pass, and reports fields the moment their closing tag
+    arrives. The first occurrence of each field wins, as with re.search.
+    """
+
+    def __init__(self, fields: Sequence[str] = ANALYSIS_FIELDS):
+        self.fields = tuple(fields)
+        self.values: Dict[str, str] = {}
+        self._text = ""
+        # Per pending field: where its value starts once the opening tag was seen
+        self._value_start: Dict[str, int] = {}
+        self._scan_from = 0
+        self._overlap = max(len(f"</{field}>") for field in self.fields)
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    @property
+    def complete(self) -> bool:
+        return len(self.values) == len(self.fields)
+
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        """Add text; returns the (field, value) pairs completed by it, in document order"""
+        self._text += chunk
+        completed = []
+        for field in self.fields:
+            if field in self.values:
+                continue
+            start = self._value_start.get(field)
+            if start is None:
+                opening = self._text.find(f"<{field}>", self._scan_from)
+                if opening < 0:
+                    continue
+                start = self._value_start[field] = opening + len(field) + 2
+            closing = self._text.find(f"</{field}>", max(start, self._scan_from))
+            if closing < 0:
+                continue
+            self.values[field] = self._text[start:closing].strip()
+            completed.append((closing, field))
+        # Tags can straddle chunks, so rescan a tag's length back next time
+        self._scan_from = max(0, len(self._text) - self._overlap)
+        return [(field, self.values[field]) for _position, field in sorted(completed)]
+
+
+def parse_fields(text: str, fields: Sequence[str] = ANALYSIS_FIELDS) -> Dict[str, str]:
+    """One-shot parse of a complete answer; missing fields are absent from the result"""
+    parser = IncrementalXMLParser(fields)
+    parser.feed(text)
+    return parser.values
@@ -0,0 +1,195 @@
+const uploadArea = document.getElementById('uploadArea');
+const imageFile = document.getElementById('imageFile');
+const analyzeBtn = document.getElementById('analyzeBtn');
+const resultDiv = document.getElementById('result');
+const previewDiv = document.getElementById('preview');
+
+// Server configuration, rendered into the page so this script stays cacheable
+const maxFileSizeMb = Number(document.body.dataset.maxFileSizeMb);
+
+let selectedFile = null;
+
+// Drag and drop functionality
+uploadArea.addEventListener('dragover', (e) => {
+    e.preventDefault();
+    uploadArea.classList.add('dragover');
+});
+
+uploadArea.addEventListener('dragleave', () => {
+    uploadArea.classList.remove('dragover');
+});
+
+uploadArea.addEventListener('drop', (e) => {
+    e.preventDefault();
+    uploadArea.classList.remove('dragover');
+    const files = e.dataTransfer.files;
+    if (files.length > 0) {
+        handleFileSelect(files[0]);
+    }
+});
+
+imageFile.addEventListener('change', (e) => {
+    if (e.target.files.length > 0) {
+        handleFileSelect(e.target.files[0]);
+    }
+});
+
+function handleFileSelect(file) {
+    if (!file.type.startsWith('image/')) {
+        alert('Please select an image file');
+        return;
+    }
+
+    if (file.size > maxFileSizeMb * 1024 * 1024) {
+        alert(`File size must be less than ${maxFileSizeMb}MB`);
+        return;
+    }
+
+    selectedFile = file;
+    analyzeBtn.disabled = false;
+
+    // Show image preview
+    const reader = new FileReader();
+    reader.onload = (e) => {
+        previewDiv.innerHTML = '<img src="' + e.target.result + '" alt="Preview" class="image-preview">';
+    };
+    reader.readAsDataURL(file);
+}
+
+async function analyzeCrop() {
+    if (!selectedFile) {
+        alert('Please select an image first');
+        return;
+    }
+
+    analyzeBtn.disabled = true;
+    analyzeBtn.textContent = '🔄 Analyzing...';
+    resultDiv.innerHTML = '<div class="loading">🔬 Analyzing crop image for diseases...</div>';
+
+    const formData = new FormData();
+    formData.append('file', selectedFile);
+
+    try {
+        // Fields are streamed as Server-Sent Events while the model answers
+        const response = await fetch('/api/analyze/stream', {
+            method: 'POST',
+            body: formData
+        });
+
+        if (!response.ok) {
+            const errorData = await response.json();
+            throw new Error(errorData.detail || 'Analysis failed');
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        const partial = {};
+        let buffer = '';
+        let finished = false;
+
+        while (!finished) {
+            const { value, done } = await reader.read();
+            if (done) {
+                throw new Error('Analysis stream ended unexpectedly');
+            }
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while (!finished && (boundary = buffer.indexOf('\n\n')) >= 0) {
+                const message = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                const event = (message.match(/^event: (.*)$/m) || [])[1];
+                const data = JSON.parse((message.match(/^data: (.*)$/m) || [])[1] || '{}');
+
+                if (event === 'field') {
+                    partial[data.field] = data.value;
+                    displayPartialResults(partial);
+                } else if (event === 'result') {
+                    displayResults(data);
+                    finished = true;
+                } else if (event === 'error') {
+                    throw new Error(data.detail || 'Analysis failed');
+                }
+            }
+        }
+    } catch (error) {
+        resultDiv.innerHTML = '<div class="error">❌ Error: ' + error.message + '</div>';
+    } finally {
+        analyzeBtn.disabled = false;
+        analyzeBtn.textContent = '🔬 Analyze Crop';
+    }
+}
+
+function displayPartialResults(fields) {
+    const pending = '<span style="color: #adb5bd;">…</span>';
+
+    const html = `
+        <div class="result">
+            <h3>📊 Analysis Results <span class="loading">(receiving...)</span></h3>
+            <div class="result-grid">
+                <div class="result-item">
+                    <div class="result-label">🦠 Disease Type</div>
+                    <div class="result-value">${fields.disease_type || pending}</div>
+                </div>
+                <div class="result-item">
+                    <div class="result-label">🌱 Crop Type</div>
+                    <div class="result-value">${fields.crop_type || pending}</div>
+                </div>
+                <div class="result-item">
+                    <div class="result-label">⚠️ Severity Level</div>
+                    <div class="result-value">${fields.severity_level ? fields.severity_level + '/10' : pending}</div>
+                </div>
+                <div class="result-item">
+                    <div class="result-label">📏 Affected Area</div>
+                    <div class="result-value">${fields.affected_area_percentage ? fields.affected_area_percentage + '%' : pending}</div>
+                </div>
+            </div>
+        </div>
+    `;
+
+    resultDiv.innerHTML = html;
+}
+
+function displayResults(data) {
+    const severityColor = getSeverityColor(data.severity_level);
+    const severityWidth = (data.severity_level / 10) * 100;
+
+    const html = `
+        <div class="result">
+            <h3>📊 Analysis Results</h3>
+            <div class="result-grid">
+                <div class="result-item">
+                    <div class="result-label">🦠 Disease Type</div>
+                    <div class="result-value">${data.disease_type}</div>
+                </div>
+                <div class="result-item">
+                    <div class="result-label">🌱 Crop Type</div>
+                    <div class="result-value">${data.crop_type}</div>
+                </div>
+                <div class="result-item">
+                    <div class="result-label">⚠️ Severity Level</div>
+                    <div class="result-value">${data.severity_level}/10</div>
+                    <div class="severity-bar">
+                        <div class="severity-fill" style="width: ${severityWidth}%; background-color: ${severityColor}"></div>
+                    </div>
+                </div>
+                <div class="result-item">
+                    <div class="result-label">📏 Affected Area</div>
+                    <div class="result-value">${data.affected_area_percentage}%</div>
+                </div>
+            </div>
+            <p style="margin-top: 15px; color: #6c757d; font-size: 14px;">
+                📄 File: ${data.filename} | ⏱️ Analysis time: ${data.response_time_ms}ms
+            </p>
+        </div>
+    `;
+
+    resultDiv.innerHTML = html;
+}
+
+function getSeverityColor(severity) {
+    if (severity <= 2) return '#28a745'; // Green - healthy/mild
+    if (severity <= 4) return '#ffc107'; // Yellow - moderate
+    if (severity <= 7) return '#fd7e14'; // Orange - concerning
+    return '#dc3545'; // Red - severe
+}
@@ -0,0 +1,113 @@
+"""
+Fill an analysis history store with synthetic records and compare aggregate
+queries answered from the daily rollups with the same aggregates computed by
+scanning the records.
+
+Records go through HistoryStore.record() and its batched write-behind flush,
+stamped evenly over the last --days days, so the insert rate includes index
+and rollup maintenance. Query times are the median of --repeat runs.
+
+Usage:
+    python -m benchmarks.bench_history --rows 1000000 --days 365 --path /tmp/history.sqlite3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+
+from app.services.history import HistoryStore
+
+DISEASES = ["Healthy", "Leaf Rust", "Stem Rust", "Septoria", "Blast", "Late Blight", "Maize Streak", "Powdery Mildew"]
+CROPS = ["Wheat", "Teff", "Maize", "Barley", "Sorghum", "Coffee", "Potato"]
+
+
+def median_ms(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(timings), 2)
+
+
+async def fill(store: HistoryStore, rows: int, days: int) -> float:
+    rng = random.Random(7)
+    start_ts = time.time() - days * 86400
+    start = time.perf_counter()
+    for i in range(rows):
+        store.record({
+            "image_digest": f"{rng.getrandbits(256):064x}",
+            "model": "google/gemini-2.5-flash",
+            "response_time_ms": rng.randint(400, 4000),
+            "disease_type": rng.choice(DISEASES),
+            "crop_type": rng.choice(CROPS),
+            "severity_level": rng.randint(1, 10),
+            "affected_area_percentage": rng.uniform(0, 100),
+            "cache_status": "miss",
+            "filename": f"field_{i}.jpg",
+        }, "bench", recorded_at=start_ts + i * days * 86400 / rows)
+        if len(store._pending) >= store.batch_size:
+            await store.flush()
+    await store.flush()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--path", default="bench_history.sqlite3")
+    args = parser.parse_args()
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(args.path + suffix):
+            os.remove(args.path + suffix)
+    store = HistoryStore(args.path, batch_size=args.batch_size, max_pending=args.rows + 1)
+    fill_s = asyncio.run(fill(store, args.rows, args.days))
+
+    first_day = time.strftime("%Y-%m-%d", time.gmtime(time.time() - args.days * 86400))
+    last_day = time.strftime("%Y-%m-%d", time.gmtime())
+    reader = store._reader
+
+    def scan_daily():
+        reader.execute(
+            "SELECT day, disease_type, crop_type, COUNT(*), AVG(severity_level), AVG(affected_area_percentage) "
+            "FROM analyses WHERE day BETWEEN ? AND ? GROUP BY day, disease_type, crop_type",
+            (first_day, last_day),
+        ).fetchall()
+
+    def scan_severity():
+        reader.execute(
+            "SELECT severity_level, COUNT(*) FROM analyses WHERE day BETWEEN ? AND ? AND disease_type = ? "
+            "GROUP BY severity_level",
+            (first_day, last_day, "Leaf Rust"),
+        ).fetchall()
+
+    results = {
+        "rows": args.rows,
+        "days": args.days,
+        "insert_rows_per_s": round(args.rows / fill_s),
+        "rollup_rows": reader.execute("SELECT COUNT(*) FROM daily_rollups").fetchone()[0],
+        "daily_by_disease_crop_ms": {
+            "rollup": median_ms(lambda: store.daily_counts(first_day, last_day), args.repeat),
+            "scan": median_ms(scan_daily, args.repeat),
+        },
+        "severity_histogram_ms": {
+            "rollup": median_ms(lambda: store.severity_histogram(first_day, last_day, "Leaf Rust"), args.repeat),
+            "scan": median_ms(scan_severity, args.repeat),
+        },
+        "latest_100_by_disease_ms": median_ms(lambda: store.query(disease_type="Blast", limit=100), args.repeat),
+        "db_mb": round(os.path.getsize(args.path) / 1e6, 1),
+    }
+    store.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
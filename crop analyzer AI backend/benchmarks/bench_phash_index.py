@@ -0,0 +1,112 @@
+"""
+Benchmark the perceptual-hash Hamming index at millions of stored hashes.
+
+By default hashes come in clustered families (--family-size near-duplicates of
+one base hash, each within --max-distance bits of it), like repeated uploads of
+the same field. Family members share hash chunks, so they crowd the index
+buckets that uniform random hashes (--distribution uniform) spread evenly. With --live, each hash expires after the next
+--live insertions, as cache entries do, and the index should stay at that size
+however many hashes pass through it.
+
+Usage:
+    python -m benchmarks.bench_phash_index --size 2000000 --queries 2000 --max-distance 6
+    python -m benchmarks.bench_phash_index --size 2000000 --live 200000
+"""
+
+import argparse
+import json
+import random
+import resource
+import time
+from typing import Iterator
+
+from app.services.perceptual_hash import HammingIndex
+
+
+def flip_bits(value: int, count: int, rng: random.Random) -> int:
+    for bit in rng.sample(range(64), count):
+        value ^= 1 << bit
+    return value
+
+
+def hashes(args, rng: random.Random) -> Iterator[int]:
+    """An endless stream of hashes in the chosen distribution"""
+    while True:
+        if args.distribution == "uniform":
+            yield rng.getrandbits(64)
+            continue
+        base = rng.getrandbits(64)
+        for _ in range(args.family_size):
+            yield flip_bits(base, rng.randint(0, args.max_distance), rng)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=2_000_000, help="number of hashes inserted")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--max-distance", type=int, default=6)
+    parser.add_argument("--distribution", choices=["clustered", "uniform"], default="clustered")
+    parser.add_argument("--family-size", type=int, default=8, help="near-duplicates per base hash when clustered")
+    parser.add_argument("--live", type=int, default=0, help="hashes expire after this many later inserts, 0 = never")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    index = HammingIndex(max_distance=args.max_distance)
+    # Simulated clock, one tick per insert, far enough ahead that wall-clock expiry never applies
+    clock = time.time() + 10 ** 9
+
+    start = time.perf_counter()
+    stored = []
+    stream = hashes(args, rng)
+    for i in range(args.size):
+        value = next(stream)
+        if args.live:
+            index.add(value, str(i), expires_at=clock + i + args.live)
+            index.expire(now=clock + i)
+        else:
+            index.add(value, str(i))
+        # Queries probe hashes that are still indexed at the end
+        if i >= args.size - args.queries:
+            stored.append(value)
+    build_s = time.perf_counter() - start
+
+    # Half the queries are near-duplicates of stored hashes, half are unrelated
+    queries = []
+    for i in range(args.queries):
+        if i % 2 == 0:
+            queries.append((flip_bits(stored[i], rng.randint(0, args.max_distance), rng), True))
+        else:
+            queries.append((rng.getrandbits(64), False))
+
+    latencies = []
+    found = 0
+    match_counts = []
+    for value, expected in queries:
+        start = time.perf_counter()
+        matches = index.search(value)
+        latencies.append((time.perf_counter() - start) * 1000)
+        match_counts.append(len(matches))
+        if expected and matches:
+            found += 1
+
+    latencies.sort()
+    result = {
+        "distribution": args.distribution,
+        "inserted": args.size,
+        "size": len(index),
+        "max_distance": args.max_distance,
+        "build_seconds": round(build_s, 2),
+        "query_ms_p50": round(latencies[len(latencies) // 2], 4),
+        "query_ms_p99": round(latencies[int(len(latencies) * 0.99)], 4),
+        "query_ms_mean": round(sum(latencies) / len(latencies), 4),
+        "near_duplicate_recall": round(found / (args.queries // 2 or 1), 4),
+        "matches_per_query_mean": round(sum(match_counts) / len(match_counts), 2),
+        # ru_maxrss is KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
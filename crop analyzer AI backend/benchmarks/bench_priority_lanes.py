@@ -0,0 +1,152 @@
+"""
+Interactive latency while bulk work saturates upstream capacity, with and
+without the priority-lane scheduler.
+
+Starts benchmarks.mock_openrouter and, for each setting of SCHEDULER_ENABLED,
+the API with a fixed upstream concurrency (--slots). For --duration-s seconds,
+--bulk-concurrency clients keep /api/analyze busy as a bulk tenant (an API key
+mapped to the bulk lane) while --interactive-concurrency clients send ordinary
+uploads. Every upload is distinct (a counter after the JPEG end marker), so
+single-flight never merges them. Reports latency percentiles and completed requests per lane, and the
+scheduler's per-lane queue wait from /metrics.
+
+Usage:
+    python -m benchmarks.bench_priority_lanes --duration-s 20 --slots 4 --latency-ms 500
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import httpx
+
+from benchmarks.bench_upload_memory import free_port, wait_until_ready
+from benchmarks.load_test import make_corpus, mock_arguments, percentiles
+from benchmarks.mock_openrouter import add_arguments
+
+BULK_KEY = "bench-bulk-key"
+WAIT_METRIC = "crop_analyzer_scheduler_wait_seconds"
+
+
+def lane_waits(metrics_text: str) -> Dict[str, float]:
+    """Mean queue wait in ms per lane from the wait histogram's _sum and _count"""
+    sums: Dict[str, float] = {}
+    counts: Dict[str, float] = {}
+    for line in metrics_text.splitlines():
+        if not line.startswith(WAIT_METRIC) or 'lane="' not in line:
+            continue
+        lane = line.split('lane="', 1)[1].split('"', 1)[0]
+        value = float(line.rsplit(" ", 1)[1])
+        if line.startswith(WAIT_METRIC + "_sum"):
+            sums[lane] = value
+        elif line.startswith(WAIT_METRIC + "_count"):
+            counts[lane] = value
+    return {lane: round(sums[lane] / counts[lane] * 1000, 1) for lane in counts if counts[lane]}
+
+
+async def drive(base_url: str, corpus: List[bytes], args) -> dict:
+    latencies: Dict[str, List[float]] = {"interactive": [], "bulk": []}
+    errors: Dict[str, int] = {"interactive": 0, "bulk": 0}
+    deadline = time.monotonic() + args.duration_s
+    concurrency = args.bulk_concurrency + args.interactive_concurrency
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=300.0) as client:
+        async def client_loop(lane: str, index: int):
+            headers = {"X-API-Key": BULK_KEY} if lane == "bulk" else {}
+            sent = 0
+            while time.monotonic() < deadline:
+                # Bytes after the end-of-image marker change the digest but not the picture
+                payload = corpus[(index * 7 + sent) % len(corpus)] + f"{lane}-{index}-{sent}".encode()
+                sent += 1
+                start = time.perf_counter()
+                response = await client.post(
+                    f"{base_url}/api/analyze",
+                    files={"file": (f"{lane}_{index}_{sent}.jpg", payload, "image/jpeg")},
+                    headers=headers,
+                )
+                if response.status_code == 200:
+                    latencies[lane].append((time.perf_counter() - start) * 1000)
+                else:
+                    errors[lane] += 1
+                if lane == "interactive":
+                    # Farmers upload now and then, they do not hammer the API
+                    await asyncio.sleep(args.interactive_think_s)
+
+        await asyncio.gather(
+            *(client_loop("bulk", i) for i in range(args.bulk_concurrency)),
+            *(client_loop("interactive", i) for i in range(args.interactive_concurrency)),
+        )
+        metrics = (await client.get(f"{base_url}/metrics")).text
+
+    return {
+        lane: {"completed": len(samples), "errors": errors[lane], "latency_ms": percentiles(samples)}
+        for lane, samples in latencies.items()
+    } | {"queue_wait_ms_mean": lane_waits(metrics)}
+
+
+async def run(args) -> dict:
+    corpus = make_corpus(args.images, args.image_edge, args.seed)
+    mock_port = free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    mock = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.mock_openrouter", "--port", str(mock_port)] + mock_arguments(args)
+    )
+    results = {}
+    try:
+        await wait_until_ready(mock_url, path="/stats")
+        for enabled in ("false", "true"):
+            port = free_port()
+            env = dict(
+                os.environ,
+                OPENROUTER_API_KEY="load-test",
+                OPENROUTER_BASE_URL=f"{mock_url}/api/v1",
+                CACHE_ENABLED="false",
+                HISTORY_ENABLED="false",
+                UPSTREAM_WARMUP="false",
+                UPSTREAM_CONCURRENCY_INITIAL=str(args.slots),
+                UPSTREAM_CONCURRENCY_MIN=str(args.slots),
+                UPSTREAM_CONCURRENCY_MAX=str(args.slots),
+                UPSTREAM_HEDGE_PERCENTILE="0",
+                SCHEDULER_ENABLED=enabled,
+                SCHEDULER_API_KEYS=f"{BULK_KEY}=reanalysis:bulk",
+            )
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+                env=env,
+                stdout=subprocess.DEVNULL,
+            )
+            try:
+                base_url = f"http://127.0.0.1:{port}"
+                await wait_until_ready(base_url)
+                results["scheduler" if enabled == "true" else "fifo"] = await drive(base_url, corpus, args)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        mock.terminate()
+        mock.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration-s", type=float, default=20)
+    parser.add_argument("--slots", type=int, default=4, help="fixed upstream concurrency limit")
+    parser.add_argument("--bulk-concurrency", type=int, default=32)
+    parser.add_argument("--interactive-concurrency", type=int, default=2)
+    parser.add_argument("--interactive-think-s", type=float, default=0.5, help="pause between interactive uploads")
+    parser.add_argument("--images", type=int, default=20, help="synthetic images in the corpus")
+    parser.add_argument("--image-edge", type=int, default=480, help="longest edge of the largest images")
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Measure peak memory of building and sending one upstream request body.
+
+Compares the previous construction (base64 string, data-URL f-string, then
+httpx serialising the whole dict with json=) against StreamedJSONBody, which
+base64-encodes the image in chunks while the body is sent. Both bodies go
+through httpx to a transport that reads the request stream chunk by chunk
+without keeping it, so only the client side is measured. Peak is the
+tracemalloc high-water mark above the already allocated upload.
+
+Usage:
+    python -m benchmarks.bench_request_body --size-mb 10
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import tracemalloc
+
+import httpx
+
+from app.services.request_body import ImageData, StreamedJSONBody
+
+URL = "http://upstream.invalid/api/v1/chat/completions"
+
+
+class DrainTransport(httpx.AsyncBaseTransport):
+    """Consumes request bodies without buffering them and answers 200"""
+
+    def __init__(self):
+        self.bytes_received = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        async for chunk in request.stream:
+            self.bytes_received += len(chunk)
+        return httpx.Response(200, json={"ok": True})
+
+
+def payload(image_url) -> dict:
+    return {
+        "model": "openai/gpt-4o-mini",
+        "messages": [
+            {"role": "system", "content": "You are an agricultural plant pathologist."},
+            {"role": "user", "content": [
+                {"type": "text", "text": "Please analyze this crop image for disease detection."},
+                {"type": "image_url", "image_url": {"url": image_url}},
+            ]},
+        ],
+        "temperature": 0.1,
+        "max_tokens": 300,
+    }
+
+
+async def send_in_memory(client: httpx.AsyncClient, image: bytes) -> None:
+    base64_image = base64.b64encode(image).decode("utf-8")
+    await client.post(URL, json=payload(f"data:image/jpeg;base64,{base64_image}"))
+
+
+async def send_streamed(client: httpx.AsyncClient, image: bytes) -> None:
+    body = StreamedJSONBody(payload(ImageData(image, "image/jpeg")))
+    await client.post(URL, content=body, headers={"Content-Length": str(body.content_length)})
+
+
+async def measure(send, image: bytes) -> dict:
+    transport = DrainTransport()
+    async with httpx.AsyncClient(transport=transport) as client:
+        # Warm up lazily allocated client state outside the measurement
+        await client.get(URL)
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        await send(client, image)
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+    return {
+        "peak_mb": round(peak / 1024 / 1024, 2),
+        "peak_to_upload_ratio": round(peak / len(image), 3),
+        "body_mb": round(transport.bytes_received / 1024 / 1024, 2),
+    }
+
+
+async def run(args) -> dict:
+    image = os.urandom(int(args.size_mb * 1024 * 1024))
+    in_memory = await measure(send_in_memory, image)
+    streamed = await measure(send_streamed, image)
+    return {"upload_mb": args.size_mb, "in_memory_json": in_memory, "streamed_body": streamed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=10, help="size of the image sent upstream")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
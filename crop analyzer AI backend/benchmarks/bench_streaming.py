@@ -0,0 +1,116 @@
+"""
+Compare time-to-result of buffered vs streamed single-image completions.
+
+The upstream is simulated in-process: it emits the answer a few characters at a
+time with a fixed delay per chunk, after a time-to-first-token delay. Models often
+keep talking after the XML (closing tags, explanations despite the prompt), which
+--trailing-chars simulates; the streamed call stops reading once the four fields
+have closed, while the buffered call waits for the whole completion.
+
+Usage:
+    python -m benchmarks.bench_streaming --runs 20 --chunk-delay-ms 15 --trailing-chars 120
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import statistics
+import time
+
+import httpx
+from PIL import Image
+
+from app.services.crop_analyzer import CropAnalyzer
+
+ANSWER = (
+    "<analysis>\n"
+    "    <disease_type>Late Blight</disease_type>\n"
+    "    <severity_level>7</severity_level>\n"
+    "    <affected_area_percentage>45</affected_area_percentage>\n"
+    "    <crop_type>Tomato</crop_type>\n"
+)
+TRAILER = "</analysis>\n\nThe lesions are consistent with Phytophthora infestans on tomato foliage. "
+
+
+def make_transport(first_token_s: float, chunk_delay_s: float, chunk_chars: int, trailing_chars: int):
+    text = ANSWER + (TRAILER * (trailing_chars // len(TRAILER) + 1))[:max(len("</analysis>"), trailing_chars)]
+    usage = {"prompt_tokens": 1000, "completion_tokens": len(text) // 4, "total_tokens": 1000 + len(text) // 4}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        chunks = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+        if not body.get("stream"):
+            await asyncio.sleep(first_token_s + chunk_delay_s * len(chunks))
+            return httpx.Response(200, json={
+                "model": body["model"], "choices": [{"message": {"content": text}}], "usage": usage,
+            })
+
+        async def events():
+            await asyncio.sleep(first_token_s)
+            for chunk in chunks:
+                await asyncio.sleep(chunk_delay_s)
+                yield ("data: " + json.dumps({"model": body["model"], "choices": [{"delta": {"content": chunk}}]}) + "\n\n").encode()
+            yield ("data: " + json.dumps({"choices": [], "usage": usage}) + "\n\n").encode()
+            yield b"data: [DONE]\n\n"
+
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=events())
+
+    return httpx.MockTransport(handler)
+
+
+def image_bytes(seed: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (seed % 256, (seed * 7) % 256, 90)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+async def measure(streaming: bool, transport: httpx.MockTransport, runs: int) -> dict:
+    analyzer = CropAnalyzer(
+        "benchmark", http_client=httpx.AsyncClient(transport=transport), preprocess_enabled=False, streaming=streaming
+    )
+    to_result, to_first_field = [], []
+    for run in range(runs):
+        first = []
+        start = time.perf_counter()
+        await analyzer.analyze_crop_image(
+            image_bytes(run), "leaf.png",
+            on_field=lambda _field, _value: first or first.append(time.perf_counter() - start),
+        )
+        to_result.append((time.perf_counter() - start) * 1000)
+        to_first_field.append((first[0] if first else time.perf_counter() - start) * 1000)
+    await analyzer.http_client.aclose()
+    return {
+        "time_to_first_field_ms_p50": round(statistics.median(to_first_field), 1),
+        "time_to_result_ms_p50": round(statistics.median(to_result), 1),
+        "time_to_result_ms_max": round(max(to_result), 1),
+    }
+
+
+async def run(args) -> dict:
+    transport = make_transport(args.first_token_ms / 1000, args.chunk_delay_ms / 1000, args.chunk_chars, args.trailing_chars)
+    buffered = await measure(False, transport, args.runs)
+    streamed = await measure(True, transport, args.runs)
+    return {
+        "runs": args.runs,
+        "buffered": buffered,
+        "streamed": streamed,
+        "time_to_result_saved_pct": round(
+            100 * (1 - streamed["time_to_result_ms_p50"] / buffered["time_to_result_ms_p50"]), 1
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--first-token-ms", type=float, default=400, help="upstream time to first token")
+    parser.add_argument("--chunk-delay-ms", type=float, default=15, help="delay between streamed chunks")
+    parser.add_argument("--chunk-chars", type=int, default=4, help="characters per streamed chunk (~1 token)")
+    parser.add_argument("--trailing-chars", type=int, default=120, help="text the model emits after the last field")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
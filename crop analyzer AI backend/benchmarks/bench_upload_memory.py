@@ -0,0 +1,122 @@
+"""
+Measure server peak RSS while ingesting concurrent uploads.
+
+Starts the API in a uvicorn subprocess without an OpenRouter key, so every
+in-limit upload is fully ingested and then answered with 500 before any
+upstream call; oversize uploads should be rejected before they are buffered.
+Peak RSS is read from /proc (Linux only).
+
+Usage:
+    python -m benchmarks.bench_upload_memory --concurrency 100 --size-mb 9 --oversize-mb 200
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def read_rss_mb(pid: int) -> dict:
+    values = {}
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                name, amount, _unit = line.split()
+                values[name.rstrip(":")] = round(int(amount) / 1024, 1)
+    return {"rss_mb": values.get("VmRSS"), "peak_rss_mb": values.get("VmHWM")}
+
+
+async def wait_until_ready(base_url: str, timeout: float = 20.0, path: str = "/api/health") -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(f"{base_url}{path}")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+async def upload_many(base_url: str, payload: bytes, count: int, concurrency: int) -> dict:
+    statuses = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=120.0) as client:
+        async def one():
+            async with semaphore:
+                try:
+                    response = await client.post(
+                        f"{base_url}/api/analyze", files={"file": ("bench.jpg", payload, "image/jpeg")}
+                    )
+                    key = str(response.status_code)
+                except httpx.TransportError as e:
+                    # Early rejection can close the connection while the body is still being sent
+                    key = type(e).__name__
+                statuses[key] = statuses.get(key, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(count)))
+        elapsed = time.perf_counter() - start
+
+    return {"statuses": statuses, "seconds": round(elapsed, 2)}
+
+
+async def run(args) -> dict:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, OPENROUTER_API_KEY="", CACHE_ENABLED="false", MAX_FILE_SIZE_MB=str(args.limit_mb))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        env=env,
+    )
+    try:
+        await wait_until_ready(base_url)
+        results = {"baseline": read_rss_mb(server.pid)}
+
+        payload = os.urandom(args.size_mb * 1024 * 1024)
+        results["in_limit"] = await upload_many(base_url, payload, args.concurrency, args.concurrency)
+        results["in_limit"].update(read_rss_mb(server.pid))
+        del payload
+
+        oversize = b"\0" * (args.oversize_mb * 1024 * 1024)
+        results["oversize"] = await upload_many(base_url, oversize, args.oversize_count, args.oversize_count)
+        results["oversize"].update(read_rss_mb(server.pid))
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--size-mb", type=int, default=9, help="size of each in-limit upload")
+    parser.add_argument("--limit-mb", type=int, default=10, help="MAX_FILE_SIZE_MB for the server")
+    parser.add_argument("--oversize-mb", type=int, default=200, help="size of each oversize upload")
+    parser.add_argument("--oversize-count", type=int, default=10)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
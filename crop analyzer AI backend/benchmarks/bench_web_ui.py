@@ -0,0 +1,109 @@
+"""
+Measure what the web interface costs a browser: bytes transferred and server
+time for a first visit and a repeat visit.
+
+The page and the stylesheets/scripts it references are fetched in-process
+through httpx's ASGI transport (no network), advertising gzip and brotli like
+a browser. The repeat visit behaves like a browser cache: responses with a
+max-age are reused without a request, responses with an ETag are revalidated
+with If-None-Match, everything else is downloaded again. Transfer time is
+estimated for a slow mobile link (--link-kbps).
+
+Usage:
+    python -m benchmarks.bench_web_ui --requests 200 --link-kbps 256
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import statistics
+import time
+from typing import Dict, List, Tuple
+
+import httpx
+
+from app.main import app
+
+BASE_URL = "http://testserver"
+ACCEPT_ENCODING = "gzip, deflate, br"
+
+
+def referenced_assets(html: str) -> List[str]:
+    return re.findall(r'<(?:link[^>]+href|script[^>]+src)="(/[^"]+)"', html)
+
+
+async def fetch(client: httpx.AsyncClient, path: str, headers: Dict[str, str]) -> Tuple[httpx.Response, int, float]:
+    """Response, bytes on the wire (body as sent, before decompression) and server time in ms"""
+    start = time.perf_counter()
+    response = await client.get(path, headers=headers)
+    return response, response.num_bytes_downloaded, (time.perf_counter() - start) * 1000
+
+
+async def visit(client: httpx.AsyncClient, cache: Dict[str, httpx.Response]) -> Dict[str, float]:
+    """One page load; fills and uses `cache` like a browser would"""
+    totals = {"requests": 0, "bytes": 0, "server_ms": 0.0, "not_modified": 0}
+
+    async def get(path: str) -> str:
+        cached = cache.get(path)
+        headers = {"Accept-Encoding": ACCEPT_ENCODING}
+        if cached is not None:
+            cache_control = cached.headers.get("cache-control", "")
+            if "max-age" in cache_control and "max-age=0" not in cache_control:
+                return cached.text
+            if cached.headers.get("etag"):
+                headers["If-None-Match"] = cached.headers["etag"]
+        response, wire_bytes, elapsed_ms = await fetch(client, path, headers)
+        totals["requests"] += 1
+        totals["bytes"] += wire_bytes
+        totals["server_ms"] += elapsed_ms
+        if response.status_code == 304:
+            totals["not_modified"] += 1
+            return cached.text
+        cache[path] = response
+        return response.text
+
+    html = await get("/")
+    for path in referenced_assets(html):
+        await get(path)
+    totals["server_ms"] = round(totals["server_ms"], 2)
+    return totals
+
+
+async def run(args) -> dict:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url=BASE_URL) as client:
+        cache: Dict[str, httpx.Response] = {}
+        first = await visit(client, cache)
+        repeat = await visit(client, cache)
+
+        # Server time of the page itself, first-visit style (no validators)
+        timings = []
+        for _ in range(args.requests):
+            _response, _wire_bytes, elapsed_ms = await fetch(client, "/", {"Accept-Encoding": ACCEPT_ENCODING})
+            timings.append(elapsed_ms)
+
+    def link_ms(byte_count: float) -> float:
+        return round(byte_count * 8 / args.link_kbps, 1)
+
+    return {
+        "first_visit": dict(first, link_ms=link_ms(first["bytes"])),
+        "repeat_visit": dict(repeat, link_ms=link_ms(repeat["bytes"])),
+        "page_server_ms": {
+            "p50": round(statistics.median(timings), 3),
+            "mean": round(statistics.fmean(timings), 3),
+        },
+        "link_kbps": args.link_kbps,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="page requests timed for page_server_ms")
+    parser.add_argument("--link-kbps", type=float, default=256, help="link speed for the transfer-time estimate")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
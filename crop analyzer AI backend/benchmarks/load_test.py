@@ -0,0 +1,358 @@
+"""
+Load-test /api/analyze against the local OpenRouter stand-in.
+
+Starts benchmarks.mock_openrouter and the API (uvicorn subprocesses, the API
+pointed at the mock through OPENROUTER_BASE_URL), then drives /api/analyze at a
+fixed concurrency with a corpus of synthetic leaf images. Reports throughput,
+client-side latency percentiles, status counts, RSS of the API process (sampled
+from /proc, Linux only; preprocessing workers are separate processes and not
+included), server event-loop lag (from the /metrics histogram), the mock's counters and
+prompt tokens per upstream call (which image detail selection lowers), as recorded by
+the API itself. The API's token counts are checked against the mock's: they must be
+equal, except that hedged requests the API cancelled are only counted by the mock.
+The service cache is off unless --cache is given, so every request reaches the mock.
+
+Results are printed as JSON and, with --output, written to a file; --compare
+adds the relative change of the headline numbers against an earlier result.
+
+Usage:
+    python -m benchmarks.load_test --requests 500 --concurrency 32 --latency-ms 800 --output load.json
+    python -m benchmarks.load_test --requests 500 --concurrency 32 --compare load.json
+    python -m benchmarks.load_test --url http://127.0.0.1:5000 --requests 200   # existing server, no RSS
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+from PIL import Image, ImageDraw
+
+from benchmarks.bench_upload_memory import free_port, read_rss_mb, wait_until_ready
+from benchmarks.mock_openrouter import add_arguments
+
+LAG_METRIC = "crop_analyzer_event_loop_lag_seconds"
+
+# Headline numbers compared by --compare, and whether higher is better
+COMPARED = {
+    "rps": True,
+    "latency_ms.p50": False,
+    "latency_ms.p95": False,
+    "latency_ms.p99": False,
+    "rss_mb.peak": False,
+    "event_loop_lag_ms.p99": False,
+    "prompt_tokens_per_call": False,
+}
+
+
+def make_corpus(count: int, max_edge: int, seed: int) -> List[bytes]:
+    """Green leaves with brown lesions and sensor-like noise, in varied sizes"""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        width = rng.randint(max_edge // 2, max_edge)
+        height = rng.randint(max_edge // 2, max_edge)
+        image = Image.new("RGB", (width, height), (rng.randint(20, 80), rng.randint(110, 190), rng.randint(20, 70)))
+        draw = ImageDraw.Draw(image)
+        for _spot in range(rng.randint(0, 25)):
+            x, y, r = rng.randrange(width), rng.randrange(height), rng.randint(4, max(5, width // 12))
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=(rng.randint(90, 140), rng.randint(60, 90), 30))
+        noise = Image.effect_noise((width, height), 24).convert("RGB")
+        image = Image.blend(image, noise, 0.15)
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=rng.randint(80, 95))
+        corpus.append(buffer.getvalue())
+    return corpus
+
+
+def percentiles(samples: List[float]) -> Dict[str, Optional[float]]:
+    if len(samples) < 2:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    cuts = statistics.quantiles(samples, n=100)
+    return {
+        "p50": round(cuts[49], 1),
+        "p95": round(cuts[94], 1),
+        "p99": round(cuts[98], 1),
+        "mean": round(statistics.fmean(samples), 1),
+        "max": round(max(samples), 1),
+    }
+
+
+def read_histogram(metrics_text: str, name: str) -> Dict[str, Any]:
+    """Cumulative buckets, sum and count of an unlabelled histogram from Prometheus text"""
+    buckets: Dict[float, float] = {}
+    totals = {"sum": 0.0, "count": 0.0}
+    for line in metrics_text.splitlines():
+        if line.startswith(f'{name}_bucket{{le="'):
+            bound = line.split('le="', 1)[1].split('"', 1)[0]
+            buckets[float(bound)] = float(line.rsplit(" ", 1)[1])
+        elif line.startswith(f"{name}_sum "):
+            totals["sum"] = float(line.rsplit(" ", 1)[1])
+        elif line.startswith(f"{name}_count "):
+            totals["count"] = float(line.rsplit(" ", 1)[1])
+    return {"buckets": buckets, **totals}
+
+
+def lag_summary(before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, Optional[float]]:
+    """Event-loop lag during the run; p99 and max are bucket upper bounds (None past the last bucket)"""
+    count = after["count"] - before["count"]
+    if count <= 0:
+        return {"samples": 0, "mean": None, "p99": None, "max": None}
+    deltas = [(bound, after["buckets"][bound] - before["buckets"].get(bound, 0.0)) for bound in sorted(after["buckets"])]
+
+    def upper_bound(share: float) -> Optional[float]:
+        bound = next(bound for bound, cumulative in deltas if cumulative >= share * count)
+        return bound * 1000 if bound != float("inf") else None
+
+    return {
+        "samples": int(count),
+        "mean": round((after["sum"] - before["sum"]) / count * 1000, 2),
+        "p99": upper_bound(0.99),
+        "max": upper_bound(1.0),
+    }
+
+
+async def scrape_lag(client: httpx.AsyncClient, base_url: str) -> Optional[Dict[str, Any]]:
+    try:
+        response = await client.get(f"{base_url}/metrics")
+    except httpx.TransportError:
+        return None
+    if response.status_code != 200:
+        return None
+    return read_histogram(response.text, LAG_METRIC)
+
+
+async def sample_rss(pid: Optional[int], samples: List[float], stop: asyncio.Event) -> None:
+    while pid is not None and not stop.is_set():
+        rss = read_rss_mb(pid)["rss_mb"]
+        if rss is not None:
+            samples.append(rss)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=0.25)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def drive(base_url: str, corpus: List[bytes], requests: int, concurrency: int, server_pid: Optional[int]) -> dict:
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    rss_samples: List[float] = []
+    next_request = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=120.0) as client:
+        async def worker():
+            nonlocal next_request
+            while next_request < requests:
+                index = next_request
+                next_request += 1
+                payload = corpus[index % len(corpus)]
+                start = time.perf_counter()
+                try:
+                    response = await client.post(
+                        f"{base_url}/api/analyze", files={"file": (f"leaf_{index}.jpg", payload, "image/jpeg")}
+                    )
+                    key = str(response.status_code)
+                except httpx.TransportError as e:
+                    key = type(e).__name__
+                latencies.append((time.perf_counter() - start) * 1000)
+                statuses[key] = statuses.get(key, 0) + 1
+
+        lag_before = await scrape_lag(client, base_url)
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(sample_rss(server_pid, rss_samples, stop))
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await sampler
+        lag_after = await scrape_lag(client, base_url)
+
+    rss = read_rss_mb(server_pid) if server_pid is not None else {"rss_mb": None, "peak_rss_mb": None}
+    return {
+        "duration_s": round(elapsed, 2),
+        "rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": percentiles(latencies),
+        "statuses": statuses,
+        "rss_mb": {
+            "mean": round(statistics.fmean(rss_samples), 1) if rss_samples else None,
+            "peak": max(rss_samples) if rss_samples else None,
+            "final": rss["rss_mb"],
+            "process_peak": rss["peak_rss_mb"],
+        },
+        "event_loop_lag_ms": lag_summary(lag_before, lag_after) if lag_before and lag_after else None,
+    }
+
+
+async def settled_usage(client: httpx.AsyncClient, base_url: str, timeout: float = 35.0) -> Dict[str, Any]:
+    """The API's health report once no streamed completion is still being read for its usage"""
+    deadline = time.monotonic() + timeout
+    while True:
+        health = (await client.get(f"{base_url}/api/health")).json()
+        if not health["upstream_usage"]["stream_drains"]["in_progress"] or time.monotonic() > deadline:
+            return health
+        await asyncio.sleep(0.2)
+
+
+def token_accounting(health: Dict[str, Any], mock: Dict[str, Any]) -> Dict[str, Any]:
+    """Prompt and cached tokens recorded by the API next to those the mock reported"""
+    modes = [stats for name, stats in health["upstream_usage"].items() if name != "stream_drains"]
+    app = {
+        "calls": sum(stats["calls"] for stats in modes),
+        "prompt_tokens": sum(stats["prompt_tokens"] for stats in modes),
+        "cached_tokens": sum(stats["cached_tokens"] for stats in modes),
+    }
+    answered = mock["requests"] - mock["errors"] - mock["rate_limited"]
+    hedges = health["upstream_resilience"]["hedges"]
+    if hedges:
+        # A cancelled hedge was counted by the mock when it arrived but never answered the API
+        consistent = 0 < app["prompt_tokens"] <= mock["prompt_tokens"] and app["calls"] <= answered
+    else:
+        consistent = (
+            app["prompt_tokens"] == mock["prompt_tokens"]
+            and app["cached_tokens"] == mock["cached_tokens"]
+            and app["calls"] == answered
+        )
+    return {
+        "app": app,
+        "mock": {"calls": answered, "prompt_tokens": mock["prompt_tokens"], "cached_tokens": mock["cached_tokens"]},
+        "hedges": hedges,
+        "abandoned_stream_drains": health["upstream_usage"]["stream_drains"]["abandoned"],
+        "consistent": consistent,
+    }
+
+
+def lookup(results: dict, dotted: str) -> Optional[float]:
+    value: Any = results
+    for part in dotted.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def compare(current: dict, baseline: dict) -> Dict[str, Any]:
+    """Relative change per headline number; `regressed` when it moved the wrong way by more than 5%"""
+    comparison = {}
+    for key, higher_is_better in COMPARED.items():
+        now, before = lookup(current, key), lookup(baseline, key)
+        if not now or not before:
+            continue
+        change_pct = round(100 * (now - before) / before, 1)
+        comparison[key] = {
+            "baseline": before,
+            "current": now,
+            "change_pct": change_pct,
+            "regressed": change_pct < -5 if higher_is_better else change_pct > 5,
+        }
+    return comparison
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def mock_arguments(args: argparse.Namespace) -> List[str]:
+    names = [
+        "latency_ms", "latency_sigma", "ttft_share", "chunk_chars", "error_rate",
+        "rate_limit_rate", "retry_after_s", "malformed_rate", "low_confidence_rate", "seed",
+    ]
+    arguments = [item for name in names for item in (f"--{name.replace('_', '-')}", str(getattr(args, name)))]
+    return arguments + ["--prompt-cache" if args.prompt_cache else "--no-prompt-cache"]
+
+
+async def run(args) -> dict:
+    corpus = make_corpus(args.images, args.image_edge, args.seed)
+    processes = []
+    try:
+        mock_url = None
+        server_pid = None
+        base_url = args.url
+        if base_url is None:
+            mock_port, port = free_port(), free_port()
+            mock_url = f"http://127.0.0.1:{mock_port}"
+            processes.append(subprocess.Popen(
+                [sys.executable, "-m", "benchmarks.mock_openrouter", "--port", str(mock_port)] + mock_arguments(args)
+            ))
+            await wait_until_ready(mock_url, path="/stats")
+
+            env = dict(
+                os.environ,
+                OPENROUTER_API_KEY="load-test",
+                OPENROUTER_BASE_URL=f"{mock_url}/api/v1",
+                CACHE_ENABLED="true" if args.cache else "false",
+            )
+            env.update(pair.split("=", 1) for pair in args.env)
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+                env=env,
+                stdout=subprocess.DEVNULL,
+            )
+            processes.append(server)
+            server_pid = server.pid
+            base_url = f"http://127.0.0.1:{port}"
+            await wait_until_ready(base_url)
+
+        results = {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "images": len(corpus),
+            "image_kb_mean": round(statistics.fmean(len(image) for image in corpus) / 1024, 1),
+        }
+        results.update(await drive(base_url, corpus, args.requests, args.concurrency, server_pid))
+        if mock_url is not None:
+            async with httpx.AsyncClient() as client:
+                health = await settled_usage(client, base_url)
+                results["mock"] = (await client.get(f"{mock_url}/stats")).json()
+            accounting = token_accounting(health, results["mock"])
+            results["token_accounting"] = accounting
+            calls = accounting["app"]["calls"]
+            results["prompt_tokens_per_call"] = round(accounting["app"]["prompt_tokens"] / calls, 1) if calls else None
+            if not accounting["consistent"]:
+                print(f"Token accounting differs from the mock: {json.dumps(accounting)}", file=sys.stderr)
+        return results
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--images", type=int, default=40, help="synthetic images in the corpus")
+    parser.add_argument("--image-edge", type=int, default=1600, help="longest edge of the largest images")
+    parser.add_argument("--cache", action="store_true", help="leave the service's result cache on")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra server environment")
+    parser.add_argument("--url", help="load an already running server instead of starting one (and the mock)")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.compare:
+        with open(args.compare) as baseline:
+            results["comparison"] = compare(results, json.load(baseline))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
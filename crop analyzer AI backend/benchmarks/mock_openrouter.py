@@ -0,0 +1,215 @@
+"""
+Local stand-in for the OpenRouter chat-completions API, for load tests that
+should not spend money on the real one.
+
+Latency is drawn from a log-normal distribution around --latency-ms (spread
+--latency-sigma); streamed answers send the first chunk after --ttft-share of
+it and spread the rest across the chunks. A fraction of requests can be
+answered with 5xx errors, 429s with Retry-After, or malformed XML (no fields,
+truncated, or out-of-range values), and a fraction of answers to low-detail
+images reports low confidence. A message with several images (the service's packed
+batch calls) is answered with one indexed <analysis> block per image inside
+<analyses>; there, a malformed answer is a block without fields. Prompt tokens per image follow the image's
+`detail` hint (low 85, high 765, none 850). With --prompt-cache, a system prompt seen
+before is reported as cached in usage.prompt_tokens_details, like providers do.
+Counters are served on GET /stats.
+
+Point the service at it with OPENROUTER_BASE_URL=http://127.0.0.1:<port>/api/v1.
+
+Usage:
+    python -m benchmarks.mock_openrouter --port 8900 --latency-ms 800 --rate-limit-rate 0.02 --malformed-rate 0.05
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+DISEASES = [
+    ("Late Blight", "Tomato"), ("Early Blight", "Potato"), ("Leaf Rust", "Wheat"),
+    ("Gray Leaf Spot", "Maize"), ("Powdery Mildew", "Barley"), ("Healthy", "Teff"),
+]
+
+MALFORMED = [
+    "I'm sorry, I can't determine the crop in this image.",
+    "<analysis>\n    <disease_type>Late Blight</disease_type>\n    <severity_le",
+    "<analysis><disease_type>Rust</disease_type><severity_level>high</severity_level>"
+    "<affected_area_percentage>250</affected_area_percentage><crop_type>Wheat</crop_type></analysis>",
+]
+
+
+@dataclass
+class MockConfig:
+    latency_ms: float = 800.0
+    latency_sigma: float = 0.3
+    ttft_share: float = 0.4
+    chunk_chars: int = 8
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after_s: float = 1.0
+    malformed_rate: float = 0.0
+    low_confidence_rate: float = 0.0
+    prompt_cache: bool = True
+    seed: int = 0
+
+
+# Prompt tokens charged per image by its detail hint, roughly OpenAI's for a 1024px image
+IMAGE_TOKENS = {"low": 85, "high": 765, None: 850}
+
+
+def analysis_block(rng: random.Random, config: MockConfig, low_detail: bool = False, index: Optional[int] = None) -> str:
+    opening = "<analysis>" if index is None else f'<analysis index="{index}">'
+    disease, crop = rng.choice(DISEASES)
+    healthy = disease == "Healthy"
+    confidence = "low" if low_detail and rng.random() < config.low_confidence_rate else "high"
+    return (
+        f"{opening}\n"
+        f"    <confidence>{confidence}</confidence>\n"
+        f"    <disease_type>{disease}</disease_type>\n"
+        f"    <severity_level>{1 if healthy else rng.randint(2, 9)}</severity_level>\n"
+        f"    <affected_area_percentage>{0 if healthy else rng.randint(5, 80)}</affected_area_percentage>\n"
+        f"    <crop_type>{crop}</crop_type>\n"
+        "</analysis>"
+    )
+
+
+def answer_text(rng: random.Random, config: MockConfig, details: List[Optional[str]]) -> Tuple[str, int]:
+    """The answer for a message with these image detail hints, and how many of its analyses are malformed"""
+    if len(details) <= 1:
+        if rng.random() < config.malformed_rate:
+            return rng.choice(MALFORMED), 1
+        return analysis_block(rng, config, "low" in details), 0
+    blocks = []
+    malformed = 0
+    for index, detail in enumerate(details):
+        if rng.random() < config.malformed_rate:
+            malformed += 1
+            blocks.append(f'<analysis index="{index}">I cannot tell what this image shows.</analysis>')
+        else:
+            blocks.append(analysis_block(rng, config, detail == "low", index))
+    return "<analyses>\n" + "\n".join(blocks) + "\n</analyses>", malformed
+
+
+def create_app(config: MockConfig) -> FastAPI:
+    app = FastAPI(title="Mock OpenRouter")
+    rng = random.Random(config.seed)
+    stats: Dict[str, int] = {
+        "requests": 0, "streamed": 0, "errors": 0, "rate_limited": 0, "malformed": 0,
+        "prompt_tokens": 0, "cached_tokens": 0, "low_detail_images": 0,
+    }
+    seen_prompts = set()
+
+    def sample_latency_s() -> float:
+        return config.latency_ms / 1000 * math.exp(rng.gauss(0, config.latency_sigma))
+
+    @app.post("/api/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        roll = rng.random()
+        if roll < config.rate_limit_rate:
+            stats["rate_limited"] += 1
+            return JSONResponse(
+                {"error": {"code": 429, "message": "Rate limit exceeded"}},
+                status_code=429,
+                headers={"Retry-After": str(config.retry_after_s)},
+            )
+        latency = sample_latency_s()
+        if roll < config.rate_limit_rate + config.error_rate:
+            stats["errors"] += 1
+            await asyncio.sleep(latency / 2)
+            return JSONResponse({"error": {"code": 502, "message": "Upstream error"}}, status_code=502)
+
+        details = [
+            part["image_url"].get("detail")
+            for message in body.get("messages", []) if isinstance(message.get("content"), list)
+            for part in message["content"] if part.get("type") == "image_url"
+        ]
+        text, malformed = answer_text(rng, config, details)
+        stats["malformed"] += malformed
+        stats["low_detail_images"] += details.count("low")
+        usage = {
+            "prompt_tokens": 200 + sum(IMAGE_TOKENS.get(detail, IMAGE_TOKENS[None]) for detail in details),
+            "completion_tokens": len(text) // 4,
+        }
+        stats["prompt_tokens"] += usage["prompt_tokens"]
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        system = json.dumps([message["content"] for message in body.get("messages", []) if message.get("role") == "system"])
+        if config.prompt_cache and system in seen_prompts:
+            cached = len(system) // 4
+            usage["prompt_tokens_details"] = {"cached_tokens": cached}
+            stats["cached_tokens"] += cached
+        seen_prompts.add(system)
+        model = body.get("model", "mock")
+
+        if not body.get("stream"):
+            await asyncio.sleep(latency)
+            return {"model": model, "choices": [{"message": {"role": "assistant", "content": text}}], "usage": usage}
+
+        stats["streamed"] += 1
+        chunks = [text[i:i + config.chunk_chars] for i in range(0, len(text), config.chunk_chars)]
+        chunk_delay = latency * (1 - config.ttft_share) / max(1, len(chunks))
+
+        async def events():
+            yield b": OPENROUTER PROCESSING\n\n"
+            await asyncio.sleep(latency * config.ttft_share)
+            for chunk in chunks:
+                payload = {"model": model, "choices": [{"delta": {"content": chunk}}]}
+                yield f"data: {json.dumps(payload)}\n\n".encode()
+                await asyncio.sleep(chunk_delay)
+            yield f"data: {json.dumps({'model': model, 'choices': [], 'usage': usage})}\n\n".encode()
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    async def get_stats() -> Dict[str, Any]:
+        return {"config": asdict(config), **stats}
+
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Mock options, shared with the load test that spawns this server"""
+    defaults = MockConfig()
+    parser.add_argument("--latency-ms", type=float, default=defaults.latency_ms, help="median completion latency")
+    parser.add_argument("--latency-sigma", type=float, default=defaults.latency_sigma, help="log-normal spread")
+    parser.add_argument("--ttft-share", type=float, default=defaults.ttft_share, help="share of latency before the first chunk")
+    parser.add_argument("--chunk-chars", type=int, default=defaults.chunk_chars, help="characters per streamed chunk")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="fraction answered with 502")
+    parser.add_argument("--rate-limit-rate", type=float, default=defaults.rate_limit_rate, help="fraction answered with 429")
+    parser.add_argument("--retry-after-s", type=float, default=defaults.retry_after_s, help="Retry-After sent with 429s")
+    parser.add_argument("--malformed-rate", type=float, default=defaults.malformed_rate, help="fraction with malformed XML")
+    parser.add_argument(
+        "--low-confidence-rate", type=float, default=defaults.low_confidence_rate,
+        help="fraction of low-detail answers reporting low confidence",
+    )
+    parser.add_argument(
+        "--prompt-cache", action=argparse.BooleanOptionalAction, default=defaults.prompt_cache,
+        help="report repeated system prompts as cached tokens",
+    )
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(**{name: getattr(args, name) for name in asdict(MockConfig())})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import io
+import os
+import random
+
+# Before any app module reads its configuration
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+
+import httpx
+import pytest
+from PIL import Image
+
+from app.services.crop_analyzer import CropAnalyzer
+from app.services.resilience import ResilientCaller, UpstreamTarget
+from benchmarks.mock_openrouter import MockConfig, create_app
+
+MOCK_BASE_URL = "http://mock-openrouter"
+MOCK_URL = MOCK_BASE_URL + "/api/v1/chat/completions"
+
+
+@pytest.fixture
+def image_bytes():
+    """Factory for small noise JPEGs; the same seed gives the same bytes, different seeds different images"""
+
+    def make(seed: int = 0, size=(64, 64)) -> bytes:
+        rng = random.Random(seed)
+        image = Image.frombytes("RGB", size, bytes(rng.getrandbits(8) for _ in range(size[0] * size[1] * 3)))
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG")
+        return buffer.getvalue()
+
+    return make
+
+
+@pytest.fixture
+def mock_upstream():
+    """
+    Factory for an httpx client served in-process by benchmarks.mock_openrouter;
+    keyword arguments are MockConfig fields. Latency defaults to a few milliseconds.
+    The mock's counters are at GET /stats on the same client.
+    """
+
+    def make(**config) -> httpx.AsyncClient:
+        config.setdefault("latency_ms", 5.0)
+        config.setdefault("latency_sigma", 0.0)
+        app = create_app(MockConfig(**config))
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url=MOCK_BASE_URL, timeout=10.0)
+
+    return make
+
+
+@pytest.fixture
+def analyzer():
+    """Factory for a CropAnalyzer calling the given mock client, without a cache or preprocessing pool"""
+
+    def make(client: httpx.AsyncClient, models=("mock/a",), streaming: bool = False, **options) -> CropAnalyzer:
+        resilience = options.pop("resilience", None) or ResilientCaller(
+            [UpstreamTarget(model, MOCK_URL) for model in models], max_attempts=1, hedge_percentile=0
+        )
+        return CropAnalyzer(
+            "test",
+            http_client=client,
+            resilience=resilience,
+            streaming=streaming,
+            preprocess_enabled=False,
+            **options,
+        )
+
+    return make
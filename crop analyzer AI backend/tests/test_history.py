@@ -0,0 +1,69 @@
+import asyncio
+import calendar
+
+from app.services.history import HistoryStore
+
+DAY_1 = calendar.timegm((2026, 5, 1, 12, 0, 0))
+DAY_2 = DAY_1 + 86400
+
+
+def response(digest: str, cache_status: str = "miss", disease_type: str = "Leaf Rust", severity_level: int = 6):
+    return {
+        "image_digest": digest,
+        "model": "mock/a",
+        "response_time_ms": 100,
+        "disease_type": disease_type,
+        "crop_type": "Wheat",
+        "severity_level": severity_level,
+        "affected_area_percentage": 30.0,
+        "cache_status": cache_status,
+        "filename": f"{digest}.jpg",
+    }
+
+
+def store_with(tmp_path, records):
+    store = HistoryStore(str(tmp_path / "history.sqlite3"))
+    for result, recorded_at in records:
+        store.record(result, "analyze", recorded_at=recorded_at)
+    asyncio.run(store.flush())
+    return store
+
+
+def test_rollups_count_each_diagnosed_image_once_per_day(tmp_path):
+    store = store_with(tmp_path, [
+        (response("a"), DAY_1),
+        (response("a", "hit"), DAY_1),
+        (response("a", "coalesced"), DAY_1),
+        # A resized copy of "a"
+        (response("b", "near_hit"), DAY_1),
+        (response("c", disease_type="Analysis Failed", severity_level=1), DAY_1),
+        (response("d", disease_type="No Crop Detected", severity_level=1), DAY_1),
+        (response("e", severity_level=3), DAY_1),
+        (response("a", "hit"), DAY_2),
+    ])
+
+    days = store.daily_counts("2026-05-01", "2026-05-02", "disease")
+    assert [(row["day"], row["disease_type"], row["analyses"]) for row in days] == [
+        ("2026-05-01", "Leaf Rust", 2),
+        ("2026-05-02", "Leaf Rust", 1),
+    ]
+    assert days[0]["mean_severity"] == 4.5
+    # Every record is still kept, with its outcome
+    outcomes = [record["outcome"] for record in store.query(limit=10)]
+    assert sorted(outcomes) == ["diagnosis"] * 5 + ["failed", "near_duplicate", "no_crop"]
+
+
+def test_repeats_split_across_batches_are_counted_once(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.sqlite3"), batch_size=1)
+    store.record(response("a"), "analyze", recorded_at=DAY_1)
+    store.record(response("a", "hit"), "batch", recorded_at=DAY_1 + 60)
+    asyncio.run(store.flush())
+    assert store.batches == 2
+    assert store.daily_counts("2026-05-01", "2026-05-01")[0]["analyses"] == 1
+
+
+def test_severity_histogram_covers_levels_1_to_10(tmp_path):
+    store = store_with(tmp_path, [(response("a", severity_level=1), DAY_1), (response("b", severity_level=10), DAY_1)])
+    histogram = store.severity_histogram("2026-05-01", "2026-05-01")
+    assert list(histogram) == list(range(1, 11))
+    assert (histogram[1], histogram[10], sum(histogram.values())) == (1, 1, 2)
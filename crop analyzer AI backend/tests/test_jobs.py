@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from app.services.jobs import InMemoryJobQueue, JobQueueFull
+from app.services.upload_limits import UploadBudget
+
+
+def test_queued_images_are_charged_to_the_upload_budget_until_their_job_finishes():
+    async def scenario():
+        budget = UploadBudget(250)
+        release = asyncio.Event()
+
+        async def handler(image_data: bytes, filename: str):
+            await release.wait()
+            return {"size": len(image_data)}
+
+        queue = InMemoryJobQueue(handler, workers=1, budget=budget)
+        await queue.start()
+        running = await queue.submit(b"x" * 100, "running.jpg")
+        queued = await queue.submit(b"x" * 100, "queued.jpg")
+        await asyncio.sleep(0)
+        # Plenty of queue slots left, but not enough budget
+        with pytest.raises(JobQueueFull):
+            await queue.submit(b"x" * 100, "rejected.jpg")
+        held = (budget.stats(), queue.stats())
+        release.set()
+        await queue.stop(drain_timeout_s=1)
+        return held, (budget.stats(), queue.stats()), [queue.get(job.id).status for job in (running, queued)]
+
+    (budget_held, queue_held), (budget_after, queue_after), statuses = asyncio.run(scenario())
+    assert budget_held["in_flight_bytes"] == 200
+    assert queue_held["held_bytes"] == 200
+    assert queue_held["rejected"] == 1
+    assert statuses == ["succeeded", "succeeded"]
+    assert budget_after["in_flight_bytes"] == 0
+    assert queue_after["held_bytes"] == 0
+
+
+def test_jobs_left_queued_at_shutdown_fail_and_give_their_bytes_back():
+    async def scenario():
+        budget = UploadBudget(1000)
+
+        async def handler(image_data: bytes, filename: str):
+            await asyncio.sleep(10)
+
+        queue = InMemoryJobQueue(handler, workers=1, budget=budget)
+        await queue.start()
+        jobs = [await queue.submit(b"x" * 100, f"{i}.jpg") for i in range(3)]
+        await asyncio.sleep(0)
+        await queue.stop()
+        return budget.stats(), [queue.get(job.id).error["status_code"] for job in jobs]
+
+    budget, errors = asyncio.run(scenario())
+    assert budget["in_flight_bytes"] == 0
+    assert errors == [503, 503, 503]
@@ -0,0 +1,91 @@
+import asyncio
+import io
+import random
+
+from PIL import Image
+
+from app.services.perceptual_hash import HammingIndex, color_distance, image_signature
+from app.services.result_cache import AnalysisCache
+
+GREEN = (0.3, 1.0, 0.3)
+RED = (1.0, 0.3, 0.3)
+
+
+def encode(image: Image.Image, quality: int = 90) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def leaf(tint=GREEN, size=(96, 96), seed=0) -> Image.Image:
+    """Blocky texture whose brightness pattern is the same whatever the tint"""
+    rng = random.Random(seed)
+    blocks = [[rng.randrange(40, 255) for _ in range(12)] for _ in range(12)]
+    image = Image.new("RGB", size)
+    image.putdata([
+        tuple(int(channel * blocks[y * 12 // size[1]][x * 12 // size[0]]) for channel in tint)
+        for y in range(size[1]) for x in range(size[0])
+    ])
+    return image
+
+
+def test_flat_and_textureless_images_have_no_signature():
+    for color in ((200, 30, 30), (30, 30, 200), (230, 220, 40), (40, 160, 40)):
+        assert image_signature(encode(Image.new("RGB", (64, 64), color))) is None
+    rng = random.Random(1)
+    faint = Image.new("L", (64, 64))
+    faint.putdata([128 + rng.choice((-1, 0, 1)) for _ in range(64 * 64)])
+    assert image_signature(encode(faint.convert("RGB"))) is None
+
+
+def test_resized_copy_keeps_its_signature():
+    phash, color = image_signature(encode(leaf()))
+    copy_phash, copy_color = image_signature(encode(leaf().resize((64, 64)), quality=60))
+    assert bin(phash ^ copy_phash).count("1") <= 6
+    assert color_distance(color, copy_color) <= 24
+
+
+def test_search_with_a_color_skips_differently_colored_entries():
+    green_hash, green = image_signature(encode(leaf(GREEN)))
+    red_hash, red = image_signature(encode(leaf(RED)))
+    # Same structure in another color: the hashes alone cannot tell them apart
+    assert bin(green_hash ^ red_hash).count("1") <= 6
+    index = HammingIndex(max_distance=6, max_color_distance=24)
+    index.add(green_hash, "green", color=green)
+    index.add(red_hash ^ 1, "colorless")
+    assert sorted(value for _d, _h, value in index.search(red_hash)) == ["colorless", "green"]
+    assert index.search(red_hash, color=red) == []
+    assert [value for _d, _h, value in index.search(green_hash, color=green)] == ["green"]
+
+
+def analyze_after_green_leaf(mock_upstream, analyzer, image: bytes):
+    async def scenario():
+        async with mock_upstream() as client:
+            crop_analyzer = analyzer(client, cache=AnalysisCache(), phash_index=HammingIndex())
+            first = await crop_analyzer.analyze_crop_image(encode(leaf(GREEN)), "leaf.jpg")
+            second = await crop_analyzer.analyze_crop_image(image, "other.jpg")
+            return first, second, (await client.get("/stats")).json()
+
+    return asyncio.run(scenario())
+
+
+def test_resized_copy_reuses_the_analysis(mock_upstream, analyzer):
+    first, second, stats = analyze_after_green_leaf(mock_upstream, analyzer, encode(leaf().resize((64, 64)), 60))
+    assert second["cache_status"] == "near_hit"
+    assert second["disease_type"] == first["disease_type"]
+    assert stats["requests"] == 1
+
+
+def test_solid_color_images_get_their_own_analysis(mock_upstream, analyzer):
+    for color in ((200, 30, 30), (30, 30, 200), (230, 220, 40)):
+        _first, second, stats = analyze_after_green_leaf(
+            mock_upstream, analyzer, encode(Image.new("RGB", (96, 96), color))
+        )
+        assert second["cache_status"] == "miss"
+        assert stats["requests"] == 2
+
+
+def test_same_structure_in_another_color_gets_its_own_analysis(mock_upstream, analyzer):
+    _first, second, stats = analyze_after_green_leaf(mock_upstream, analyzer, encode(leaf(RED)))
+    assert second["cache_status"] == "miss"
+    assert stats["requests"] == 2
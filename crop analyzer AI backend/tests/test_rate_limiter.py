@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+
+from app.services.rate_limiter import AdaptiveConcurrencyLimiter, TokenBucket, UpstreamLimiter
+from app.services.shared_state import SharedState
+
+
+def test_limit_grows_additively_on_healthy_calls():
+    limiter = AdaptiveConcurrencyLimiter(initial=4, maximum=6)
+    for _ in range(4):
+        limiter.on_success(0.1)
+    # About one slot per window of `limit` successes
+    assert 4.9 < limiter.limit < 5.1
+    for _ in range(100):
+        limiter.on_success(0.1)
+    assert limiter.limit == 6
+
+
+def test_limit_halves_on_rate_limit_once_per_interval():
+    limiter = AdaptiveConcurrencyLimiter(initial=16, minimum=2, decrease_interval_s=60)
+    limiter.on_rate_limited()
+    limiter.on_rate_limited()
+    assert limiter.limit == 8
+    limiter = AdaptiveConcurrencyLimiter(initial=16, minimum=2, decrease_interval_s=0)
+    for _ in range(10):
+        limiter.on_rate_limited()
+    assert limiter.limit == 2
+
+
+def test_latency_spike_shrinks_the_limit():
+    limiter = AdaptiveConcurrencyLimiter(initial=10, decrease_interval_s=0)
+    limiter.on_success(0.1)
+    before = limiter.limit
+    limiter.on_success(1.0)
+    assert limiter.limit < before
+
+
+def test_limit_shrinks_under_429s_from_the_mock(mock_upstream, analyzer, image_bytes):
+    async def scenario():
+        concurrency = AdaptiveConcurrencyLimiter(initial=8, minimum=1, decrease_interval_s=0)
+        limiter = UpstreamLimiter(requests_per_minute=0, tokens_per_minute=0, concurrency=concurrency)
+        async with mock_upstream(rate_limit_rate=1.0, retry_after_s=0.01) as client:
+            crop_analyzer = analyzer(client, limiter=limiter)
+            results = await asyncio.gather(
+                *(crop_analyzer.analyze_crop_image(image_bytes(i), "leaf.jpg") for i in range(4)),
+                return_exceptions=True,
+            )
+        return results, limiter.stats()
+
+    results, stats = asyncio.run(scenario())
+    assert all(getattr(result, "status_code", None) == 503 for result in results)
+    assert stats["rate_limited"] == 4
+    assert stats["concurrency_limit"] < 8
+    assert stats["in_flight"] == 0
+
+
+def test_in_flight_calls_never_exceed_the_limit(mock_upstream, analyzer, image_bytes):
+    async def scenario():
+        concurrency = AdaptiveConcurrencyLimiter(initial=3, minimum=3, maximum=3)
+        limiter = UpstreamLimiter(requests_per_minute=0, tokens_per_minute=0, concurrency=concurrency)
+        peak = 0
+
+        async def watch():
+            nonlocal peak
+            while True:
+                peak = max(peak, concurrency.in_flight)
+                await asyncio.sleep(0.001)
+
+        watcher = asyncio.create_task(watch())
+        async with mock_upstream(latency_ms=20) as client:
+            crop_analyzer = analyzer(client, limiter=limiter)
+            await asyncio.gather(*(crop_analyzer.analyze_crop_image(image_bytes(i), "leaf.jpg") for i in range(12)))
+        watcher.cancel()
+        return peak
+
+    assert asyncio.run(scenario()) == 3
+
+
+def test_call_queued_during_a_pause_waits_it_out():
+    async def scenario():
+        limiter = UpstreamLimiter(
+            requests_per_minute=0, tokens_per_minute=0,
+            concurrency=AdaptiveConcurrencyLimiter(initial=1, minimum=1, maximum=1),
+        )
+        granted_at = []
+
+        async def queued_call():
+            async with limiter.permit():
+                granted_at.append(time.time())
+
+        async with limiter.permit() as permit:
+            waiting = asyncio.create_task(queued_call())
+            await asyncio.sleep(0.01)
+            # A 429 arrives while the second call waits for the slot
+            permit.rate_limited(0.2)
+            paused_until = limiter.paused_until
+        await waiting
+        return granted_at[0], paused_until, limiter.concurrency.in_flight
+
+    granted_at, paused_until, in_flight = asyncio.run(scenario())
+    assert granted_at >= paused_until
+    assert in_flight == 0
+
+
+def test_token_bucket_paces_acquisitions():
+    async def scenario():
+        bucket = TokenBucket(rate_per_minute=600, capacity=2)
+        start = time.monotonic()
+        for _ in range(4):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    # Two from the burst capacity, two more at 10 per second
+    assert 0.15 < asyncio.run(scenario()) < 0.5
+
+
+def test_shared_state_is_never_touched_on_the_event_loop(tmp_path, mock_upstream, analyzer, image_bytes):
+    shared = SharedState(str(tmp_path / "shared.sqlite3"))
+    threads = []
+    for name in ("transaction", "get_value", "raise_value"):
+        method = getattr(shared, name)
+
+        def spy(*args, method=method, **kwargs):
+            threads.append(threading.current_thread())
+            return method(*args, **kwargs)
+
+        setattr(shared, name, spy)
+
+    async def scenario():
+        limiter = UpstreamLimiter(requests_per_minute=600, tokens_per_minute=600_000, shared=shared)
+        async with mock_upstream(rate_limit_rate=0.5, retry_after_s=0.01) as client:
+            crop_analyzer = analyzer(client, limiter=limiter)
+            await asyncio.gather(
+                *(crop_analyzer.analyze_crop_image(image_bytes(i), "leaf.jpg") for i in range(8)),
+                return_exceptions=True,
+            )
+        stats = limiter.stats()
+        await limiter.flush()
+        return stats, limiter.paused_until, list(threads), threading.current_thread()
+
+    stats, paused_until, seen, loop_thread = asyncio.run(scenario())
+    assert stats["rate_limited"] > 0 and stats["tokens_available"] < 600_000
+    # The pause other workers see was written
+    assert shared.get_value("upstream_paused_until") == paused_until
+    assert seen and loop_thread not in seen
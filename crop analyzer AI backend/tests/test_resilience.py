@@ -0,0 +1,164 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from app.services.rate_limiter import AdaptiveConcurrencyLimiter, UpstreamLimiter
+from app.services.request_context import DeadlineExceeded
+from app.services.resilience import (
+    ResilientCaller, UpstreamError, UpstreamTarget, is_breaker_failure, is_retryable,
+)
+
+MOCK_URL = "http://mock-openrouter/api/v1/chat/completions"
+
+
+@pytest.mark.parametrize(
+    "error, retryable, breaker_failure",
+    [
+        (UpstreamError(500, "bad gateway", upstream_status=502), True, True),
+        (UpstreamError(500, "timeout", upstream_status=408), True, True),
+        (UpstreamError(503, "rate limited", upstream_status=429, retry_after_s=1.0), True, False),
+        (UpstreamError(500, "transport"), True, True),
+        (UpstreamError(500, "unauthorized", upstream_status=401), False, False),
+        (UpstreamError(500, "bad request", upstream_status=400), False, False),
+        (HTTPException(status_code=400, detail="client error"), False, False),
+        (HTTPException(status_code=502, detail="server error"), True, True),
+        (httpx.ConnectError("refused"), True, True),
+        (DeadlineExceeded(), False, False),
+    ],
+)
+def test_retry_policy(error, retryable, breaker_failure):
+    assert is_retryable(error) is retryable
+    assert is_breaker_failure(error) is breaker_failure
+
+
+def caller(models=("mock/a",), **options) -> ResilientCaller:
+    options.setdefault("max_attempts", 3)
+    options.setdefault("retry_base_delay_s", 0.0)
+    options.setdefault("hedge_percentile", 0)
+    return ResilientCaller([UpstreamTarget(model, MOCK_URL) for model in models], **options)
+
+
+async def analyze(crop_analyzer, image: bytes):
+    try:
+        return await crop_analyzer.analyze_crop_image(image, "leaf.jpg")
+    except HTTPException as e:
+        return e
+
+
+def test_5xx_is_retried_up_to_max_attempts(mock_upstream, analyzer, image_bytes):
+    async def scenario():
+        async with mock_upstream(error_rate=1.0) as client:
+            result = await analyze(analyzer(client, resilience=caller(breaker_failure_threshold=10)), image_bytes())
+            return result, (await client.get("/stats")).json()
+
+    error, stats = asyncio.run(scenario())
+    assert isinstance(error, UpstreamError) and error.upstream_status == 502
+    assert stats["requests"] == 3
+
+
+def test_429_is_retried_after_retry_after_without_opening_the_breaker(mock_upstream, analyzer, image_bytes):
+    async def scenario():
+        resilience = caller(breaker_failure_threshold=1)
+        async with mock_upstream(rate_limit_rate=1.0, retry_after_s=0.05) as client:
+            error = await analyze(analyzer(client, resilience=resilience), image_bytes())
+            return error, (await client.get("/stats")).json(), resilience
+
+    error, stats, resilience = asyncio.run(scenario())
+    assert error.status_code == 503 and error.upstream_status == 429
+    assert "Retry-After" in error.headers
+    assert stats["rate_limited"] == 3
+    assert resilience.breakers["mock/a"].state == "closed"
+
+
+def test_429_with_a_long_retry_after_goes_back_to_the_client(mock_upstream, analyzer, image_bytes):
+    async def scenario():
+        async with mock_upstream(rate_limit_rate=1.0, retry_after_s=60) as client:
+            error = await analyze(analyzer(client, resilience=caller(retry_max_delay_s=1.0)), image_bytes())
+            return error, (await client.get("/stats")).json()
+
+    error, stats = asyncio.run(scenario())
+    assert error.status_code == 503
+    assert stats["requests"] == 1
+
+
+def test_failing_model_fails_over_and_its_breaker_opens(mock_upstream):
+    async def scenario():
+        resilience = caller(models=("mock/a", "mock/b"), breaker_failure_threshold=2)
+        async with mock_upstream() as healthy:
+            # mock/a answers 502s, mock/b is served by the healthy mock
+            async with mock_upstream(error_rate=1.0) as failing:
+                async def send(target: UpstreamTarget):
+                    client = failing if target.model == "mock/a" else healthy
+                    response = await client.post(target.url, json={"model": target.model, "messages": []})
+                    if response.status_code != 200:
+                        raise UpstreamError(500, "upstream error", upstream_status=response.status_code)
+                    return response.json()
+
+                answered = [(await resilience.call(send))[1].model for _ in range(4)]
+                return answered, (await failing.get("/stats")).json(), resilience
+
+    answered, failing_stats, resilience = asyncio.run(scenario())
+    assert answered == ["mock/b"] * 4
+    # Two failures open mock/a's breaker; later calls skip it
+    assert failing_stats["requests"] == 2
+    assert resilience.breakers["mock/a"].state == "open"
+
+
+def test_slow_calls_are_hedged(mock_upstream, analyzer, image_bytes):
+    async def scenario():
+        resilience = caller(max_attempts=1, hedge_percentile=50, hedge_min_samples=5)
+        async with mock_upstream(latency_ms=20, latency_sigma=0.8) as client:
+            crop_analyzer = analyzer(client, resilience=resilience)
+            results = [await analyze(crop_analyzer, image_bytes(i)) for i in range(30)]
+            return results, (await client.get("/stats")).json(), resilience
+
+    results, stats, resilience = asyncio.run(scenario())
+    assert all(isinstance(result, dict) for result in results)
+    assert resilience.hedges > 0
+    # A hedge that lost the race may be cancelled before the mock counts it
+    assert 30 < stats["requests"] <= 30 + resilience.hedges
+
+
+def test_time_queued_for_a_slot_neither_triggers_a_hedge_nor_counts_as_latency(mock_upstream, analyzer, image_bytes):
+    async def scenario():
+        resilience = caller(max_attempts=1, hedge_percentile=50, hedge_min_samples=5)
+        for _ in range(5):
+            resilience.latencies["mock/a"].add(0.02)
+        limiter = UpstreamLimiter(
+            requests_per_minute=0, tokens_per_minute=0,
+            concurrency=AdaptiveConcurrencyLimiter(initial=1, minimum=1, maximum=1),
+        )
+        async with mock_upstream() as client:
+            crop_analyzer = analyzer(client, resilience=resilience, limiter=limiter)
+            async with limiter.permit():
+                # Queued ten times longer than the hedge threshold
+                upload = asyncio.create_task(analyze(crop_analyzer, image_bytes()))
+                await asyncio.sleep(0.2)
+            result = await upload
+            return result, (await client.get("/stats")).json(), resilience
+
+    result, stats, resilience = asyncio.run(scenario())
+    assert result["attempts"] == 1
+    assert resilience.hedges == 0
+    assert stats["requests"] == 1
+    assert resilience.latencies["mock/a"].samples[-1] < 0.1
+
+
+def test_hedge_still_queued_when_the_call_ends_is_not_counted(mock_upstream, analyzer, image_bytes):
+    async def scenario():
+        resilience = caller(max_attempts=1, hedge_percentile=50, hedge_min_samples=5)
+        for _ in range(5):
+            resilience.latencies["mock/a"].add(0.02)
+        # One request per minute: the hedge waits for the bucket until the first answers
+        limiter = UpstreamLimiter(requests_per_minute=1, tokens_per_minute=0)
+        async with mock_upstream(latency_ms=100) as client:
+            crop_analyzer = analyzer(client, resilience=resilience, limiter=limiter)
+            result = await analyze(crop_analyzer, image_bytes())
+            return result, (await client.get("/stats")).json(), resilience
+
+    result, stats, resilience = asyncio.run(scenario())
+    assert resilience.hedges == 1
+    assert result["attempts"] == 1
+    assert stats["requests"] == 1
@@ -0,0 +1,205 @@
+import asyncio
+from typing import List
+
+from app.services.rate_limiter import AdaptiveConcurrencyLimiter, UpstreamLimiter
+from app.services.scheduler import FairScheduler, Flow, FlowGroup, scheduling
+
+LANES = [("interactive", 4.0), ("bulk", 1.0)]
+
+
+def make_scheduler(slots: int = 1, lanes=LANES, **options) -> FairScheduler:
+    concurrency = AdaptiveConcurrencyLimiter(initial=slots, minimum=slots, maximum=slots)
+    return FairScheduler(concurrency, list(lanes), **options)
+
+
+async def dispatch_order(scheduler: FairScheduler, flows: List[Flow]) -> List[Flow]:
+    """
+    Queue one call per flow while a held call keeps the only slot busy, then let
+    them run one after another; returns the flows in the order they got the slot
+    """
+    order = []
+    holder = await scheduler.acquire()
+
+    async def call(flow: Flow):
+        with scheduling(flow):
+            granted = await scheduler.acquire()
+        order.append(granted)
+        scheduler.release(granted)
+
+    tasks = [asyncio.create_task(call(flow)) for flow in flows]
+    await asyncio.sleep(0)
+    scheduler.release(holder)
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_backlogged_lanes_share_slots_by_weight():
+    flows = [Flow("bulk", "batch-tenant")] * 20 + [Flow("interactive", f"farmer-{i}") for i in range(20)]
+    order = asyncio.run(dispatch_order(make_scheduler(), flows))
+    first = [flow.lane for flow in order[:20]]
+    # Queued last, but interactive gets about 4 of every 5 slots
+    assert 15 <= first.count("interactive") <= 17
+    assert len(order) == 40
+
+
+def test_interactive_call_is_not_stuck_behind_a_bulk_backlog():
+    flows = [Flow("bulk", "batch-tenant")] * 50 + [Flow("interactive", "farmer")]
+    order = asyncio.run(dispatch_order(make_scheduler(), flows))
+    assert [flow.lane for flow in order].index("interactive") <= 2
+
+
+def test_tenants_in_a_lane_take_turns():
+    flows = [Flow("bulk", "big")] * 10 + [Flow("bulk", "small")] * 2
+    order = asyncio.run(dispatch_order(make_scheduler(), flows))
+    tenants = [flow.tenant for flow in order]
+    assert tenants[:4].count("small") == 2
+
+
+def test_tenant_at_its_cap_is_skipped():
+    async def scenario():
+        scheduler = make_scheduler(slots=4, tenant_caps={"big": 1})
+        granted = []
+
+        async def call(flow: Flow):
+            with scheduling(flow):
+                granted.append(await scheduler.acquire())
+
+        tasks = [asyncio.create_task(call(Flow("bulk", "big"))) for _ in range(3)]
+        tasks.append(asyncio.create_task(call(Flow("bulk", "small"))))
+        await asyncio.sleep(0.01)
+        in_flight = sorted(flow.tenant for flow in granted)
+        for flow in list(granted):
+            scheduler.release(flow)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return in_flight
+
+    # A free slot stays free rather than going to a tenant over its cap
+    assert asyncio.run(scenario()) == ["big", "small"]
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    async def scenario():
+        scheduler = make_scheduler()
+        holder = await scheduler.acquire()
+        with scheduling(Flow("bulk", "gone")):
+            waiter = asyncio.create_task(scheduler.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        queued = scheduler.queued()[("bulk",)]
+        scheduler.release(holder)
+        return queued, scheduler.concurrency.in_flight
+
+    assert asyncio.run(scenario()) == (0, 0)
+
+
+def test_interactive_uploads_finish_first_against_the_mock(mock_upstream, analyzer, image_bytes):
+    async def scenario():
+        scheduler = make_scheduler(slots=2)
+        limiter = UpstreamLimiter(
+            requests_per_minute=0, tokens_per_minute=0, concurrency=scheduler.concurrency, scheduler=scheduler
+        )
+        finished = []
+        async with mock_upstream(latency_ms=20) as client:
+            crop_analyzer = analyzer(client, limiter=limiter)
+
+            async def upload(flow: Flow, index: int):
+                with scheduling(flow):
+                    await crop_analyzer.analyze_crop_image(image_bytes(index), f"{index}.jpg")
+                finished.append(flow.lane)
+
+            # The bulk backlog is queued before the interactive uploads arrive
+            tasks = [asyncio.create_task(upload(Flow("bulk", "batch-tenant"), i)) for i in range(16)]
+            await asyncio.sleep(0.005)
+            tasks += [asyncio.create_task(upload(Flow("interactive", f"farmer-{i}"), 100 + i)) for i in range(4)]
+            await asyncio.gather(*tasks)
+        return finished, scheduler.stats()
+
+    finished, stats = asyncio.run(scenario())
+    assert len(finished) == 20
+    assert max(index for index, lane in enumerate(finished) if lane == "interactive") < 10
+    assert stats["lanes"]["interactive"]["dispatched"] == 4
+
+
+def test_coalesced_call_moves_to_the_lane_of_its_best_waiter():
+    async def scenario():
+        scheduler = make_scheduler()
+        holder = await scheduler.acquire()
+        order = []
+
+        async def call(flow):
+            with scheduling(flow):
+                granted = await scheduler.acquire()
+            order.append(granted)
+            scheduler.release(granted)
+
+        backlog = [asyncio.create_task(call(Flow("bulk", "batch-tenant"))) for _ in range(10)]
+        group = FlowGroup()
+        group.join(Flow("bulk", "batch-tenant"))
+        shared = asyncio.create_task(call(group))
+        await asyncio.sleep(0)
+        # An interactive upload of the same image joins while the call is queued in bulk
+        group.join(Flow("interactive", "farmer"))
+        queued = scheduler.queued()
+        scheduler.release(holder)
+        await asyncio.gather(shared, *backlog)
+        return queued, order
+
+    queued, order = asyncio.run(scenario())
+    assert queued == {("interactive",): 1, ("bulk",): 10}
+    # Without the move it would have waited for the whole bulk backlog
+    assert order.index(Flow("interactive", "farmer")) <= 1
+
+
+def test_coalesced_call_drops_back_when_its_best_waiter_leaves():
+    async def scenario():
+        scheduler = make_scheduler()
+        holder = await scheduler.acquire()
+        group = FlowGroup()
+        group.join(Flow("interactive", "farmer"))
+        group.join(Flow("bulk", "batch-tenant"))
+        with scheduling(group):
+            shared = asyncio.create_task(scheduler.acquire())
+        await asyncio.sleep(0)
+        before = scheduler.queued()
+        group.leave(Flow("interactive", "farmer"))
+        after = scheduler.queued()
+        scheduler.release(holder)
+        granted = await shared
+        scheduler.release(granted)
+        return before, after, granted
+
+    before, after, granted = asyncio.run(scenario())
+    assert before == {("interactive",): 1, ("bulk",): 0}
+    assert after == {("interactive",): 0, ("bulk",): 1}
+    assert granted == Flow("bulk", "batch-tenant")
+
+
+def test_coalesced_uploads_run_in_the_best_waiters_lane(mock_upstream, analyzer, image_bytes):
+    async def scenario():
+        scheduler = make_scheduler(slots=1)
+        limiter = UpstreamLimiter(
+            requests_per_minute=0, tokens_per_minute=0, concurrency=scheduler.concurrency, scheduler=scheduler
+        )
+        finished = []
+        async with mock_upstream(latency_ms=20) as client:
+            crop_analyzer = analyzer(client, limiter=limiter)
+
+            async def upload(flow: Flow, index: int):
+                with scheduling(flow):
+                    result = await crop_analyzer.analyze_crop_image(image_bytes(index), f"{index}.jpg")
+                finished.append((flow.lane, result["cache_status"]))
+
+            tasks = [asyncio.create_task(upload(Flow("bulk", "batch-tenant"), i)) for i in range(8)]
+            await asyncio.sleep(0.005)
+            # A farmer uploads the same photo the bulk job is waiting to analyze
+            tasks.append(asyncio.create_task(upload(Flow("interactive", "farmer"), 7)))
+            await asyncio.gather(*tasks)
+        return finished, scheduler.stats()
+
+    finished, stats = asyncio.run(scenario())
+    assert finished.index(("interactive", "coalesced")) <= 2
+    assert stats["lanes"]["interactive"]["dispatched"] == 1
+    assert stats["lanes"]["bulk"]["dispatched"] == 7
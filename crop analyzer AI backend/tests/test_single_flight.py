@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+import pytest
+
+from app.services.rate_limiter import AdaptiveConcurrencyLimiter, UpstreamLimiter
+from app.services.request_context import DeadlineExceeded, RequestContext, serving
+from app.services.singleflight import SingleFlight
+
+
+def test_identical_concurrent_uploads_share_one_upstream_call(mock_upstream, analyzer, image_bytes):
+    async def scenario():
+        async with mock_upstream(latency_ms=30) as client:
+            crop_analyzer = analyzer(client)
+            image = image_bytes(1)
+            results = await asyncio.gather(*(crop_analyzer.analyze_crop_image(image, "leaf.jpg") for _ in range(5)))
+            return results, (await client.get("/stats")).json()
+
+    results, stats = asyncio.run(scenario())
+    assert stats["requests"] == 1
+    assert sorted(result["cache_status"] for result in results) == ["coalesced"] * 4 + ["miss"]
+    assert len({result["disease_type"] for result in results}) == 1
+
+
+def test_different_uploads_are_not_coalesced(mock_upstream, analyzer, image_bytes):
+    async def scenario():
+        async with mock_upstream(latency_ms=30) as client:
+            crop_analyzer = analyzer(client)
+            await asyncio.gather(*(crop_analyzer.analyze_crop_image(image_bytes(i), "leaf.jpg") for i in range(3)))
+            return (await client.get("/stats")).json()
+
+    assert asyncio.run(scenario())["requests"] == 3
+
+
+def test_one_waiter_leaving_does_not_cancel_the_shared_call():
+    async def scenario():
+        flight = SingleFlight()
+        started = asyncio.Event()
+
+        async def work():
+            started.set()
+            await asyncio.sleep(0.05)
+            return "done"
+
+        first = asyncio.create_task(flight.do("key", work))
+        second = asyncio.create_task(flight.do("key", work))
+        await started.wait()
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        return await second, flight.stats()
+
+    result, stats = asyncio.run(scenario())
+    assert result == ("done", True)
+    assert stats["upstream_executions"] == 1
+    assert stats["cancelled_executions"] == 0
+
+
+def test_shared_call_is_cancelled_once_every_waiter_left():
+    async def scenario():
+        flight = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def work():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiters = [asyncio.create_task(flight.do("key", work)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        return flight.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["cancelled_executions"] == 1
+    assert stats["in_flight"] == 0
+
+
+@pytest.mark.parametrize("leader_deadline_ms, follower_deadline_ms", [(150, None), (None, 150)])
+def test_request_without_deadline_is_not_failed_by_a_coalesced_short_one(
+    mock_upstream, analyzer, image_bytes, leader_deadline_ms, follower_deadline_ms
+):
+    async def scenario():
+        limiter = UpstreamLimiter(
+            requests_per_minute=0, tokens_per_minute=0,
+            concurrency=AdaptiveConcurrencyLimiter(initial=1, minimum=1, maximum=1),
+        )
+
+        async def upload(deadline_ms):
+            deadline = time.monotonic() + deadline_ms / 1000 if deadline_ms is not None else None
+            with serving(RequestContext(deadline=deadline)):
+                try:
+                    return await crop_analyzer.analyze_crop_image(image_bytes(1), "leaf.jpg")
+                except DeadlineExceeded as e:
+                    return e
+
+        async with mock_upstream() as client:
+            crop_analyzer = analyzer(client, limiter=limiter)
+            async with limiter.permit():
+                # The only upstream slot stays busy past the short deadline
+                leader = asyncio.create_task(upload(leader_deadline_ms))
+                await asyncio.sleep(0.01)
+                follower = asyncio.create_task(upload(follower_deadline_ms))
+                await asyncio.sleep(0.3)
+            results = await asyncio.gather(leader, follower)
+            return results, (await client.get("/stats")).json()
+
+    (leader, follower), stats = asyncio.run(scenario())
+    by_deadline = {leader_deadline_ms: leader, follower_deadline_ms: follower}
+    assert isinstance(by_deadline[150], DeadlineExceeded)
+    assert by_deadline[None]["disease_type"]
+    assert stats["requests"] == 1
@@ -0,0 +1,158 @@
+import asyncio
+import io
+import time
+
+import pytest
+from PIL import Image
+
+from app.services.triage import (
+    HEALTHY, NOT_PLANT, ColorHistogramBackend, MicroBatcher, Triage, create_triage_backend,
+)
+
+
+def solid(color, size=(64, 64)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+GREEN_LEAF = solid((40, 160, 40))
+BROWN_LEAF = solid((150, 100, 30))
+GREY_WALL = solid((128, 128, 128))
+
+
+@pytest.mark.parametrize(
+    "image, label",
+    [(GREEN_LEAF, HEALTHY), (BROWN_LEAF, "diseased"), (GREY_WALL, NOT_PLANT), (solid((30, 60, 200)), NOT_PLANT)],
+)
+def test_bundled_color_model_classifies_offline(image, label):
+    (prediction,) = ColorHistogramBackend().predict_batch([image])
+    assert prediction.label == label
+    assert prediction.confidence > 0.9
+
+
+def test_undecodable_image_gets_a_zero_confidence_prediction():
+    predictions = ColorHistogramBackend().predict_batch([b"not an image", GREEN_LEAF])
+    assert (predictions[0].label, predictions[0].confidence) == ("unknown", 0.0)
+    assert predictions[1].label == HEALTHY
+
+
+def test_backend_factory():
+    assert create_triage_backend("none") is None
+    assert isinstance(create_triage_backend("color"), ColorHistogramBackend)
+    with pytest.raises(ValueError):
+        create_triage_backend("onnx")
+    with pytest.raises(ValueError):
+        create_triage_backend("magic")
+
+
+def run_batcher(items, **options):
+    calls = []
+
+    def fn(batch):
+        calls.append(list(batch))
+        return [item * 10 for item in batch]
+
+    async def scenario():
+        batcher = MicroBatcher(fn, **options)
+        results = await asyncio.gather(*(batcher.submit(item) for item in items))
+        return results, batcher
+
+    results, batcher = asyncio.run(scenario())
+    return results, calls, batcher
+
+
+def test_concurrent_items_run_as_one_batch_when_the_window_closes():
+    results, calls, batcher = run_batcher(range(5), max_batch_size=16, max_wait_ms=20)
+    assert results == [0, 10, 20, 30, 40]
+    assert calls == [[0, 1, 2, 3, 4]]
+    assert (batcher.batches, batcher.items) == (1, 5)
+
+
+def test_full_batch_flushes_without_waiting_for_the_window():
+    start = time.monotonic()
+    results, calls, _batcher = run_batcher(range(6), max_batch_size=3, max_wait_ms=10_000)
+    assert time.monotonic() - start < 1
+    assert results == [0, 10, 20, 30, 40, 50]
+    assert calls == [[0, 1, 2], [3, 4, 5]]
+
+
+def test_partial_batch_flushes_on_the_timer():
+    _results, calls, _batcher = run_batcher(range(4), max_batch_size=3, max_wait_ms=10)
+    assert calls == [[0, 1, 2], [3]]
+
+
+def test_cancelled_caller_is_dropped_from_its_batch():
+    calls = []
+
+    def fn(batch):
+        calls.append(list(batch))
+        return batch
+
+    async def scenario():
+        batcher = MicroBatcher(fn, max_batch_size=16, max_wait_ms=20)
+        gone = asyncio.create_task(batcher.submit("gone"))
+        kept = asyncio.create_task(batcher.submit("kept"))
+        await asyncio.sleep(0)
+        gone.cancel()
+        return await kept
+
+    assert asyncio.run(scenario()) == "kept"
+    assert calls == [["kept"]]
+
+
+def test_backend_error_fails_every_item_of_the_batch():
+    def fn(batch):
+        raise RuntimeError("model crashed")
+
+    async def scenario():
+        batcher = MicroBatcher(fn, max_wait_ms=5)
+        return await asyncio.gather(batcher.submit(1), batcher.submit(2), return_exceptions=True)
+
+    assert [str(error) for error in asyncio.run(scenario())] == ["model crashed"] * 2
+
+
+def test_only_confident_local_labels_are_answered_locally():
+    async def scenario(threshold):
+        triage = Triage(ColorHistogramBackend(), confidence_threshold=threshold)
+        outcomes = [await triage.classify(image) for image in (GREEN_LEAF, GREY_WALL, BROWN_LEAF)]
+        return [local for _prediction, local in outcomes], triage.stats()
+
+    local, stats = asyncio.run(scenario(0.9))
+    # Diseased leaves always go to the vision model
+    assert local == [True, True, False]
+    assert stats["answered_locally"] == {HEALTHY: 1, NOT_PLANT: 1}
+    assert stats["escalated"] == 1
+
+    local, stats = asyncio.run(scenario(1.0))
+    assert local == [False, False, False]
+    assert stats["escalation_rate"] == 1.0
+
+
+def test_local_answer_skips_the_upstream_model(mock_upstream, analyzer):
+    async def scenario():
+        async with mock_upstream() as client:
+            crop_analyzer = analyzer(client, triage=Triage(ColorHistogramBackend(), confidence_threshold=0.9))
+            result = await crop_analyzer.analyze_crop_image(GREEN_LEAF, "leaf.jpg")
+            return result, (await client.get("/stats")).json()
+
+    result, stats = asyncio.run(scenario())
+    assert stats["requests"] == 0
+    assert result["disease_type"] == "Healthy"
+    assert result["model"].startswith("local/")
+
+
+def test_below_threshold_escalates_to_the_upstream_model(mock_upstream, analyzer):
+    async def scenario():
+        async with mock_upstream() as client:
+            crop_analyzer = analyzer(client, triage=Triage(ColorHistogramBackend(), confidence_threshold=1.0))
+            results = [
+                await crop_analyzer.analyze_crop_image(image, name)
+                for image, name in ((GREEN_LEAF, "leaf.jpg"), (BROWN_LEAF, "rust.jpg"))
+            ]
+            return results, (await client.get("/stats")).json()
+
+    results, stats = asyncio.run(scenario())
+    assert stats["requests"] == 2
+    assert [result["triage"]["escalated"] for result in results] == [True, True]
+    assert [result["triage"]["label"] for result in results] == [HEALTHY, "diseased"]
@@ -0,0 +1,85 @@
+import asyncio
+import random
+
+import pytest
+
+from app.services.xml_stream import ANALYSIS_FIELDS, IncrementalXMLParser, parse_fields
+from benchmarks.mock_openrouter import MALFORMED, MockConfig, analysis_block
+
+ANSWER = (
+    "<analysis>\n    <confidence>high</confidence>\n    <disease_type>Late Blight</disease_type>\n"
+    "    <severity_level>7</severity_level>\n    <affected_area_percentage>40</affected_area_percentage>\n"
+    "    <crop_type>Tomato</crop_type>\n</analysis>"
+)
+EXPECTED = {
+    "disease_type": "Late Blight", "severity_level": "7", "affected_area_percentage": "40", "crop_type": "Tomato",
+}
+
+
+def feed_in_chunks(text: str, size: int):
+    parser = IncrementalXMLParser()
+    reported = []
+    for start in range(0, len(text), size):
+        reported.extend(parser.feed(text[start:start + size]))
+    return parser, reported
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 8, 13, 64, len(ANSWER)])
+def test_fields_split_across_chunks_are_parsed_once_in_document_order(size):
+    parser, reported = feed_in_chunks(ANSWER, size)
+    assert parser.complete
+    assert parser.values == EXPECTED
+    assert [field for field, _value in reported] == list(ANALYSIS_FIELDS)
+    assert dict(reported) == EXPECTED
+
+
+def test_field_is_reported_when_its_closing_tag_arrives():
+    parser = IncrementalXMLParser()
+    assert parser.feed("<analysis><disease_type>Rust</disease_") == []
+    assert parser.feed("type><severity_level>3") == [("disease_type", "Rust")]
+    assert parser.feed("</severity_level>") == [("severity_level", "3")]
+    assert not parser.complete
+
+
+def test_first_occurrence_wins():
+    values = parse_fields("<disease_type>Rust</disease_type><disease_type>Blight</disease_type>")
+    assert values == {"disease_type": "Rust"}
+
+
+def test_truncated_answer_leaves_missing_fields_absent():
+    values = parse_fields(MALFORMED[1])
+    assert values == {"disease_type": "Late Blight"}
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_mock_answers_parse_the_same_incrementally_and_whole(seed):
+    rng = random.Random(seed)
+    text = analysis_block(rng, MockConfig())
+    whole = parse_fields(text)
+    assert set(whole) == set(ANALYSIS_FIELDS)
+    parser, _reported = feed_in_chunks(text, rng.randint(1, 16))
+    assert parser.values == whole
+
+
+def test_streamed_analysis_reports_fields_before_the_result(mock_upstream, analyzer, image_bytes):
+    async def scenario():
+        async with mock_upstream(chunk_chars=4) as client:
+            crop_analyzer = analyzer(client, streaming=True)
+            fields = []
+
+            def on_field(name, value):
+                fields.append((name, value))
+
+            result = await crop_analyzer.analyze_crop_image(image_bytes(), "leaf.jpg", on_field=on_field)
+            await crop_analyzer.wait_for_drains()
+            stats = (await client.get("/stats")).json()
+        return result, fields, stats, crop_analyzer.usage_stats()
+
+    result, fields, stats, usage = asyncio.run(scenario())
+    assert stats["streamed"] == 1
+    assert [name for name, _value in fields] == list(ANALYSIS_FIELDS)
+    assert dict(fields)["disease_type"] == result["disease_type"]
+    assert dict(fields)["crop_type"] == result["crop_type"]
+    # The usage chunk after the answer was read by the background drain and counted
+    assert usage["stream_drains"]["drained"] == 1
+    assert usage["single"]["prompt_tokens"] == stats["prompt_tokens"]